@@ -55,6 +55,17 @@ class NGIObject(object):
             subitem = self._subitems[name] = self._subitem_type(name, dirname)
         return subitem
 
+    def merge(self, other):
+        """Add the subitems of another object with the same name to this one,
+        merging those that both have.
+        """
+        for name, other_subitem in other._subitems.items():
+            try:
+                self._subitems[name].merge(other_subitem)
+            except KeyError:
+                self._subitems[name] = other_subitem
+        self.being_analyzed = self.being_analyzed or other.being_analyzed
+
     def __iter__(self):
         return iter(self._subitems.values())
 
@@ -103,6 +114,11 @@ class NGISeqRun(NGIObject):
     def __iter__(self):
         return iter(self._subitems)
 
+    def merge(self, other):
+        self.add_fastq_files([fastq for fastq in other.fastq_files
+                              if fastq not in self.fastq_files])
+        self.being_analyzed = self.being_analyzed or other.being_analyzed
+
     def add_fastq_files(self, fastq):
         if type(fastq) == list:
             self._subitems.extend(fastq)
@@ -4,23 +4,28 @@
 
 from __future__ import print_function
 
-import glob
+import collections
+import fnmatch
 import os
 import re
 import sys
 
+from multiprocessing.pool import ThreadPool
 from ngi_pipeline.conductor.classes import NGIProject
 from ngi_pipeline.conductor.launchers import launch_analysis
-from ngi_pipeline.database.classes import CharonSession, CharonError
+from ngi_pipeline.conductor.manifest import FlowcellManifest, get_manifest_path
+from ngi_pipeline.database.classes import CharonError
 from ngi_pipeline.database.communicate import get_project_id_from_name
 from ngi_pipeline.database.filesystem import create_charon_entries_from_project
 from ngi_pipeline.log.loggers import minimal_logger
 from ngi_pipeline.utils.classes import with_ngi_config
 from ngi_pipeline.utils.communication import mail_analysis
-from ngi_pipeline.utils.filesystem import do_rsync, do_symlink, \
-                                          locate_flowcell, safe_makedir
+from ngi_pipeline.utils.fastq import fastq_stem
+from ngi_pipeline.utils.filesystem import do_rsync, list_dir_entries, locate_flowcell, \
+                                          safe_makedir, safe_symlink, LinkPlan
 from ngi_pipeline.utils.parsers import determine_library_prep_from_fcid, \
                                        determine_library_prep_from_samplesheet, \
+                                       get_sample_libprep_seqruns, \
                                        parse_lane_from_filename
 
 LOG = minimal_logger(__name__)
@@ -68,7 +73,7 @@ def process_demultiplexed_flowcells(demux_fcid_dirs, restrict_to_projects=None,
                                     restart_finished_jobs=False, restart_running_jobs=False,
                                     fallback_libprep=None, keep_existing_data=False, no_qc=False,
                                     quiet=False, manual=False, config=None, config_file_path=None,
-                                    generate_bqsr_bam=False):
+                                    generate_bqsr_bam=False, workers=None):
     """Sort demultiplexed Illumina flowcells into projects and launch their analysis.
 
     :param list demux_fcid_dirs: The CASAVA-produced demux directory/directories.
@@ -85,6 +90,7 @@ def process_demultiplexed_flowcells(demux_fcid_dirs, restrict_to_projects=None,
     :param bool manual: This is being run from a user script; added to config
     :param dict config: The parsed NGI configuration file; optional.
     :param str config_file_path: The path to the NGI configuration file; optional.
+    :param int workers: The number of flowcells to organize concurrently (default 1)
     """
     if not restrict_to_projects: restrict_to_projects = []
     if not restrict_to_samples: restrict_to_samples = []
@@ -92,7 +98,8 @@ def process_demultiplexed_flowcells(demux_fcid_dirs, restrict_to_projects=None,
                                                           restrict_to_projects=restrict_to_projects,
                                                           restrict_to_samples=restrict_to_samples,
                                                           fallback_libprep=fallback_libprep,
-                                                          quiet=quiet, config=config)
+                                                          quiet=quiet, workers=workers,
+                                                          config=config)
     for project in projects_to_analyze:
         if UPPSALA_PROJECT_RE.match(project.project_id):
             LOG.info('Creating Charon records for Uppsala project "{}" if they '
@@ -107,11 +114,16 @@ def process_demultiplexed_flowcells(demux_fcid_dirs, restrict_to_projects=None,
 def organize_projects_from_flowcell(demux_fcid_dirs, restrict_to_projects=None,
                                     restrict_to_samples=None,
                                     fallback_libprep=None, quiet=False,
-                                    create_files=True,
+                                    create_files=True, workers=None,
                                     config=None, config_file_path=None):
     """Sort demultiplexed Illumina flowcells into projects and return a list of them,
     creating the project/sample/libprep/seqrun dir tree on disk via symlinks.
 
+    Each flowcell is organized on its own, up to workers of them at a time in
+    a pool of threads, and the resulting project trees are merged in the
+    sorted order of the flowcell paths, so the result does not depend on
+    which flowcell finishes first.
+
     :param list demux_fcid_dirs: The CASAVA-produced demux directory/directories.
     :param list restrict_to_projects: A list of projects; analysis will be
                                       restricted to these. Optional.
@@ -120,6 +132,7 @@ def organize_projects_from_flowcell(demux_fcid_dirs, restrict_to_projects=None,
     :param str fallback_libprep: If libprep cannot be determined, use this value if supplied (default None)
     :param bool quiet: Don't send notification emails
     :param bool create_files: Alter the filesystem (as opposed to just parsing flowcells) (default True)
+    :param int workers: The number of flowcells to organize concurrently (default 1)
     :param dict config: The parsed NGI configuration file; optional.
     :param str config_file_path: The path to the NGI configuration file; optional.
 
@@ -130,9 +143,8 @@ def organize_projects_from_flowcell(demux_fcid_dirs, restrict_to_projects=None,
     if not restrict_to_projects: restrict_to_projects = []
     if not restrict_to_samples: restrict_to_samples = []
     demux_fcid_dirs_set = set(demux_fcid_dirs)
-    # Sort/copy each raw demux FC into project/sample/fcid format -- "analysis-ready"
-    projects_to_analyze = dict()
-    for demux_fcid_dir in demux_fcid_dirs_set:
+    fc_dirs = []
+    for demux_fcid_dir in sorted(demux_fcid_dirs_set):
         try:
             # Get the full path to the flowcell if it was passed in as just a name
             demux_fcid_dir = locate_flowcell(demux_fcid_dir)
@@ -140,16 +152,40 @@ def organize_projects_from_flowcell(demux_fcid_dirs, restrict_to_projects=None,
             # Flowcell path couldn't be found/doesn't exist; skip it
             LOG.error('Skipping flowcell "{}": {}'.format(demux_fcid_dir, e))
             continue
+        if demux_fcid_dir not in fc_dirs:
+            fc_dirs.append(demux_fcid_dir)
+
+    # Set once here, not by each flowcell's thread; launch_analysis reads it later
+    config["quiet"] = quiet
+    # Sort/copy each raw demux FC into project/sample/fcid format -- "analysis-ready"
+    def setup_flowcell(fc_dir):
         # These will be a bunch of Project objects each containing Samples, FCIDs, lists of fastq files
-        projects_to_analyze = \
-                setup_analysis_directory_structure(fc_dir=demux_fcid_dir,
-                                                   projects_to_analyze=projects_to_analyze,
-                                                   restrict_to_projects=restrict_to_projects,
-                                                   restrict_to_samples=restrict_to_samples,
-                                                   create_files=create_files,
-                                                   fallback_libprep=fallback_libprep,
-                                                   config=config,
-                                                   quiet=quiet)
+        return setup_analysis_directory_structure(fc_dir=fc_dir,
+                                                  projects_to_analyze=collections.OrderedDict(),
+                                                  restrict_to_projects=restrict_to_projects,
+                                                  restrict_to_samples=restrict_to_samples,
+                                                  create_files=create_files,
+                                                  fallback_libprep=fallback_libprep,
+                                                  config=config,
+                                                  quiet=quiet)
+    workers = min(len(fc_dirs), int(workers or 1))
+    if workers > 1:
+        LOG.info("Organizing {} flowcells with {} workers".format(len(fc_dirs), workers))
+        pool = ThreadPool(workers)
+        try:
+            fc_projects = pool.map(setup_flowcell, fc_dirs)
+        finally:
+            pool.close()
+    else:
+        fc_projects = map(setup_flowcell, fc_dirs)
+    projects_to_analyze = collections.OrderedDict()
+    for flowcell_projects in fc_projects:
+        # An empty list if the flowcell could not be parsed
+        for project_dir, project_obj in (flowcell_projects or {}).items():
+            try:
+                projects_to_analyze[project_dir].merge(project_obj)
+            except KeyError:
+                projects_to_analyze[project_dir] = project_obj
     if not projects_to_analyze:
         if restrict_to_projects:
             error_message = ("No projects found to process: the specified flowcells "
@@ -187,6 +223,7 @@ def setup_analysis_directory_structure(fc_dir, projects_to_analyze,
     :param str fallback_libprep: If libprep cannot be determined, use this value if supplied (default None)
     :param list restrict_to_projects: Specific projects within the flowcell to process exclusively
     :param list restrict_to_samples: Specific samples within the flowcell to process exclusively
+    :param bool quiet: Don't send notification emails
 
     :returns: A list of NGIProject objects that need to be run through the analysis pipeline
     :rtype: list
@@ -196,7 +233,6 @@ def setup_analysis_directory_structure(fc_dir, projects_to_analyze,
     LOG.info("Setting up analysis for demultiplexed data in source folder \"{}\"".format(fc_dir))
     if not restrict_to_projects: restrict_to_projects = []
     if not restrict_to_samples: restrict_to_samples = []
-    config["quiet"] = quiet # Hack because I enter here from a script sometimes
     #Checks flowcell path to establish which group owns it
     pattern=".+({}|{})\/.+".format(config["analysis"]["sthlm_root"], config["analysis"]["upps_root"])
     matches=re.match(pattern, fc_dir)
@@ -223,6 +259,17 @@ def setup_analysis_directory_structure(fc_dir, projects_to_analyze,
         LOG.error("Error when processing flowcell dir \"{}\": {}".format(fc_dir, e))
         return []
     fc_full_id = fc_dir_structure['fc_full_id']
+    # (project_id, sample_name, fc_full_id) -> libprep name (or None) from Charon
+    charon_libpreps = {}
+    # How this flowcell was organized before, if it was
+    manifest = None
+    if create_files:
+        manifest = FlowcellManifest(get_manifest_path(analysis_top_dir, fc_full_id),
+                                    fc_dir_structure['fc_dir'])
+    # The fastq files to symlink into the seqrun directories, made once all
+    # the samples have been set up
+    link_plan = LinkPlan()
+    linked_samples = []
     if not fc_dir_structure.get('projects'):
         LOG.warn("No projects found in specified flowcell directory \"{}\"".format(fc_dir))
     # Iterate over the projects in the flowcell directory
@@ -231,8 +278,12 @@ def setup_analysis_directory_structure(fc_dir, projects_to_analyze,
         project_original_name = project['project_original_name']
         samplesheet_path = fc_dir_structure.get("samplesheet_path")
         try:
-            # Maps e.g. "Y.Mom_14_01" to "P123"
-            project_id = get_project_id_from_name(project_name)
+            if manifest and project_name in manifest.project_ids:
+                project_id = str(manifest.project_ids[project_name])
+            else:
+                # Maps e.g. "Y.Mom_14_01" to "P123"
+                project_id = get_project_id_from_name(project_name)
+                if manifest: manifest.project_ids[project_name] = project_id
         except (CharonError, RuntimeError, ValueError) as e:
             LOG.warn('Could not retrieve project id from Charon (record missing?). '
                      'Using project name ("{}") as project id '
@@ -253,12 +304,10 @@ def setup_analysis_directory_structure(fc_dir, projects_to_analyze,
         if create_files:
             safe_makedir(project_dir, 0o2770)
             safe_makedir(project_analysis_dir, 0o2770)
-            if not project_dir == project_sl_dir and \
-               not os.path.exists(project_sl_dir):
-                os.symlink(project_dir, project_sl_dir)
-            if not project_analysis_dir == project_analysis_sl_dir and \
-               not os.path.exists(project_analysis_sl_dir):
-                os.symlink(project_analysis_dir, project_analysis_sl_dir)
+            if not project_dir == project_sl_dir:
+                safe_symlink(project_dir, project_sl_dir)
+            if not project_analysis_dir == project_analysis_sl_dir:
+                safe_symlink(project_analysis_dir, project_analysis_sl_dir)
         try:
             project_obj = projects_to_analyze[project_dir]
         except KeyError:
@@ -274,15 +323,34 @@ def setup_analysis_directory_structure(fc_dir, projects_to_analyze,
                 LOG.debug("Skipping sample {}: not in specified samples "
                           "{}".format(sample_name, ", ".join(restrict_to_samples)))
                 continue
+            sample_dir = os.path.join(project_dir, sample_name)
+            sample_record = manifest and manifest.get_sample(project['project_dir'],
+                                                             sample['sample_dir'],
+                                                             sample.get('file_info', {}))
+            if sample_record and sample_record['project_id'] == project_id and \
+                    os.path.isdir(sample_dir):
+                LOG.debug("Sample {} is unchanged since the flowcell was last "
+                          "organized".format(sample_name))
+                sample_obj = project_obj.add_sample(name=sample_name, dirname=sample_name)
+                for fq_file, libprep_name in sorted(sample_record['libpreps'].items()):
+                    libprep_name = str(libprep_name)
+                    sample_obj.add_libprep(name=libprep_name, dirname=libprep_name).\
+                            add_seqrun(name=fc_full_id, dirname=fc_full_id).\
+                            add_fastq_files(fq_file)
+                continue
             LOG.info("Setting up sample {}".format(sample_name))
             # Create a directory for the sample if it doesn't already exist
-            sample_dir = os.path.join(project_dir, sample_name)
             if create_files: safe_makedir(sample_dir, 0o2770)
             # This will only create a new sample object if it doesn't already exist in the project
             sample_obj = project_obj.add_sample(name=sample_name, dirname=sample_name)
+            # fastq file -> libprep name, for the manifest
+            sample_libpreps = {}
+            sample_links = []
+            # Set if Charon could not be asked for the sample's libpreps
+            charon_failure = None
             # Get the Library Prep ID for each file
-            pattern = re.compile(".*\.(fastq|fq)(\.gz|\.gzip|\.bz2)?$")
-            fastq_files = filter(pattern.match, sample.get('files', []))
+            fastq_files = [fq_file for fq_file in sample.get('files', [])
+                           if fastq_stem(fq_file) is not None]
             # For each fastq file, create the libprep and seqrun objects
             # and add the fastq file to the seqprep object
             # Note again that these objects only get created if they don't yet exist;
@@ -291,7 +359,7 @@ def setup_analysis_directory_structure(fc_dir, projects_to_analyze,
                 # Try to parse from SampleSheet
                 try:
                     if not samplesheet_path: raise ValueError()
-                    lane_num = re.match(r'[\w-]+_L\d{2}(\d)_\w+', fq_file).groups()[0]
+                    lane_num = parse_lane_from_filename(fq_file)
                     libprep_name = determine_library_prep_from_samplesheet(samplesheet_path,
                                                                            project_original_name,
                                                                            sample_name,
@@ -299,60 +367,49 @@ def setup_analysis_directory_structure(fc_dir, projects_to_analyze,
                 except (IndexError, ValueError) as e:
                     LOG.debug('Unable to determine library prep from sample sheet file '
                               '("{}"); try to determine from Charon'.format(e))
-                    try:
-                        # Requires Charon access
-                        libprep_name = determine_library_prep_from_fcid(project_id, sample_name, fc_full_id)
-                        LOG.debug('Found libprep name "{}" in Charon'.format(libprep_name))
-                    except ValueError:
-                        charon_session = CharonSession()
-                        libpreps = charon_session.sample_get_libpreps(project_id, sample_name).get('libpreps')
-                        if len(libpreps) == 1:
-                            libprep_name = libpreps[0].get('libprepid')
-                            LOG.warn('Project "{}" / sample "{}" / seqrun "{}" / fastq "{}" '
-                                     'has no libprep information in Charon, but only one '
-                                     'library prep is present in Charon ("{}"). Using '
-                                     'this as the library prep.'.format(project_name,
-                                                                        sample_name,
-                                                                        fc_full_id,
-                                                                        fq_file,
-                                                                        libprep_name))
-                        elif fallback_libprep:
-                            libprep_name = fallback_libprep
-                            LOG.warn('Project "{}" / sample "{}" / seqrun "{}" / fastq "{}" '
-                                     'has no libprep information in Charon, but a fallback '
-                                     'libprep value of "{}" was supplied -- using this '
-                                     'value.'.format(project_name,
-                                                     sample_name,
-                                                     fc_full_id,
-                                                     fq_file,
-                                                     libprep_name,
-                                                     fallback_libprep))
-                        else:
-                            error_text = ('Project "{}" / sample "{}" / seqrun "{}" / fastq "{}" '
-                                          'has no libprep information in Charon. Skipping '
-                                          'analysis.'.format(project_name, sample_name,
-                                                             fc_full_id, fq_file))
+                    # Requires Charon access; done once for all the sample's fastq files
+                    charon_key = (project_id, sample_name, fc_full_id)
+                    if charon_failure is not None:
+                        continue
+                    if charon_key not in charon_libpreps:
+                        try:
+                            charon_libpreps[charon_key] = \
+                                    _determine_library_prep_from_charon(project_id, project_name,
+                                                                        sample_name, fc_full_id,
+                                                                        fallback_libprep, quiet,
+                                                                        config)
+                        except CharonError as e:
+                            # Not recorded, so the sample is set up again next time
+                            charon_failure = e
+                            sample_links = None
+                            error_text = ('Could not get the library preps of project "{}" / '
+                                          'sample "{}" from Charon: {}. Skipping its fastq '
+                                          'files without a libprep in the SampleSheet for '
+                                          'seqrun "{}".'.format(project_name, sample_name, e,
+                                                                fc_full_id))
                             LOG.error(error_text)
-                            if not config.get('quiet'):
+                            if not quiet:
                                 mail_analysis(project_name=project_name,
                                               sample_name=sample_name,
                                               level="ERROR",
                                               info_text=error_text)
                             continue
+                    libprep_name = charon_libpreps[charon_key]
+                    if not libprep_name:
+                        sample_links = None
+                        continue
+                sample_libpreps[fq_file] = libprep_name
                 libprep_object = sample_obj.add_libprep(name=libprep_name,
                                                         dirname=libprep_name)
-                libprep_dir = os.path.join(sample_dir, libprep_name)
-                if create_files: safe_makedir(libprep_dir, 0o2770)
                 seqrun_object = libprep_object.add_seqrun(name=fc_full_id,
                                                           dirname=fc_full_id)
-                seqrun_dir = os.path.join(libprep_dir, fc_full_id)
-                if create_files: safe_makedir(seqrun_dir, 0o2770)
                 seqrun_object.add_fastq_files(fq_file)
             if fastq_files and create_files:
                 src_sample_dir = os.path.join(fc_dir_structure['fc_dir'],
                                               project['data_dir'],
                                               project['project_dir'],
                                               sample['sample_dir'])
+                seqrun_dst_dirs = []
                 for libprep_obj in sample_obj:
                     for seqrun_obj in libprep_obj:
                         src_fastq_files = [os.path.join(src_sample_dir, fastq_file) for
@@ -360,30 +417,121 @@ def setup_analysis_directory_structure(fc_dir, projects_to_analyze,
                         seqrun_dst_dir = os.path.join(project_obj.base_path, "DATA", project_obj.dirname,
                                                       sample_obj.dirname, libprep_obj.dirname,
                                                       seqrun_obj.dirname)
-                        LOG.info("Symlinking fastq files from {} to {}...".format(src_sample_dir, seqrun_dst_dir))
-                        try:
-                            do_symlink(src_fastq_files, seqrun_dst_dir)
-                        except OSError:
-                            error_text = ('Could not symlink files for project/sample'
-                                          'libprep/seqrun {}/{}/{}/{}'.format(project_obj,
-                                                                              sample_obj,
-                                                                              libprep_obj,
-                                                                              seqrun_obj))
-                            LOG.error(error_text)
-                            if not config.get('quiet'):
-                                mail_analysis(project_name=project_name,
-                                              sample_name=sample_name,
-                                              level="ERROR",
-                                              info_text=error_text)
-                            continue
+                        LOG.debug("Planning symlinks to fastq files from {} in {}".format(src_sample_dir, seqrun_dst_dir))
+                        link_plan.add(src_fastq_files, seqrun_dst_dir)
+                        seqrun_dst_dirs.append((seqrun_dst_dir, libprep_obj, seqrun_obj))
+                        if sample_links is not None:
+                            sample_links.extend(os.path.join(seqrun_dst_dir, fastq_file)
+                                                for fastq_file in seqrun_obj.fastq_files)
+                linked_samples.append((project, sample, project_id, project_obj, sample_obj,
+                                       sample_libpreps, sample_links, seqrun_dst_dirs))
+    if link_plan:
+        # Make all the symlinks of the flowcell at once
+        LOG.info("Symlinking {} fastq files from flowcell {}...".format(len(link_plan), fc_full_id))
+        link_errors = link_plan.execute()
+        LOG.info("Symlinked {} fastq files ({} already present)".format(link_plan.num_created,
+                                                                      link_plan.num_existing))
+        for (project, sample, project_id, project_obj, sample_obj, sample_libpreps,
+             sample_links, seqrun_dst_dirs) in linked_samples:
+            for seqrun_dst_dir, libprep_obj, seqrun_obj in seqrun_dst_dirs:
+                if seqrun_dst_dir not in link_errors:
+                    continue
+                sample_links = None
+                error_text = ('Could not symlink files for project/sample'
+                              'libprep/seqrun {}/{}/{}/{}: {}'.format(project_obj,
+                                                                      sample_obj,
+                                                                      libprep_obj,
+                                                                      seqrun_obj,
+                                                                      link_errors[seqrun_dst_dir]))
+                LOG.error(error_text)
+                if not quiet:
+                    mail_analysis(project_name=project_obj.name,
+                                  sample_name=sample_obj.name,
+                                  level="ERROR",
+                                  info_text=error_text)
+            # Only samples that were organized completely are recorded
+            if sample_links is not None:
+                manifest.set_sample(project['project_dir'], sample['sample_dir'],
+                                    sample.get('file_info', {}), sample_obj.name, project_id,
+                                    sample_libpreps, sample_links)
+    if manifest:
+        if manifest.num_reused:
+            LOG.info("{} sample(s) of flowcell {} were unchanged since it was last "
+                     "organized".format(manifest.num_reused, fc_full_id))
+        try:
+            manifest.save()
+        except (IOError, OSError) as e:
+            LOG.warn('Could not write the flowcell manifest "{}": {}'.format(manifest.path, e))
     return projects_to_analyze
 
 
+def _determine_library_prep_from_charon(project_id, project_name, sample_name, fc_full_id,
+                                        fallback_libprep=None, quiet=False, config=None):
+    """Find the library prep of a sample sequenced on a flowcell from its
+    libpreps and seqruns in Charon, using its only libprep or the fallback
+    libprep if the flowcell is not among its seqruns.
+
+    :returns: The library prep name, or None if it cannot be determined
+    :rtype: str
+    :raises CharonError: If Charon fails other than by not knowing the sample
+    """
+    try:
+        libprep_seqruns = get_sample_libprep_seqruns(project_id, sample_name)
+    except CharonError as e:
+        if e.status_code != 404:
+            raise
+        LOG.debug('Could not get library preps for project "{}" / sample "{}" '
+                  'from Charon: {}'.format(project_id, sample_name, e))
+        libprep_seqruns = {}
+    try:
+        libprep_name = determine_library_prep_from_fcid(project_id, sample_name, fc_full_id,
+                                                        libprep_seqruns)
+        LOG.debug('Found libprep name "{}" in Charon'.format(libprep_name))
+        return libprep_name
+    except ValueError as e:
+        if any(fc_full_id in seqrun_ids for seqrun_ids in libprep_seqruns.values()):
+            # More than one libprep on this flowcell; neither guess is safe
+            error_text = '{}. Skipping analysis.'.format(e)
+        elif len(libprep_seqruns) == 1:
+            libprep_name = libprep_seqruns.keys()[0]
+            LOG.warn('Project "{}" / sample "{}" / seqrun "{}" '
+                     'has no libprep information in Charon, but only one '
+                     'library prep is present in Charon ("{}"). Using '
+                     'this as the library prep.'.format(project_name,
+                                                        sample_name,
+                                                        fc_full_id,
+                                                        libprep_name))
+            return libprep_name
+        elif fallback_libprep:
+            LOG.warn('Project "{}" / sample "{}" / seqrun "{}" '
+                     'has no libprep information in Charon, but a fallback '
+                     'libprep value of "{}" was supplied -- using this '
+                     'value.'.format(project_name,
+                                     sample_name,
+                                     fc_full_id,
+                                     fallback_libprep))
+            return fallback_libprep
+        else:
+            error_text = ('Project "{}" / sample "{}" / seqrun "{}" '
+                          'has no libprep information in Charon. Skipping '
+                          'analysis.'.format(project_name, sample_name, fc_full_id))
+    LOG.error(error_text)
+    if not quiet:
+        mail_analysis(project_name=project_name,
+                      sample_name=sample_name,
+                      level="ERROR",
+                      info_text=error_text)
+    return None
+
+
 def parse_flowcell(fc_dir):
     """
     Traverse a CASAVA-1.8 or 2.5 generated directory structure for the HiSeq 2500
     and return a dictionary of the elements it contains.
 
+    Each directory is read once; the size and modification time of each fastq
+    file are included so that later steps need not stat them again.
+
     :param str fc_dir: The directory created by CASAVA for this flowcell.
 
     :returns: A dict of information about the flowcell, including project/sample info
@@ -397,48 +545,63 @@ def parse_flowcell(fc_dir):
     if not os.access(fc_dir, os.R_OK): os_msg = "could not be read (permission denied)"
     if locals().get('os_msg'): raise OSError("Error with flowcell dir {}: directory {}".format(fc_dir, os_msg))
     LOG.info('Parsing flowcell directory "{}"...'.format(fc_dir))
-    samplesheet_path = os.path.join(fc_dir, "SampleSheet.csv")
-    if not os.path.exists(samplesheet_path):
+    fc_entries = dict((entry.name, entry) for entry in list_dir_entries(fc_dir))
+    if "SampleSheet.csv" not in fc_entries:
         LOG.warn("Could not find samplesheet in directory {}".format(fc_dir))
         samplesheet_path = None
     else:
+        samplesheet_path = fc_entries["SampleSheet.csv"].path
         LOG.debug("SampleSheet.csv found at {}".format(samplesheet_path))
     fc_full_id = os.path.basename(fc_dir)
-    c2_5_path = os.path.join(fc_dir, "Demultiplexing")
-    c1_8_path = os.path.join(fc_dir, "Unaligned*")
-    if os.path.exists(c2_5_path):
-        data_dir = c2_5_path
+    if "Demultiplexing" in fc_entries:
+        data_dirs = [fc_entries["Demultiplexing"]]
     else:
-        data_dir = c1_8_path
-    for project_dir in glob.glob(os.path.join(data_dir, "*")):
-        path, base_dir = os.path.split(project_dir)
-        if not base_dir: path, base_dir = os.path.split(path)
-        project_original_name = os.path.basename(base_dir).replace('Project_', '')
+        data_dirs = [entry for name, entry in sorted(fc_entries.items())
+                     if fnmatch.fnmatch(name, "Unaligned*")]
+    project_entries = [project_entry for data_dir in data_dirs
+                       for project_entry in list_dir_entries(data_dir.path)]
+    for project_entry in project_entries:
+        project_dir = project_entry.path
+        project_original_name = project_entry.name.replace('Project_', '')
         project_name = project_original_name.replace('__', '.')
-        if not (os.path.isdir(project_dir) and \
-                (UPPSALA_PROJECT_RE.match(project_name) or \
-                   STHLM_PROJECT_RE.match(project_name))):
+        if not ((UPPSALA_PROJECT_RE.match(project_name) or \
+                    STHLM_PROJECT_RE.match(project_name)) and \
+                project_entry.is_dir()):
             continue
         LOG.info('Parsing project directory "{}"...'.format(
                             project_dir.split(os.path.split(fc_dir)[0] + "/")[1]))
         project_samples = []
-        sample_dir_pattern = os.path.join(project_dir, "*")
         if STHLM_X_PROJECT_RE.match(project_name):
             project_name = project_name.replace('_', '.', 1)
-        for sample_dir in glob.glob(sample_dir_pattern):
+        for sample_entry in list_dir_entries(project_dir):
+            if not sample_entry.is_dir():
+                continue
+            sample_dir = sample_entry.path
             LOG.info('Parsing samples directory "{}"...'.format(sample_dir.split(
                                                 os.path.split(fc_dir)[0] + "/")[1]))
-            sample_name = os.path.basename(sample_dir).replace('Sample_', '')
-            fastq_file_pattern = os.path.join(sample_dir, "*.fastq.gz")
-            fastq_files = [os.path.basename(fq) for fq in glob.glob(fastq_file_pattern)]
-            project_samples.append({'sample_dir': os.path.basename(sample_dir),
+            sample_name = sample_entry.name.replace('Sample_', '')
+            fastq_files = []
+            file_info = {}
+            for fastq_entry in list_dir_entries(sample_dir, "*.fastq.gz"):
+                try:
+                    fastq_stat = fastq_entry.stat()
+                except OSError as e:
+                    # e.g. a dangling symlink
+                    LOG.warn('Could not stat fastq file "{}": {}'.format(fastq_entry.path, e))
+                    fastq_stat = None
+                fastq_files.append(fastq_entry.name)
+                file_info[fastq_entry.name] = {
+                        'size': fastq_stat.st_size if fastq_stat else None,
+                        'mtime': fastq_stat.st_mtime if fastq_stat else None}
+            project_samples.append({'sample_dir': sample_entry.name,
                                     'sample_name': sample_name,
-                                    'files': fastq_files})
+                                    'files': fastq_files,
+                                    'file_info': file_info})
         if not project_samples:
             LOG.warn('No samples found for project "{}" in fc "{}"'.format(project_name, fc_dir))
         else:
             projects.append({'data_dir': os.path.relpath(os.path.dirname(project_dir), fc_dir),
-                             'project_dir': os.path.basename(project_dir),
+                             'project_dir': project_entry.name,
                              'project_name': project_name,
                              'project_original_name': project_original_name,
                              'samples': project_samples})
@@ -0,0 +1,128 @@
+"""A record of how a flowcell was organized into the analysis directory tree.
+
+After a flowcell has been set up (see flowcell.setup_analysis_directory_structure),
+its manifest under <analysis top dir>/flowcell_manifests/ holds, for each
+sample directory, the fastq files found with their sizes and mtimes, the
+library prep each was assigned and the symlinks made, as well as the Charon
+project id of each project. When the flowcell is organized again, samples
+whose fastq files are unchanged are rebuilt from the manifest instead of
+going through Charon and the filesystem again.
+
+Only samples whose every fastq file got a library prep and a symlink are
+recorded, so samples that failed are retried on the next run; a record is
+also not reused if any of its symlinks has since gone missing or broken. Delete the
+manifest to have the whole flowcell organized from scratch.
+"""
+import json
+import os
+
+from ngi_pipeline.log.loggers import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+MANIFEST_DIR_NAME = "flowcell_manifests"
+
+
+def get_manifest_path(analysis_top_dir, fc_full_id):
+    """The path to the manifest of a flowcell.
+
+    :param str analysis_top_dir: The analysis top directory of the flowcell
+    :param str fc_full_id: The full flowcell id (e.g. 140704_D00123_0321_BC423WACXX)
+
+    :rtype: str
+    """
+    return os.path.join(analysis_top_dir, MANIFEST_DIR_NAME, "{}.json".format(fc_full_id))
+
+
+class FlowcellManifest(object):
+    VERSION = 1
+
+    def __init__(self, path, fc_dir):
+        """Load the manifest at path, if there is one for this flowcell directory.
+
+        :param str path: The path to the manifest file
+        :param str fc_dir: The path to the flowcell directory
+        """
+        self.path = path
+        self.fc_dir = fc_dir
+        self.project_ids = {}
+        self.samples = {}
+        self.num_reused = 0
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except IOError:
+            return
+        except ValueError as e:
+            LOG.warn('Ignoring unreadable flowcell manifest "{}": {}'.format(path, e))
+            return
+        if manifest.get("version") != self.VERSION or manifest.get("fc_dir") != fc_dir:
+            LOG.info('Ignoring flowcell manifest "{}" written for another flowcell '
+                     'directory or version'.format(path))
+            return
+        self.project_ids = manifest.get("project_ids", {})
+        self.samples = manifest.get("samples", {})
+
+    def __repr__(self):
+        return "<FlowcellManifest {} ({} samples)>".format(self.path, len(self.samples))
+
+    @staticmethod
+    def _files_key(file_info):
+        return {fastq: [info['size'], info['mtime']] for fastq, info in file_info.items()}
+
+    @staticmethod
+    def _links_present(links):
+        """Whether all the symlinks still resolve to files; a name that is
+        listed but is a broken symlink does not count."""
+        return all(os.path.isfile(link) for link in links)
+
+    def get_sample(self, project_dir, sample_dir, file_info):
+        """The record of a sample directory, if its fastq files are unchanged
+        and the symlinks made to them are all still there.
+
+        :param str project_dir: The project directory name in the flowcell
+        :param str sample_dir: The sample directory name in the project directory
+        :param dict file_info: The fastq files with sizes and mtimes, from parse_flowcell
+
+        :returns: The record, with "sample_name", "project_id", "libpreps"
+                  (fastq name -> libprep) and "links", or None
+        :rtype: dict
+        """
+        record = self.samples.get("{}/{}".format(project_dir, sample_dir))
+        if record and record["files"] == self._files_key(file_info) and \
+                self._links_present(record["links"]):
+            self.num_reused += 1
+            return record
+        return None
+
+    def set_sample(self, project_dir, sample_dir, file_info, sample_name, project_id,
+                   libpreps, links):
+        """Record how a sample directory was organized.
+
+        :param str project_dir: The project directory name in the flowcell
+        :param str sample_dir: The sample directory name in the project directory
+        :param dict file_info: The fastq files with sizes and mtimes, from parse_flowcell
+        :param str sample_name: The sample name
+        :param str project_id: The project id
+        :param dict libpreps: The library prep of each fastq file
+        :param list links: The paths of the symlinks to the fastq files
+        """
+        self.samples["{}/{}".format(project_dir, sample_dir)] = {
+                "files": self._files_key(file_info),
+                "sample_name": sample_name,
+                "project_id": project_id,
+                "libpreps": libpreps,
+                "links": sorted(links)}
+
+    def save(self):
+        """Write the manifest, replacing the previous one atomically."""
+        manifest_dir = os.path.dirname(self.path)
+        if not os.path.exists(manifest_dir):
+            os.makedirs(manifest_dir)
+        tmp_path = "{}.tmp{}".format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({"version": self.VERSION,
+                       "fc_dir": self.fc_dir,
+                       "project_ids": self.project_ids,
+                       "samples": self.samples}, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.path)
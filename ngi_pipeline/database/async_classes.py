@@ -0,0 +1,196 @@
+"""A non-blocking Charon client for code that needs to make many lookups at
+once. Requests are made on a tornado IOLoop, so hundreds of them can be in
+flight together (bounded by charon.max_concurrent_requests), and responses are
+checked with the same rules as CharonSession's validate_response.
+
+From synchronous code, run a coroutine with e.g.
+
+    IOLoop().run_sync(lambda: AsyncCharonSession().project_get_tree("P1234"))
+"""
+import collections
+import json
+import re
+import time
+
+from ngi_pipeline.database.classes import CharonProjectTree, raise_for_charon_status
+from ngi_pipeline.database.instrumentation import CHARON_STATS
+from ngi_pipeline.database.utils import load_charon_transport_settings, \
+                                       load_charon_variables
+from ngi_pipeline.log.loggers import minimal_logger
+from tornado import gen, locks
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+LOG = minimal_logger(__name__)
+
+# tornado reports timeouts and connection failures with this pseudo status code
+TORNADO_CONNECTION_FAILURE_CODE = 599
+
+CharonResponseSummary = collections.namedtuple('CharonResponseSummary',
+                                               ['status_code', 'reason', 'url'])
+
+
+class AsyncCharonSession(object):
+    """Coroutine versions of the CharonSession read methods. Each method
+    returns a Future resolving to the same data the CharonSession method
+    returns, or raising the same CharonError.
+
+    Instances are bound to the IOLoop they are first used on; create one per
+    IOLoop.
+    """
+    def __init__(self, config=None, config_file_path=None, max_concurrent_requests=None):
+        _charon_vars_dict = load_charon_variables(config=config,
+                                                  config_file_path=config_file_path)
+        try:
+            self._api_token_dict = {'X-Charon-API-token': _charon_vars_dict['charon_api_token']}
+            # Remove trailing slashes
+            m = re.match(r'(?P<url>.*\w+)/*', _charon_vars_dict['charon_base_url'])
+            self._base_url = m.groups()[0] if m else _charon_vars_dict['charon_base_url']
+        except KeyError as e:
+            raise ValueError('Unable to load needed Charon variable: {}'.format(e))
+        self._transport_settings = load_charon_transport_settings(config=config,
+                                                                  config_file_path=config_file_path)
+        self._timeouts = self._transport_settings['timeout']
+        self.max_concurrent_requests = int(max_concurrent_requests or
+                                           self._transport_settings['max_concurrent_requests'])
+        self._semaphore = locks.Semaphore(self.max_concurrent_requests)
+        # Concurrency is bounded by the semaphore: requests waiting in tornado's
+        # own queue would count the wait against their timeout
+        self._client = AsyncHTTPClient(force_instance=True,
+                                       max_clients=self.max_concurrent_requests)
+
+    def construct_charon_url(self, *args):
+        """Build a Charon URL, appending any *args passed."""
+        return "{}/api/v1/{}".format(self._base_url,'/'.join([str(a) for a in args]))
+
+    def reset_base_url(self, charon_url):
+        LOG.info('Resetting Charon base URL from "{}" to "{}"'.format(self._base_url,
+                                                                      charon_url))
+        self._base_url = charon_url
+
+    def close(self):
+        self._client.close()
+
+    @gen.coroutine
+    def request(self, method, url, data=None):
+        """Make one request, retrying GET and PUT as CharonSession does.
+
+        :param str method: The HTTP verb
+        :param str url: The full URL
+        :param str data: The request body (optional)
+
+        :returns: The response
+        :rtype: tornado.httpclient.HTTPResponse
+        :raises CharonError: If the request fails
+        """
+        # Found now, while the calling coroutine is still on the stack
+        caller = CHARON_STATS.current_caller()
+        start_time = time.time()
+        connect_timeout, read_timeout = self._timeouts[method.lower()]
+        retries_left = int(self._transport_settings['max_retries']) \
+                       if method in ('GET', 'PUT') else 0
+        retry_codes = set(self._transport_settings['retry_status_codes'])
+        retry_codes.add(TORNADO_CONNECTION_FAILURE_CODE)
+        num_retries = 0
+        while True:
+            http_request = HTTPRequest(url, method=method, headers=self._api_token_dict,
+                                       body=data, connect_timeout=connect_timeout,
+                                       request_timeout=connect_timeout + read_timeout)
+            with (yield self._semaphore.acquire()):
+                response = yield self._client.fetch(http_request, raise_error=False)
+            if response.code in retry_codes and retries_left > 0:
+                retries_left -= 1
+                num_retries += 1
+                # Same schedule as urllib3's Retry: no wait before the first retry
+                backoff = float(self._transport_settings['retry_backoff_factor']) * \
+                          (2 ** (num_retries - 1)) if num_retries > 1 else 0
+                LOG.debug('Retrying {} {} in {}s (code {})'.format(method, url, backoff,
+                                                                   response.code))
+                yield gen.sleep(backoff)
+                continue
+            response_summary = _summarize_response(response)
+            CHARON_STATS.record(method, url, response_summary.status_code,
+                                time.time() - start_time,
+                                bytes_sent=len(data or ""),
+                                bytes_received=len(response.body or ""),
+                                caller=caller)
+            raise_for_charon_status(response_summary)
+            raise gen.Return(response)
+
+    @gen.coroutine
+    def get_json(self, url):
+        response = yield self.request('GET', url)
+        raise gen.Return(json.loads(response.body))
+
+    # Project
+    def project_get(self, projectid):
+        return self.get_json(self.construct_charon_url('project', projectid))
+
+    def project_get_samples(self, projectid):
+        return self.get_json(self.construct_charon_url('samples', projectid))
+
+    def projects_get_all(self):
+        return self.get_json(self.construct_charon_url('projects'))
+
+    @gen.coroutine
+    def project_get_tree(self, projectid, restrict_to_samples=None,
+                         restrict_to_libpreps=None):
+        """As CharonSession.project_get_tree; all the requests for a level of
+        the hierarchy are made at once.
+
+        :returns: The indexed project hierarchy
+        :rtype: CharonProjectTree
+        :raises CharonError: If any of the requests fail
+        """
+        project_doc, samples = yield [self.project_get(projectid),
+                                      self.project_get_samples(projectid)]
+        tree = CharonProjectTree(project_doc)
+        tree.add_samples(samples.get('samples', []), restrict_to_samples)
+        sample_ids = list(tree.samples.keys())
+        libpreps_list = yield [self.sample_get_libpreps(projectid, sample_id)
+                               for sample_id in sample_ids]
+        for sample_id, libpreps in zip(sample_ids, libpreps_list):
+            for libprep in libpreps.get('libpreps', []):
+                tree.add_libprep(sample_id, libprep)
+        libprep_keys = tree.libprep_keys(restrict_to_libpreps)
+        seqruns_list = yield [self.libprep_get_seqruns(projectid, sample_id, libprep_id)
+                              for sample_id, libprep_id in libprep_keys]
+        for (sample_id, libprep_id), seqruns in zip(libprep_keys, seqruns_list):
+            for seqrun in seqruns.get('seqruns', []):
+                tree.add_seqrun(sample_id, libprep_id, seqrun)
+        raise gen.Return(tree)
+
+    # Sample
+    def sample_get(self, projectid, sampleid):
+        return self.get_json(self.construct_charon_url("sample", projectid, sampleid))
+
+    def sample_get_libpreps(self, projectid, sampleid):
+        return self.get_json(self.construct_charon_url('libpreps', projectid, sampleid))
+
+    def sample_get_projects(self, sampleid):
+        return self.get_json(self.construct_charon_url('projectidsfromsampleid', sampleid))
+
+    # LibPrep
+    def libprep_get(self, projectid, sampleid, libprepid):
+        return self.get_json(self.construct_charon_url("libprep", projectid, sampleid,
+                                                       libprepid))
+
+    def libprep_get_seqruns(self, projectid, sampleid, libprepid):
+        return self.get_json(self.construct_charon_url('seqruns', projectid, sampleid,
+                                                       libprepid))
+
+    # SeqRun
+    def seqrun_get(self, projectid, sampleid, libprepid, seqrunid):
+        return self.get_json(self.construct_charon_url("seqrun", projectid, sampleid,
+                                                       libprepid, seqrunid))
+
+
+def _summarize_response(response):
+    """Translate a tornado response into what raise_for_charon_status expects,
+    mapping tornado's timeouts to 408 and connection failures to 503 as
+    validate_response does for requests."""
+    status_code = response.code
+    reason = response.reason
+    if status_code == TORNADO_CONNECTION_FAILURE_CODE:
+        reason = str(response.error)
+        status_code = 408 if "timeout" in reason.lower() else 503
+    return CharonResponseSummary(status_code, reason, response.effective_url)
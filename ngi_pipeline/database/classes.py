@@ -1,14 +1,27 @@
 from __future__ import print_function
 
+import collections
 import functools
 import json
 import os
 import re
 import requests
-
-from ngi_pipeline.database.utils import load_charon_variables
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from ngi_pipeline.database.instrumentation import CHARON_STATS, register_exit_report
+from ngi_pipeline.database.response_cache import CharonResponseCache
+from ngi_pipeline.database.utils import load_charon_instrumentation_settings, \
+                                       load_charon_transport_settings, \
+                                       load_charon_variables
 from ngi_pipeline.log.loggers import minimal_logger
-from requests.exceptions import Timeout
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+from requests.packages.urllib3.util.retry import Retry
 
 LOG = minimal_logger(__name__)
 
@@ -40,14 +53,48 @@ class CharonSession(requests.Session):
         except KeyError as e:
             raise ValueError('Unable to load needed Charon variable: {}'.format(e))
 
+        # One pooled, keep-alive adapter for all Charon traffic; only the
+        # idempotent GET and PUT are retried (with exponential backoff)
+        self._transport_settings = load_charon_transport_settings(config=config,
+                                                                  config_file_path=config_file_path)
+        self._timeouts = self._transport_settings['timeout']
+        adapter = HTTPAdapter(pool_connections=int(self._transport_settings['pool_connections']),
+                              pool_maxsize=int(self._transport_settings['pool_maxsize']),
+                              max_retries=build_charon_retry(self._transport_settings))
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
         self.get = validate_response(functools.partial(self.get,
-                    headers=self._api_token_dict, timeout=3))
+                    headers=self._api_token_dict, timeout=self._timeouts['get']), 'GET')
         self.post = validate_response(functools.partial(self.post,
-                    headers=self._api_token_dict, timeout=3))
+                    headers=self._api_token_dict, timeout=self._timeouts['post']), 'POST')
         self.put = validate_response(functools.partial(self.put,
-                    headers=self._api_token_dict, timeout=3))
+                    headers=self._api_token_dict, timeout=self._timeouts['put']), 'PUT')
         self.delete = validate_response(functools.partial(self.delete,
-                    headers=self._api_token_dict, timeout=3))
+                    headers=self._api_token_dict, timeout=self._timeouts['delete']), 'DELETE')
+        # Optionally serve repeated GETs from memory; writes drop what they make stale
+        self.response_cache = None
+        if self._transport_settings['cache_ttl']:
+            self.response_cache = CharonResponseCache(self._transport_settings['cache_ttl'],
+                                                      self._transport_settings['cache_max_entries'])
+            conditional_get = validate_response(functools.partial(requests.Session.get, self,
+                                timeout=self._timeouts['get']), 'GET',
+                                success_codes=CHARON_SUCCESS_CODES + (304,))
+            self.get = functools.partial(self.response_cache.get, conditional_get,
+                                         headers=self._api_token_dict)
+            self.post = _invalidating(self.post, self.response_cache, 'POST')
+            self.put = _invalidating(self.put, self.response_cache, 'PUT')
+            self.delete = _invalidating(self.delete, self.response_cache, 'DELETE')
+        # Other caches of Charon data (e.g. the local mirror) are told of every write
+        self._write_listeners = []
+        self.post = _notifying(self.post, self._write_listeners, 'POST')
+        self.put = _notifying(self.put, self._write_listeners, 'PUT')
+        self.delete = _notifying(self.delete, self._write_listeners, 'DELETE')
+        # Requests are always counted; report them at exit if configured
+        register_exit_report(**load_charon_instrumentation_settings(config=config,
+                                                                    config_file_path=config_file_path))
+        # Open update batches are per-thread; see batch_updates()
+        self._batch_state = threading.local()
 
         self._project_params = ('projectid', 'name', 'status', 'best_practice_analysis',
                                 'sequencing_facility', 'delivery_status', 'delivery_token')
@@ -75,6 +122,108 @@ class CharonSession(requests.Session):
         return "{}/api/v1/{}".format(self._base_url,'/'.join([str(a) for a in args]))
 
 
+    def map_concurrently(self, function, items, max_workers=None,
+                         return_exceptions=False):
+        """Call function on each item using a bounded pool of threads, which
+        share this session's connection pool.
+
+        :param function function: The function to call with each item
+        :param list items: The arguments to call the function with
+        :param int max_workers: The maximum number of concurrent calls (optional)
+        :param bool return_exceptions: Return CharonErrors in place of results
+                                       instead of raising the first one
+
+        :returns: The results, in the same order as the items
+        :rtype: list
+        """
+        items = list(items)
+        if return_exceptions:
+            function = _return_charon_errors(function)
+        function = _attributed_to(function, CHARON_STATS.current_caller())
+        max_workers = min(len(items), int(max_workers or
+                          self._transport_settings['max_concurrent_requests']))
+        if max_workers <= 1:
+            return [function(item) for item in items]
+        pool = ThreadPool(max_workers)
+        try:
+            return pool.map(function, items)
+        finally:
+            pool.close()
+
+    @contextmanager
+    def batch_updates(self, max_workers=None, journal=None):
+        """Buffer the *_update calls made in this thread within the block and
+        send them when it exits: all updates to the same document are merged
+        into a single PUT, and the PUTs are sent concurrently. Nested blocks
+        join the outermost one, which does the flushing; code opening a nested
+        block reports its own failed updates through the batch's
+        add_failure_handler.
+
+        While a batch is open the *_update methods return None, and documents
+        read through this session in the same thread include the pending
+        updates. The updates are sent even if the block raises an exception.
+
+        If a journal is given, updates that cannot be sent because Charon is
+        unavailable are stored in it instead of raising, as are updates to
+        documents that already have updates waiting in the journal. After the
+        block, the batch's unavailable_error is set if any were journaled
+        because Charon was unavailable, and its flush_error if any failed
+        (which is only logged if the block raised, as that exception is the
+        one that propagates).
+
+        :param int max_workers: The maximum number of concurrent PUTs (optional)
+        :param CharonJournal journal: Where to keep undeliverable updates (optional)
+
+        :returns: The open batch
+        :rtype: CharonUpdateBatch
+        :raises CharonBatchError: After all documents are attempted, if any update failed
+        """
+        current_batch = self.current_batch()
+        if current_batch is not None:
+            yield current_batch
+            return
+        batch = self._batch_state.batch = CharonUpdateBatch(self)
+        try:
+            yield batch
+        except Exception:
+            exc_info = sys.exc_info()
+            self._batch_state.batch = None
+            try:
+                batch.flush(max_workers=max_workers, journal=journal)
+            except CharonBatchError as e:
+                LOG.error(e)
+            # A bare raise would re-raise the CharonBatchError just handled
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._batch_state.batch = None
+        batch.flush(max_workers=max_workers, journal=journal)
+
+    def add_write_listener(self, listener):
+        """Call listener(method, url) after every POST, PUT and DELETE this
+        session sends, whether it succeeded or not.
+
+        :param function listener: The function to call
+        """
+        if listener not in self._write_listeners:
+            self._write_listeners.append(listener)
+
+    def current_batch(self):
+        """Return the update batch open in this thread, or None."""
+        return getattr(self._batch_state, 'batch', None)
+
+    def _apply_pending_updates(self, url, document):
+        """Reads made inside a batch see the batch's not yet sent updates."""
+        batch = self.current_batch()
+        if batch is not None and url in batch.documents:
+            document.update(batch.documents[url][1])
+        return document
+
+    def _update_document(self, url, data, label):
+        batch = self.current_batch()
+        if batch is not None:
+            batch.add(url, data, label)
+            return None
+        return self.put(url, json.dumps(data)).text
+
     def reset_base_url(self, charon_url):
         LOG.info('Resetting Charon base URL from "{}" to "{}"'.format(self._base_url,
                                                                       charon_url))
@@ -89,18 +238,73 @@ class CharonSession(requests.Session):
                          data=json.dumps(data)).json()
 
     def project_get(self, projectid):
-        return self.get(self.construct_charon_url('project', projectid)).json()
+        url = self.construct_charon_url('project', projectid)
+        return self._apply_pending_updates(url, self.get(url).json())
 
 
     def project_get_samples(self, projectid):
         return self.get(self.construct_charon_url('samples', projectid)).json()
 
+    def project_get_tree(self, projectid, restrict_to_samples=None,
+                         restrict_to_libpreps=None, max_workers=None):
+        """Fetch the project document and all its samples, libpreps and seqruns
+        in one call. Each level of the hierarchy is fetched with concurrent
+        requests (at most max_workers at a time), so the number of sequential
+        round-trips is fixed regardless of the size of the project.
+
+        :param str projectid: The project id
+        :param list restrict_to_samples: Only fetch these samples (optional)
+        :param list restrict_to_libpreps: Only fetch seqruns for these libpreps (optional)
+        :param int max_workers: The maximum number of concurrent requests (optional)
+
+        :returns: The indexed project hierarchy
+        :rtype: CharonProjectTree
+        :raises CharonError: If any of the requests fail
+        """
+        project_doc, samples = self.map_concurrently(
+                lambda f: f(projectid), [self.project_get, self.project_get_samples],
+                max_workers=max_workers)
+        tree = CharonProjectTree(project_doc)
+        tree.add_samples(samples.get('samples', []), restrict_to_samples)
+        sample_ids = list(tree.samples.keys())
+        libpreps_list = self.map_concurrently(
+                lambda sample_id: self.sample_get_libpreps(projectid, sample_id),
+                sample_ids, max_workers=max_workers)
+        for sample_id, libpreps in zip(sample_ids, libpreps_list):
+            for libprep in libpreps.get('libpreps', []):
+                tree.add_libprep(sample_id, libprep)
+        return self._add_seqruns(projectid, tree, restrict_to_libpreps, max_workers)
+
+    def _add_seqruns(self, projectid, tree, restrict_to_libpreps=None, max_workers=None):
+        """Fetch the seqruns of the tree's libpreps, and apply the updates
+        pending in this thread's batch to everything in it."""
+        libprep_keys = tree.libprep_keys(restrict_to_libpreps)
+        seqruns_list = self.map_concurrently(
+                lambda key: self.libprep_get_seqruns(projectid, *key),
+                libprep_keys, max_workers=max_workers)
+        for (sample_id, libprep_id), seqruns in zip(libprep_keys, seqruns_list):
+            for seqrun in seqruns.get('seqruns', []):
+                tree.add_seqrun(sample_id, libprep_id, seqrun)
+        if self.current_batch() is not None:
+            for sample_id, sample in tree.samples.items():
+                self._apply_pending_updates(self.construct_charon_url('sample', projectid,
+                                                                      sample_id), sample)
+                for libprep_id, libprep in tree.libpreps[sample_id].items():
+                    self._apply_pending_updates(self.construct_charon_url('libprep', projectid,
+                                                                          sample_id, libprep_id),
+                                                libprep)
+            for sample_id, libprep_id, seqrun in tree.iter_seqruns():
+                self._apply_pending_updates(self.construct_charon_url('seqrun', projectid,
+                                                                      sample_id, libprep_id,
+                                                                      seqrun['seqrunid']), seqrun)
+        return tree
+
     def project_update(self, projectid, name=None, status=None, best_practice_analysis=None,
                        sequencing_facility=None, delivery_status=None, delivery_token=None):
         l_dict = locals()
         data = { k: l_dict.get(k) for k in self._project_params if l_dict.get(k)}
-        return self.put(self.construct_charon_url('project', projectid),
-                        data=json.dumps(data)).text
+        return self._update_document(self.construct_charon_url('project', projectid),
+                                     data, projectid)
 
     def projects_get_all(self):
         return self.get(self.construct_charon_url('projects')).json()
@@ -125,11 +329,33 @@ class CharonSession(requests.Session):
 
     def sample_get(self, projectid, sampleid):
         url = self.construct_charon_url("sample", projectid, sampleid)
-        return self.get(url).json()
+        return self._apply_pending_updates(url, self.get(url).json())
 
     def sample_get_libpreps(self, projectid, sampleid):
         return self.get(self.construct_charon_url('libpreps', projectid, sampleid)).json()
 
+    def sample_get_tree(self, projectid, sampleid, max_workers=None):
+        """Fetch a sample document and all its libpreps and seqruns, without
+        fetching the rest of the project. The project document of the tree
+        returned holds only the projectid.
+
+        :param str projectid: The project id
+        :param str sampleid: The sample id
+        :param int max_workers: The maximum number of concurrent requests (optional)
+
+        :returns: The indexed sample hierarchy
+        :rtype: CharonProjectTree
+        :raises CharonError: If any of the requests fail
+        """
+        sample_doc, libpreps = self.map_concurrently(
+                lambda f: f(projectid, sampleid), [self.sample_get, self.sample_get_libpreps],
+                max_workers=max_workers)
+        tree = CharonProjectTree({'projectid': projectid})
+        tree.add_sample(sample_doc)
+        for libprep in libpreps.get('libpreps', []):
+            tree.add_libprep(sampleid, libprep)
+        return self._add_seqruns(projectid, tree, max_workers=max_workers)
+
     def sample_get_projects(self, sampleid):
         return self.get(self.construct_charon_url('projectidsfromsampleid', sampleid)).json()
 
@@ -140,7 +366,7 @@ class CharonSession(requests.Session):
         url = self.construct_charon_url("sample", projectid, sampleid)
         l_dict = locals()
         data = { k: l_dict.get(k) for k in self._sample_params if l_dict.get(k)}
-        return self.put(url, json.dumps(data)).text
+        return self._update_document(url, data, "{}/{}".format(projectid, sampleid))
 
     def sample_reset(self, projectid, sampleid):
         url = self.construct_charon_url("sample", projectid, sampleid)
@@ -159,7 +385,7 @@ class CharonSession(requests.Session):
 
     def libprep_get(self, projectid, sampleid, libprepid):
         url = self.construct_charon_url("libprep", projectid, sampleid, libprepid)
-        return self.get(url).json()
+        return self._apply_pending_updates(url, self.get(url).json())
 
     def libprep_get_seqruns(self, projectid, sampleid, libprepid):
         return self.get(self.construct_charon_url('seqruns', projectid, sampleid, libprepid)).json()
@@ -168,7 +394,8 @@ class CharonSession(requests.Session):
         url = self.construct_charon_url("libprep", projectid, sampleid, libprepid)
         l_dict = locals()
         data = { k: l_dict.get(k) for k in self._libprep_params if l_dict.get(k)}
-        return self.put(url, json.dumps(data)).text
+        return self._update_document(url, data, "{}/{}/{}".format(projectid, sampleid,
+                                                                  libprepid))
 
     def libprep_reset(self, projectid, sampleid, libprepid):
         url = self.construct_charon_url("libprep", projectid, sampleid, libprepid)
@@ -190,7 +417,7 @@ class CharonSession(requests.Session):
 
     def seqrun_get(self, projectid, sampleid, libprepid, seqrunid):
         url = self.construct_charon_url("seqrun", projectid, sampleid, libprepid, seqrunid)
-        return self.get(url).json()
+        return self._apply_pending_updates(url, self.get(url).json())
 
     def seqrun_update(self, projectid, sampleid, libprepid, seqrunid,
                       lane_sequencing_status=None, alignment_status=None,
@@ -201,7 +428,8 @@ class CharonSession(requests.Session):
         url = self.construct_charon_url("seqrun", projectid, sampleid, libprepid, seqrunid)
         l_dict = locals()
         data = { k: str(l_dict.get(k)) for k in self._seqrun_params if l_dict.get(k)}
-        return self.put(url, json.dumps(data)).text
+        return self._update_document(url, data, "{}/{}/{}/{}".format(projectid, sampleid,
+                                                                     libprepid, seqrunid))
 
     def seqrun_reset(self, projectid, sampleid, libprepid, seqrunid):
         url = self.construct_charon_url("seqrun", projectid, sampleid, libprepid, seqrunid)
@@ -212,54 +440,339 @@ class CharonSession(requests.Session):
         return self.delete(self.construct_charon_url("seqrun", projectid, sampleid, libprepid, seqrunid))
 
 
+class CharonProjectTree(object):
+    """The Charon documents for a project and everything under it, indexed by id.
+
+    samples:  {sampleid: sample_doc}
+    libpreps: {sampleid: {libprepid: libprep_doc}}
+    seqruns:  {(sampleid, libprepid): {seqrunid: seqrun_doc}}
+
+    Insertion order from Charon is preserved at each level.
+    """
+    def __init__(self, project):
+        self.project = project
+        self.samples = collections.OrderedDict()
+        self.libpreps = {}
+        self.seqruns = {}
+
+    def __repr__(self):
+        return "<CharonProjectTree {} ({} samples)>".format(self.project.get('projectid'),
+                                                           len(self.samples))
+
+    def add_samples(self, samples, restrict_to_samples=None):
+        """Add the sample documents, keeping only restrict_to_samples if given.
+
+        :raises CharonError: If any of restrict_to_samples is not among the samples
+        """
+        if restrict_to_samples:
+            missing_samples = set(restrict_to_samples) - \
+                              set(sample['sampleid'] for sample in samples)
+            if missing_samples:
+                raise CharonError('Charon access failure: not found in database '
+                                  '(project "{}" has no sample(s) "{}")'.format(
+                                    self.project.get('projectid'),
+                                    '", "'.join(sorted(missing_samples))), 404)
+            samples = [sample for sample in samples
+                       if sample['sampleid'] in restrict_to_samples]
+        for sample in samples:
+            self.add_sample(sample)
+
+    def add_sample(self, sample):
+        self.samples[sample['sampleid']] = sample
+        self.libpreps.setdefault(sample['sampleid'], collections.OrderedDict())
+
+    def add_libprep(self, sampleid, libprep):
+        self.libpreps.setdefault(sampleid, collections.OrderedDict())[libprep['libprepid']] = libprep
+        self.seqruns.setdefault((sampleid, libprep['libprepid']), collections.OrderedDict())
+
+    def add_seqrun(self, sampleid, libprepid, seqrun):
+        self.seqruns.setdefault((sampleid, libprepid),
+                                collections.OrderedDict())[seqrun['seqrunid']] = seqrun
+
+    def libprep_keys(self, restrict_to_libpreps=None):
+        """Return [(sampleid, libprepid), ...] for all (or only the listed) libpreps."""
+        return [(sample_id, libprep_id) for sample_id in self.samples
+                for libprep_id in self.libpreps.get(sample_id, {})
+                if not restrict_to_libpreps or libprep_id in restrict_to_libpreps]
+
+    def get_libpreps(self, sampleid):
+        """Return the libprep documents for a sample as a list."""
+        return list(self.libpreps.get(sampleid, {}).values())
+
+    def get_seqruns(self, sampleid, libprepid):
+        """Return the seqrun documents for a libprep as a list."""
+        return list(self.seqruns.get((sampleid, libprepid), {}).values())
+
+    def iter_seqruns(self, sampleid=None):
+        """Yield (sampleid, libprepid, seqrun_doc) for all seqruns, or only
+        those of one sample."""
+        sample_ids = [sampleid] if sampleid else self.samples.keys()
+        for sample_id in sample_ids:
+            for libprep_id in self.libpreps.get(sample_id, {}):
+                for seqrun in self.get_seqruns(sample_id, libprep_id):
+                    yield sample_id, libprep_id, seqrun
+
+
+class CharonUpdateBatch(object):
+    """Updates buffered by CharonSession.batch_updates, merged per document."""
+    def __init__(self, charon_session):
+        self.charon_session = charon_session
+        # url -> (label, merged data dict), in order of first update
+        self.documents = collections.OrderedDict()
+        self.num_updates = 0
+        # [(labels, handler), ...], see add_failure_handler
+        self.failure_handlers = []
+        # The error that showed Charon to be unavailable at the last flush, if any
+        self.unavailable_error = None
+        # The CharonBatchError raised by the last flush, if any
+        self.flush_error = None
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, url, data, label):
+        """Merge data into the pending update for the document at url;
+        later values for the same field win."""
+        self.documents.setdefault(url, (label, {}))[1].update(data)
+        self.num_updates += 1
+
+    def add_failure_handler(self, labels, handler):
+        """Call handler(label, error) when the batch is flushed, for each
+        update whose label is in labels (checked then, so it may still grow)
+        that failed. Code opening a nested block reports its own failures this
+        way, since only the outermost block flushes.
+
+        :param labels: The labels of the updates to handle (a set, dict, ...)
+        :param function handler: The function to call
+        """
+        self.failure_handlers.append((labels, handler))
+
+    def flush(self, max_workers=None, journal=None):
+        """Send one PUT per document and clear the batch.
+
+        :param int max_workers: The maximum number of concurrent PUTs (optional)
+        :param CharonJournal journal: Where to keep undeliverable updates (optional)
+
+        :returns: The error that showed Charon to be unavailable, if updates were
+                  journaled because of it, otherwise None
+        :rtype: CharonError
+        :raises CharonBatchError: If any of the PUTs failed (and was not journaled),
+                                  after calling the failure handlers
+        """
+        documents = self.documents.items()
+        self.documents = collections.OrderedDict()
+        failure_handlers, self.failure_handlers = self.failure_handlers, []
+        self.unavailable_error = None
+        self.flush_error = None
+        if not documents:
+            return None
+        LOG.debug("Sending {} Charon update(s) as {} request(s)".format(self.num_updates,
+                                                                       len(documents)))
+        self.num_updates = 0
+        if journal is not None:
+            # Keep the order of updates to documents already waiting in the journal
+            queued = [(url, (label, data)) for url, (label, data) in documents
+                      if journal.has_pending(url)]
+            for url, (label, data) in queued:
+                journal.record(url, data, label=label)
+            documents = [document for document in documents if document not in queued]
+        put = lambda url_label_data: self.charon_session.put(url_label_data[0],
+                                                             json.dumps(url_label_data[1][1]))
+        results = self.charon_session.map_concurrently(put, documents,
+                                                       max_workers=max_workers,
+                                                       return_exceptions=True)
+        failures = collections.OrderedDict()
+        for (url, (label, data)), result in zip(documents, results):
+            if isinstance(result, CharonError):
+                if journal is not None and is_charon_unavailable(result):
+                    journal.record(url, data, label=label, error=result)
+                    self.unavailable_error = result
+                    continue
+                LOG.error('Charon update of "{}" failed: {}'.format(label, result))
+                failures[label] = result
+        if failures:
+            for labels, handler in failure_handlers:
+                for label, error in failures.items():
+                    if label in labels:
+                        handler(label, error)
+            self.flush_error = CharonBatchError(failures)
+            raise self.flush_error
+        return self.unavailable_error
+
+
+def _return_charon_errors(function):
+    """Wrap function so that it returns a CharonError instead of raising it."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        except CharonError as e:
+            return e
+    return wrapper
+
+
+def _attributed_to(function, caller):
+    """Wrap function so that the Charon requests it makes are attributed to
+    caller, whichever thread it runs in."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with CHARON_STATS.attributed_to(caller):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def _invalidating(function, response_cache, method):
+    """Wrap a write method so that it drops the cached responses it makes stale."""
+    def wrapper(url, *args, **kwargs):
+        try:
+            return function(url, *args, **kwargs)
+        finally:
+            response_cache.invalidate(method, url)
+    return wrapper
+
+
+def _notifying(function, listeners, method):
+    """Wrap a write method so that it calls each listener with the method and url."""
+    def wrapper(url, *args, **kwargs):
+        try:
+            return function(url, *args, **kwargs)
+        finally:
+            for listener in listeners:
+                listener(method, url)
+    return wrapper
+
+
+def build_charon_retry(transport_settings):
+    """Build the urllib3 Retry policy for Charon requests. Connection errors,
+    read timeouts and the configured server error codes are retried for GET and
+    PUT only; the final response is handed back to validate_response as usual.
+
+    :param dict transport_settings: As returned by load_charon_transport_settings
+
+    :returns: The retry policy
+    :rtype: Retry
+    """
+    retry_kwargs = dict(total=int(transport_settings['max_retries']),
+                        backoff_factor=float(transport_settings['retry_backoff_factor']),
+                        status_forcelist=frozenset(transport_settings['retry_status_codes']),
+                        raise_on_status=False)
+    retry_methods = frozenset(['GET', 'PUT'])
+    try:
+        return Retry(allowed_methods=retry_methods, **retry_kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=retry_methods, **retry_kwargs)
+
+
 class CharonError(Exception):
     def __init__(self, message, status_code=None, *args, **kwargs):
         self.status_code = status_code
         super(CharonError, self).__init__(message, *args, **kwargs)
 
 
+class CharonBatchError(CharonError):
+    """Raised when one or more documents in a batch of updates failed.
+
+    :attr dict failures: {document label (e.g. "P123/P123_456"): CharonError}
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        message = "Charon update failed for {} document(s): {}".format(
+                    len(failures), "; ".join("{}: {}".format(label, error)
+                                             for label, error in failures.items()))
+        status_codes = set(error.status_code for error in failures.values())
+        super(CharonBatchError, self).__init__(message,
+                status_code=(status_codes.pop() if len(status_codes) == 1 else None))
+
+
+CHARON_SUCCESS_CODES = (200, 201, 204)
+# Failures that say nothing about the request itself; it may succeed later
+CHARON_UNAVAILABLE_CODES = (408, 502, 503, 504)
+# There are certainly more failure codes I need to add here
+CHARON_FAILURE_CODES = {
+        400: (CharonError, ("Charon access failure: invalid input "
+                            "data (reason '{response.reason}' / "
+                            "code {response.status_code} / "
+                            "url '{response.url}')")),
+        404: (CharonError, ("Charon access failure: not found "
+                            "in database (reason '{response.reason}' / "
+                            "code {response.status_code} / "
+                            "url '{response.url}')")), # when else can we get this? malformed URL?
+        405: (CharonError, ("Charon access failure: method not "
+                            "allowed (reason '{response.reason}' / "
+                            "code {response.status_code} / "
+                            "url '{response.url}')")),
+        408: (CharonError, ("Charon access failure: connection timed out")),
+        503: (CharonError, ("Charon access failure: service "
+                            "unavailable (reason '{response.reason}' / "
+                            "code {response.status_code} / "
+                            "url '{response.url}')")),
+        409: (CharonError, ("Charon access failure: document "
+                            "revision conflict (reason '{response.reason}' / "
+                            "code {response.status_code} / "
+                            "url '{response.url}')")),}
+
+
+def raise_for_charon_status(response, success_codes=CHARON_SUCCESS_CODES):
+    """Raise the appropriate CharonError for an unsuccessful Charon response.
+
+    :param response: Any object with status_code, reason and url attributes
+    :param tuple success_codes: The status codes that are not errors
+    :raises CharonError: If the status code is not a success code
+    """
+    if response.status_code not in success_codes:
+        try:
+            err_type, err_msg = CHARON_FAILURE_CODES[response.status_code]
+        except KeyError:
+            # Error code undefined, used generic text
+            err_type = CharonError
+            err_msg = ("Charon access failure: {response.reason} "
+                       "(code {response.status_code} / url '{response.url}')")
+        raise err_type(err_msg.format(response=response), response.status_code)
+
+
+def is_charon_unavailable(error):
+    """True if a CharonError means Charon could not be reached or could not
+    answer, rather than that the request was refused."""
+    return getattr(error, "status_code", None) in CHARON_UNAVAILABLE_CODES
+
+
 class validate_response(object):
     """
     Validate or raise an appropriate exception for a Charon API query.
+    Each call is recorded in the Charon request statistics.
     """
-    def __init__(self, f):
+    def __init__(self, f, method=None, success_codes=CHARON_SUCCESS_CODES):
         self.f = f
-        ## Should these be class attributes? I don't really know
-        self.SUCCESS_CODES = (200, 201, 204)
-        # There are certainly more failure codes I need to add here
-        self.FAILURE_CODES = {
-                400: (CharonError, ("Charon access failure: invalid input "
-                                    "data (reason '{response.reason}' / "
-                                    "code {response.status_code} / "
-                                    "url '{response.url}')")),
-                404: (CharonError, ("Charon access failure: not found "
-                                    "in database (reason '{response.reason}' / "
-                                    "code {response.status_code} / "
-                                    "url '{response.url}')")), # when else can we get this? malformed URL?
-                405: (CharonError, ("Charon access failure: method not "
-                                    "allowed (reason '{response.reason}' / "
-                                    "code {response.status_code} / "
-                                    "url '{response.url}')")),
-                408: (CharonError, ("Charon access failure: connection timed out")),
-                409: (CharonError, ("Charon access failure: document "
-                                    "revision conflict (reason '{response.reason}' / "
-                                    "code {response.status_code} / "
-                                    "url '{response.url}')")),}
+        self.method = method or getattr(getattr(f, "func", f), "__name__", "?").upper()
+        self.SUCCESS_CODES = success_codes
+        self.FAILURE_CODES = CHARON_FAILURE_CODES
 
     def __call__(self, *args, **kwargs):
+        start_time = time.time()
+        response = None
+        status_code = None
         try:
-            response = self.f(*args, **kwargs)
-        except Timeout as e:
-            c_e = CharonError(e)
-            c_e.status_code = 408
-            raise c_e
-        if response.status_code not in self.SUCCESS_CODES:
             try:
-                err_type, err_msg = self.FAILURE_CODES[response.status_code]
-            except KeyError:
-                # Error code undefined, used generic text
-                err_type = CharonError
-                err_msg = ("Charon access failure: {response.reason} "
-                           "(code {response.status_code} / url '{response.url}')")
-            raise err_type(err_msg.format(**locals()), response.status_code)
-        return response
+                response = self.f(*args, **kwargs)
+            except Timeout as e:
+                c_e = CharonError(e)
+                c_e.status_code = 408
+                raise c_e
+            except ConnectionError as e:
+                # Raised once retries are exhausted or the server cannot be reached
+                raise CharonError("Charon access failure: unable to connect "
+                                  "({})".format(e), 503)
+            status_code = response.status_code
+            raise_for_charon_status(response, self.SUCCESS_CODES)
+            return response
+        except CharonError as e:
+            status_code = e.status_code
+            raise
+        finally:
+            url = kwargs.get("url") or (args[0] if args else None)
+            data = kwargs.get("data") or (args[1] if len(args) > 1 else None)
+            CHARON_STATS.record(self.method, url, status_code,
+                                time.time() - start_time,
+                                bytes_sent=len(data) if isinstance(data, basestring) else 0,
+                                bytes_received=len(response.content) if response is not None else 0)
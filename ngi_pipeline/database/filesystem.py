@@ -2,8 +2,10 @@ import json
 import os
 
 from ngi_pipeline.conductor.classes import NGIProject
-from ngi_pipeline.database.classes import CharonSession, CharonError
+from ngi_pipeline.database.async_classes import AsyncCharonSession
+from ngi_pipeline.database.classes import CharonError, CharonProjectTree, CharonSession
 from ngi_pipeline.log.loggers import minimal_logger
+from tornado import gen
 
 LOG = minimal_logger(__name__)
 
@@ -11,204 +13,317 @@ LOG = minimal_logger(__name__)
 def create_charon_entries_from_project(project, best_practice_analysis="whole_genome_reseq",
                                        sequencing_facility="NGI-S",
                                        force_overwrite=False, delete_existing=False,
-                                       retry_on_fail=True):
+                                       retry_on_fail=True, max_workers=None):
     """Given a project object, creates the relevant entries in Charon.
-    This code is remarkably shoddy as I created it in a hurry and then later
-    it became a part of the pipeline. Use at your own risk! Ha ha.
+
+    The project's existing records are fetched once and compared with the
+    project object; only the missing documents are created (and, with
+    force_overwrite, only the existing documents that differ are updated).
+    This is done level by level -- samples, then libpreps, then seqruns -- with
+    the requests of each level sent concurrently. Documents whose creation
+    fails are retried once (if retry_on_fail); whatever lies below a document
+    that could not be created is skipped.
 
     :param NGIProject project: The NGIProject object
     :param str best_practice_analysis: The workflow to assign for this project (default "variant_calling")
     :param str sequencing_facility: The facility that did the sequencing
     :param bool force_overwrite: If this is set to true, overwrite existing entries in Charon (default false)
-    :param bool delete_existing: Don't just update existing entries, delete them and create new ones (default false)
+    :param bool delete_existing: Don't just update existing entries, delete them (seqruns, libpreps
+                                 and samples) and create new ones (default false)
+    :param bool retry_on_fail: Retry the requests that failed once before giving up (default true)
+    :param int max_workers: The maximum number of concurrent requests (optional)
+
+    :raises CharonError: If the project could not be created or any of its documents failed
     """
     charon_session = CharonSession()
-    update_failed=False
-    try:
-        status = "OPEN"
+    project_id = project.project_id
+    existing_tree = _get_existing_charon_tree(charon_session, project, max_workers)
+    # Ids of the documents that could not be created; nothing goes below them
+    failed = set()
+
+    status = "OPEN"
+    project_fields = dict(name=project.name, status=status,
+                          best_practice_analysis=best_practice_analysis,
+                          sequencing_facility=sequencing_facility)
+    project_label = 'Project "{}"'.format(project)
+    if existing_tree is None:
         LOG.info('Creating project "{}" with status "{}", best practice analysis "{}", '
                  'and sequencing_facility {}'.format(project, status,
                                                      best_practice_analysis,
                                                      sequencing_facility))
-        charon_session.project_create(projectid=project.project_id,
-                                      name=project.name,
-                                      status=status,
-                                      best_practice_analysis=best_practice_analysis,
-                                      sequencing_facility=sequencing_facility)
-        LOG.info('Project "{}" created in Charon.'.format(project))
-    except CharonError as e:
-        if e.status_code == 400:
-            if force_overwrite:
-                LOG.warn('Overwriting data for project "{}"'.format(project))
-                charon_session.project_update(projectid=project.project_id,
-                                              name=project.name,
-                                              status=status,
-                                              best_practice_analysis=best_practice_analysis,
-                                              sequencing_facility=sequencing_facility)
-                LOG.info('Project "{}" updated in Charon.'.format(project))
-            else:
-                LOG.info('Project "{}" already exists; moving to samples...'.format(project))
-        else:
-            raise
+        operation = _create_or_update(
+                project_label,
+                lambda: charon_session.project_create(projectid=project_id, **project_fields),
+                lambda: charon_session.project_update(projectid=project_id, **project_fields),
+                force_overwrite)
+    else:
+        operation = _sync_document(
+                project_label, existing_tree.project, project_fields,
+                lambda **fields: charon_session.project_create(projectid=project_id, **fields),
+                lambda **fields: charon_session.project_update(projectid=project_id, **fields),
+                force_overwrite)
+        if operation is None:
+            LOG.info('Project "{}" already exists; moving to samples...'.format(project))
+    # Without the project there is nothing to do
+    if operation and _run_operations(charon_session, [((), project_label, operation)],
+                                     retry_on_fail, max_workers):
+        raise CharonError('Could not create or update project "{}" in Charon'.format(project))
+    if existing_tree is None:
+        existing_tree = CharonProjectTree({"projectid": project_id})
+
+    if delete_existing:
+        failed.update(_delete_existing_documents(charon_session, project_id, existing_tree,
+                                                 max_workers))
+
+    analysis_status = "TO_ANALYZE"
+    operations = []
     for sample in project:
-        if delete_existing:
-            LOG.warn('Deleting existing sample "{}"'.format(sample))
-            try:
-                charon_session.sample_delete(projectid=project.project_id,
-                                             sampleid=sample.name)
-            except CharonError as e:
-                update_failed=True
-                LOG.error('Could not delete sample "{}": {}'.format(sample, e))
-        try:
-            analysis_status = "TO_ANALYZE"
-            LOG.info('Creating sample "{}" with analysis_status "{}"'.format(sample, analysis_status))
-            charon_session.sample_create(projectid=project.project_id,
-                                         sampleid=sample.name,
-                                         analysis_status=analysis_status)
-            LOG.info('Project/sample "{}/{}" created in Charon.'.format(project, sample))
-        except CharonError as e:
-            if e.status_code == 400:
-                if force_overwrite:
-                    LOG.warn('Overwriting data for project "{}" / '
-                             'sample "{}"'.format(project, sample))
-                    charon_session.sample_update(projectid=project.project_id,
-                                                 sampleid=sample.name,
-                                                 analysis_status=analysis_status)
-                    LOG.info('Project/sample "{}/{}" updated in Charon.'.format(project, sample))
-                else:
-                    LOG.info('Project "{}" / sample "{}" already exists; moving '
-                             'to libpreps'.format(project, sample))
-            else:
-                update_failed=True
-                LOG.error(e)
+        if (sample.name,) in failed:
+            continue
+        label = 'Project/sample "{}/{}"'.format(project, sample)
+        operation = _sync_document(label, existing_tree.samples.get(sample.name),
+                                   dict(analysis_status=analysis_status),
+                                   lambda sample=sample, **fields: charon_session.sample_create(
+                                        projectid=project_id, sampleid=sample.name, **fields),
+                                   lambda sample=sample, **fields: charon_session.sample_update(
+                                        projectid=project_id, sampleid=sample.name, **fields),
+                                   force_overwrite)
+        if operation:
+            operations.append(((sample.name,), label, operation))
+    failed.update(_run_operations(charon_session, operations, retry_on_fail, max_workers))
+
+    qc = "PASSED"
+    operations = []
+    for sample in project:
+        for libprep in sample:
+            if (sample.name,) in failed:
                 continue
+            label = 'Project/sample/libprep "{}/{}/{}"'.format(project, sample, libprep)
+            existing = existing_tree.libpreps.get(sample.name, {}).get(libprep.name)
+            operation = _sync_document(label, existing, dict(qc=qc),
+                                       lambda sample=sample, libprep=libprep, **fields:
+                                            charon_session.libprep_create(
+                                                projectid=project_id, sampleid=sample.name,
+                                                libprepid=libprep.name, **fields),
+                                       lambda sample=sample, libprep=libprep, **fields:
+                                            charon_session.libprep_update(
+                                                projectid=project_id, sampleid=sample.name,
+                                                libprepid=libprep.name, **fields),
+                                       force_overwrite)
+            if operation:
+                operations.append(((sample.name, libprep.name), label, operation))
+    failed.update(_run_operations(charon_session, operations, retry_on_fail, max_workers))
+
+    seqrun_fields = dict(alignment_status="NOT_RUNNING", total_reads=0,
+                         mean_autosomal_coverage=0)
+    operations = []
+    for sample in project:
         for libprep in sample:
-            if delete_existing:
-                LOG.warn('Deleting existing libprep "{}"'.format(libprep))
-                try:
-                    charon_session.libprep_delete(projectid=project.project_id,
-                                                  sampleid=sample.name,
-                                                  libprepid=libprep.name)
-                except CharonError as e:
-                    LOG.warn('Could not delete libprep "{}": {}'.format(libprep, e))
-            try:
-                qc = "PASSED"
-                LOG.info('Creating libprep "{}" with qc status "{}"'.format(libprep, qc))
-                charon_session.libprep_create(projectid=project.project_id,
-                                              sampleid=sample.name,
-                                              libprepid=libprep.name,
-                                              qc=qc)
-                LOG.info(('Project/sample/libprep "{}/{}/{}" created in '
-                          'Charon').format(project, sample, libprep))
-            except CharonError as e:
-                if e.status_code == 400:
-                    if force_overwrite:
-                        LOG.warn('Overwriting data for project "{}" / '
-                                 'sample "{}" / libprep "{}"'.format(project, sample,
-                                                                     libprep))
-                        charon_session.libprep_update(projectid=project.project_id,
-                                                      sampleid=sample.name,
-                                                      libprepid=libprep.name,
-                                                      qc=qc)
-                        LOG.info(('Project/sample/libprep "{}/{}/{}" updated in '
-                                  'Charon').format(project, sample, libprep))
-                    else:
-                        LOG.debug(e)
-                        LOG.info('Project "{}" / sample "{}" / libprep "{}" already '
-                                 'exists; moving to libpreps'.format(project, sample, libprep))
-                else:
-                    update_failed=True
-                    LOG.error(e)
-                    continue
+            if (sample.name,) in failed or (sample.name, libprep.name) in failed:
+                continue
             for seqrun in libprep:
-                if delete_existing:
-                    LOG.warn('Deleting existing seqrun "{}"'.format(seqrun))
-                    try:
-                        charon_session.seqrun_delete(projectid=project.project_id,
-                                                     sampleid=sample.name,
-                                                     libprepid=libprep.name,
-                                                     seqrunid=seqrun.name)
-                    except CharonError as e:
-                        update_failed=True
-                        LOG.error('Could not delete seqrun "{}": {}'.format(seqrun, e))
-                try:
-                    alignment_status="NOT_RUNNING"
-                    LOG.info('Creating seqrun "{}" with alignment_status "{}"'.format(seqrun, alignment_status))
-                    charon_session.seqrun_create(projectid=project.project_id,
-                                                 sampleid=sample.name,
-                                                 libprepid=libprep.name,
-                                                 seqrunid=seqrun.name,
-                                                 alignment_status=alignment_status,
-                                                 total_reads=0,
-                                                 mean_autosomal_coverage=0)
-                    LOG.info(('Project/sample/libprep/seqrun "{}/{}/{}/{}" '
-                              'created in Charon').format(project, sample,
-                                                          libprep, seqrun))
-                except CharonError as e:
-                    if e.status_code == 400:
-                        if force_overwrite:
-                            LOG.warn('Overwriting data for project "{}" / '
-                                     'sample "{}" / libprep "{}" / '
-                                     'seqrun "{}"'.format(project, sample,
-                                                          libprep, seqrun))
-                            charon_session.seqrun_update(projectid=project.project_id,
-                                                         sampleid=sample.name,
-                                                         libprepid=libprep.name,
-                                                         seqrunid=seqrun.name,
-                                                         alignment_status=alignment_status,
-                                                         total_reads=0,
-                                                         mean_autosomal_coverage=0)
-                            LOG.info(('Project/sample/libprep/seqrun "{}/{}/{}/{}" '
-                                      'updated in Charon').format(project, sample,
-                                                                  libprep, seqrun))
-                        else:
-                            LOG.info('Project "{}" / sample "{}" / libprep "{}" / '
-                                     'seqrun "{}" already exists; next...'.format(project, sample,
-                                                                                  libprep, seqrun))
-                    else:
-                        update_failed=True
-                        LOG.error(e)
-                        continue
-
-    if update_failed :
-        if retry_on_fail:
-            create_charon_entries_from_project(project, best_practice_analysis=best_practice_analysis,
-                                       sequencing_facility=sequencing_facility,
-                                       force_overwrite=force_overwrite, delete_existing=delete_existing,
-                                       retry_on_fail=False)
-        else:
-            raise CharonError("A network error blocks Charon updating.")
+                label = 'Project/sample/libprep/seqrun "{}/{}/{}/{}"'.format(project, sample,
+                                                                              libprep, seqrun)
+                existing = existing_tree.seqruns.get((sample.name, libprep.name),
+                                                     {}).get(seqrun.name)
+                operation = _sync_document(label, existing, seqrun_fields,
+                                           lambda sample=sample, libprep=libprep, seqrun=seqrun, **fields:
+                                                charon_session.seqrun_create(
+                                                    projectid=project_id, sampleid=sample.name,
+                                                    libprepid=libprep.name, seqrunid=seqrun.name,
+                                                    **fields),
+                                           lambda sample=sample, libprep=libprep, seqrun=seqrun, **fields:
+                                                charon_session.seqrun_update(
+                                                    projectid=project_id, sampleid=sample.name,
+                                                    libprepid=libprep.name, seqrunid=seqrun.name,
+                                                    **fields),
+                                           force_overwrite)
+                if operation:
+                    operations.append(((sample.name, libprep.name, seqrun.name), label, operation))
+    failed.update(_run_operations(charon_session, operations, retry_on_fail, max_workers))
+
+    if failed:
+        raise CharonError("A network error blocks Charon updating.")
+
+
+def _get_existing_charon_tree(charon_session, project, max_workers=None):
+    """Fetch the Charon records of the samples, libpreps and seqruns in the
+    project object, or return None if the project is not in Charon.
+
+    :rtype: CharonProjectTree
+    """
+    project_doc, samples = charon_session.map_concurrently(
+            lambda f: f(project.project_id),
+            [charon_session.project_get, charon_session.project_get_samples],
+            max_workers=max_workers, return_exceptions=True)
+    if isinstance(project_doc, CharonError):
+        if project_doc.status_code == 404:
+            return None
+        raise project_doc
+    if isinstance(samples, CharonError):
+        raise samples
+    tree = CharonProjectTree(project_doc)
+    wanted_samples = set(sample.name for sample in project)
+    tree.add_samples([sample for sample in samples.get('samples', [])
+                      if sample['sampleid'] in wanted_samples])
+    sample_ids = list(tree.samples.keys())
+    libpreps_list = charon_session.map_concurrently(
+            lambda sample_id: charon_session.sample_get_libpreps(project.project_id, sample_id),
+            sample_ids, max_workers=max_workers)
+    for sample_id, libpreps in zip(sample_ids, libpreps_list):
+        wanted_libpreps = set(libprep.name for libprep in project.samples[sample_id])
+        for libprep in libpreps.get('libpreps', []):
+            if libprep['libprepid'] in wanted_libpreps:
+                tree.add_libprep(sample_id, libprep)
+    libprep_keys = tree.libprep_keys()
+    seqruns_list = charon_session.map_concurrently(
+            lambda key: charon_session.libprep_get_seqruns(project.project_id, *key),
+            libprep_keys, max_workers=max_workers)
+    for (sample_id, libprep_id), seqruns in zip(libprep_keys, seqruns_list):
+        for seqrun in seqruns.get('seqruns', []):
+            tree.add_seqrun(sample_id, libprep_id, seqrun)
+    return tree
+
+
+def _delete_existing_documents(charon_session, project_id, existing_tree, max_workers=None):
+    """Delete the seqruns, then the libpreps, then the samples in the tree
+    (each level concurrently), and remove the samples deleted from it. Nothing
+    more is deleted of a sample once one of its documents could not be.
+
+    :returns: The ids of the samples that could not be deleted
+    :rtype: set
+    """
+    failed = set()
+    levels = [("seqrun", [(sample_id, libprep_id, seqrun['seqrunid']) for
+                          sample_id, libprep_id, seqrun in existing_tree.iter_seqruns()],
+               charon_session.seqrun_delete),
+              ("libprep", existing_tree.libprep_keys(), charon_session.libprep_delete),
+              ("sample", [(sample_id,) for sample_id in existing_tree.samples],
+               charon_session.sample_delete)]
+    for level, documents_ids, delete in levels:
+        documents_ids = [ids for ids in documents_ids if ids[:1] not in failed]
+        for ids in documents_ids:
+            LOG.warn('Deleting existing {} "{}"'.format(level, "/".join(ids)))
+        results = charon_session.map_concurrently(
+                lambda ids, delete=delete: delete(project_id, *ids),
+                documents_ids, max_workers=max_workers, return_exceptions=True)
+        for ids, result in zip(documents_ids, results):
+            if isinstance(result, CharonError):
+                LOG.error('Could not delete {} "{}": {}'.format(level, "/".join(ids), result))
+                failed.add(ids[:1])
+    for sample_id in list(existing_tree.samples):
+        if (sample_id,) not in failed:
+            del existing_tree.samples[sample_id]
+            for libprep_id in existing_tree.libpreps.pop(sample_id, {}):
+                existing_tree.seqruns.pop((sample_id, libprep_id), None)
+    return failed
+
+
+def _sync_document(label, existing, fields, create, update, force_overwrite):
+    """Return the operation that brings a document in line with fields, or
+    None if there is nothing to do."""
+    if existing is None:
+        LOG.info('Creating {} with {}'.format(label, _format_fields(fields)))
+        return _create_or_update(label, lambda: create(**fields), lambda: update(**fields),
+                                 force_overwrite)
+    if force_overwrite and _differs(existing, fields):
+        LOG.warn('Overwriting data for {}'.format(label))
+        def operation():
+            update(**fields)
+            LOG.info('{} updated in Charon.'.format(label))
+        return operation
+    LOG.debug('{} already exists'.format(label))
+    return None
+
+
+def _create_or_update(label, create, update, force_overwrite):
+    """Return a function creating a document. If the document turns out to
+    exist after all, it is updated instead when force_overwrite is set."""
+    def operation():
+        try:
+            create()
+            LOG.info('{} created in Charon.'.format(label))
+        except CharonError as e:
+            if e.status_code != 400:
+                raise
+            if force_overwrite:
+                LOG.warn('Overwriting data for {}'.format(label))
+                update()
+                LOG.info('{} updated in Charon.'.format(label))
+            else:
+                LOG.info('{} already exists'.format(label))
+    return operation
+
+
+def _run_operations(charon_session, operations, retry_on_fail=True, max_workers=None):
+    """Run [(document ids, label, function), ...] concurrently, retrying the
+    ones that fail once if retry_on_fail.
+
+    :returns: The ids of the documents whose operations failed
+    :rtype: set
+    """
+    results = charon_session.map_concurrently(lambda operation: operation[2](),
+                                              operations, max_workers=max_workers,
+                                              return_exceptions=True)
+    failures = [(operation, result) for operation, result in zip(operations, results)
+                if isinstance(result, CharonError)]
+    if failures and retry_on_fail:
+        LOG.info("Retrying {} failed Charon update(s)".format(len(failures)))
+        return _run_operations(charon_session, [operation for operation, _ in failures],
+                               retry_on_fail=False, max_workers=max_workers)
+    for (ids, label, _), error in failures:
+        LOG.error('Could not create or update {} in Charon: {}'.format(label, error))
+    return set(ids for (ids, label, _), error in failures)
+
+
+def _differs(document, fields):
+    return any(document.get(key) != value and str(document.get(key)) != str(value)
+               for key, value in fields.items())
+
+
+def _format_fields(fields):
+    return ", ".join('{} "{}"'.format(key, value) for key, value in sorted(fields.items()))
+
 
 def recreate_project_from_db(analysis_top_dir, project_name, project_id):
-    project_dir = os.path.join(analysis_top_dir, "DATA", project_name)
+    try:
+        charon_tree = CharonSession().project_get_tree(project_id)
+    except CharonError as e:
+        raise RuntimeError("Could not access Charon records for project {}: {}".format(project_id, e))
+    return project_obj_from_charon_tree(charon_tree, analysis_top_dir, project_name, project_id)
+
+
+@gen.coroutine
+def recreate_project_from_db_async(analysis_top_dir, project_name, project_id,
+                                   charon_session=None):
+    """Coroutine version of recreate_project_from_db, for recreating many
+    projects at once on one IOLoop.
+
+    :param AsyncCharonSession charon_session: The session to use (optional)
+    """
+    try:
+        charon_tree = yield (charon_session or AsyncCharonSession()).project_get_tree(project_id)
+    except CharonError as e:
+        raise RuntimeError("Could not access Charon records for project {}: {}".format(project_id, e))
+    raise gen.Return(project_obj_from_charon_tree(charon_tree, analysis_top_dir,
+                                                  project_name, project_id))
+
+
+def project_obj_from_charon_tree(charon_tree, analysis_top_dir, project_name, project_id):
+    """Build an NGIProject with samples, libpreps and seqruns (and their
+    Charon statuses) from a CharonProjectTree."""
     project_obj = NGIProject(name=project_name,
                              dirname=project_name,
                              project_id=project_id,
                              base_path=analysis_top_dir)
-    charon_session = CharonSession()
-    try:
-        samples_dict = charon_session.project_get_samples(project_id)["samples"]
-    except CharonError as e:
-        raise RuntimeError("Could not access samples for project {}: {}".format(project_id, e))
-    for sample in samples_dict:
-        sample_id = sample.get("sampleid")
-        sample_dir = os.path.join(project_dir, sample_id)
+    for sample_id, sample in charon_tree.samples.items():
         sample_obj = project_obj.add_sample(name=sample_id, dirname=sample_id)
         sample_obj.status = sample.get("status", "unknown")
-        try:
-            libpreps_dict = charon_session.sample_get_libpreps(project_id, sample_id)["libpreps"]
-        except CharonError as e:
-            raise RuntimeError("Could not access libpreps for project {} / sample {}: {}".format(project_id,sample_id, e))
-        for libprep in libpreps_dict:
+        for libprep in charon_tree.get_libpreps(sample_id):
             libprep_id = libprep.get("libprepid")
             libprep_obj = sample_obj.add_libprep(name=libprep_id,  dirname=libprep_id)
             libprep_obj.status = libprep.get("status", "unknown")
-            try:
-                seqruns_dict = charon_session.libprep_get_seqruns(project_id, sample_id, libprep_id)["seqruns"]
-            except CharonError as e:
-                raise RuntimeError("Could not access seqruns for project {} / sample {} / "
-                                   "libprep {}: {}".format(project_id, sample_id, libprep_id, e))
-            for seqrun in seqruns_dict:
+            for seqrun in charon_tree.get_seqruns(sample_id, libprep_id):
                 # e.g. 140528_D00415_0049_BC423WACXX
                 seqrun_id = seqrun.get("seqrunid")
                 seqrun_obj = libprep_obj.add_seqrun(name=seqrun_id, dirname=seqrun_id)
@@ -0,0 +1,307 @@
+"""Counts, sizes and latencies of the requests made to Charon.
+
+Every request made through CharonSession or AsyncCharonSession is recorded in
+CHARON_STATS, keyed by HTTP verb and endpoint ("PUT seqrun") and attributed to
+the pipeline function that issued it, e.g.
+
+    ngi_pipeline.utils.charon.recurse_status_for_sample issued 412 PUT seqrun
+
+Hits and misses of the optional response cache (see response_cache.py) are
+counted here too.
+
+The statistics can be logged as a summary and/or dumped as JSON or OpenMetrics
+text when the process exits; see the "instrumentation" part of the charon
+section of the config file.
+"""
+from __future__ import print_function
+
+import atexit
+import bisect
+import collections
+import contextlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+from ngi_pipeline.log.loggers import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets; the last is +Inf
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+# Frames in these modules are skipped when finding the caller of a request
+CLIENT_MODULE_PREFIXES = ("ngi_pipeline.database.classes",
+                          "ngi_pipeline.database.async_classes",
+                          "ngi_pipeline.database.instrumentation",
+                          "ngi_pipeline.database.mirror",
+                          "ngi_pipeline.database.response_cache",
+                          "contextlib", "functools", "multiprocessing", "threading",
+                          "requests", "urllib3", "tornado")
+UNKNOWN_CALLER = "<unknown>"
+
+CHARON_URL_RE = re.compile(r'.*/api/v1/(?P<endpoint>\w+)')
+
+
+class EndpointStats(object):
+    """Aggregated statistics for one verb/endpoint pair."""
+    def __init__(self):
+        self.num_requests = 0
+        self.status_codes = collections.Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+
+    def add(self, status_code, seconds, bytes_sent, bytes_received):
+        self.num_requests += 1
+        self.status_codes[status_code] += 1
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.bucket_counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    @property
+    def num_errors(self):
+        return sum(count for status_code, count in self.status_codes.items()
+                   if not (200 <= status_code < 300 or status_code == 304))
+
+    def quantile(self, q):
+        """Estimate a latency quantile as the upper bound of its bucket."""
+        if not self.num_requests:
+            return 0.0
+        rank = q * self.num_requests
+        cumulative = 0
+        for upper_bound, count in zip(LATENCY_BUCKETS, self.bucket_counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(upper_bound, self.max_seconds)
+        return self.max_seconds
+
+    def as_dict(self):
+        return {"requests": self.num_requests,
+                "errors": self.num_errors,
+                "status_codes": dict((str(code), count) for code, count in
+                                     self.status_codes.items()),
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received,
+                "seconds_total": self.total_seconds,
+                "seconds_max": self.max_seconds,
+                "latency_buckets": [[("+Inf" if upper_bound == float("inf") else upper_bound), count]
+                                    for upper_bound, count in zip(LATENCY_BUCKETS,
+                                                                  self.bucket_counts)]}
+
+
+class CharonRequestStats(object):
+    """Thread-safe record of the requests made to Charon in this process."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._caller_state = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            # (method, endpoint) -> EndpointStats
+            self.endpoints = collections.defaultdict(EndpointStats)
+            # (caller, method, endpoint) -> number of requests
+            self.callers = collections.Counter()
+            # e.g. "hit" -> number of GETs answered from the response cache
+            self.cache_events = collections.Counter()
+
+    def record(self, method, url, status_code, seconds, bytes_sent=0,
+               bytes_received=0, caller=None):
+        """Record one request.
+
+        :param str method: The HTTP verb
+        :param str url: The URL requested
+        :param int status_code: The status code (or the CharonError code if none was received)
+        :param float seconds: The time the request took, retries included
+        :param int bytes_sent: The size of the request body
+        :param int bytes_received: The size of the response body
+        :param str caller: The function to attribute the request to (default: found from the stack)
+        """
+        endpoint = endpoint_from_url(url)
+        caller = caller or self.current_caller()
+        with self._lock:
+            self.endpoints[(method, endpoint)].add(status_code, seconds,
+                                                   bytes_sent, bytes_received)
+            self.callers[(caller, method, endpoint)] += 1
+
+    def record_cache_event(self, event, count=1):
+        """Count a response cache event ("hit", "miss", "revalidated", ...)."""
+        with self._lock:
+            self.cache_events[event] += count
+
+    def current_caller(self):
+        """The function requests made now in this thread are attributed to."""
+        return getattr(self._caller_state, "caller", None) or find_caller()
+
+    @contextlib.contextmanager
+    def attributed_to(self, caller):
+        """Attribute the requests made in this thread within the block to
+        caller; used to carry the caller over to worker threads."""
+        previous_caller = getattr(self._caller_state, "caller", None)
+        self._caller_state.caller = caller
+        try:
+            yield
+        finally:
+            self._caller_state.caller = previous_caller
+
+    def as_dict(self):
+        with self._lock:
+            return {"started_at": self.started_at,
+                    "elapsed_seconds": time.time() - self.started_at,
+                    "pid": os.getpid(),
+                    "endpoints": dict(("{} {}".format(method, endpoint), stats.as_dict())
+                                      for (method, endpoint), stats in self.endpoints.items()),
+                    "callers": [{"caller": caller, "method": method,
+                                 "endpoint": endpoint, "requests": count}
+                                for (caller, method, endpoint), count in
+                                self.callers.most_common()],
+                    "cache": dict(self.cache_events)}
+
+    def summary(self, max_callers=10):
+        """A human-readable table of the requests made, heaviest callers first."""
+        with self._lock:
+            endpoints = sorted(self.endpoints.items(), key=lambda item: -item[1].total_seconds)
+            callers = self.callers.most_common(max_callers)
+            cache_events = sorted(self.cache_events.items())
+        if not endpoints:
+            return "No Charon requests made"
+        lines = ["Charon requests by endpoint:",
+                 "    {:<24} {:>8} {:>7} {:>10} {:>9} {:>9} {:>12}".format(
+                        "endpoint", "requests", "errors", "total (s)", "p50 (s)",
+                        "p95 (s)", "bytes in")]
+        for (method, endpoint), stats in endpoints:
+            lines.append("    {:<24} {:>8} {:>7} {:>10.2f} {:>9.3f} {:>9.3f} {:>12}".format(
+                            "{} {}".format(method, endpoint), stats.num_requests,
+                            stats.num_errors, stats.total_seconds, stats.quantile(0.5),
+                            stats.quantile(0.95), stats.bytes_received))
+        lines.append("Top Charon callers:")
+        for (caller, method, endpoint), count in callers:
+            lines.append("    {} issued {} {} {}".format(caller, count, method, endpoint))
+        if cache_events:
+            lines.append("Charon response cache: {}".format(
+                            ", ".join("{} {}".format(count, event) for event, count in cache_events)))
+        return "\n".join(lines)
+
+    def to_openmetrics(self):
+        """The statistics in the OpenMetrics text exposition format."""
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+            callers = sorted(self.callers.items())
+            cache_events = sorted(self.cache_events.items())
+        lines = ["# TYPE charon_requests counter",
+                 "# HELP charon_requests Requests made to Charon."]
+        for (method, endpoint), stats in endpoints:
+            for status_code, count in sorted(stats.status_codes.items()):
+                lines.append('charon_requests_total{{method="{}",endpoint="{}",code="{}"}} '
+                             '{}'.format(method, endpoint, status_code, count))
+        lines.extend(["# TYPE charon_request_duration_seconds histogram",
+                      "# HELP charon_request_duration_seconds Charon request latency, retries included."])
+        for (method, endpoint), stats in endpoints:
+            labels = 'method="{}",endpoint="{}"'.format(method, endpoint)
+            cumulative = 0
+            for upper_bound, count in zip(LATENCY_BUCKETS, stats.bucket_counts):
+                cumulative += count
+                lines.append('charon_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(
+                                labels, "+Inf" if upper_bound == float("inf") else upper_bound,
+                                cumulative))
+            lines.append('charon_request_duration_seconds_sum{{{}}} {}'.format(labels,
+                                                                                stats.total_seconds))
+            lines.append('charon_request_duration_seconds_count{{{}}} {}'.format(labels,
+                                                                                  stats.num_requests))
+        for name, attribute, help_text in (("sent", "bytes_sent", "Request body bytes sent to Charon."),
+                                           ("received", "bytes_received", "Response body bytes received from Charon.")):
+            lines.extend(["# TYPE charon_bytes_{} counter".format(name),
+                          "# HELP charon_bytes_{} {}".format(name, help_text)])
+            for (method, endpoint), stats in endpoints:
+                lines.append('charon_bytes_{}_total{{method="{}",endpoint="{}"}} {}'.format(
+                                name, method, endpoint, getattr(stats, attribute)))
+        lines.extend(["# TYPE charon_caller_requests counter",
+                      "# HELP charon_caller_requests Charon requests by the pipeline function issuing them."])
+        for (caller, method, endpoint), count in callers:
+            lines.append('charon_caller_requests_total{{caller="{}",method="{}",endpoint="{}"}} '
+                         '{}'.format(_escape_label(caller), method, endpoint, count))
+        if cache_events:
+            lines.extend(["# TYPE charon_cache_events counter",
+                          "# HELP charon_cache_events Charon response cache hits, misses, revalidations, invalidations and evictions."])
+            for event, count in cache_events:
+                lines.append('charon_cache_events_total{{event="{}"}} {}'.format(event, count))
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """Write the statistics to path: as JSON if it ends in ".json",
+        otherwise as OpenMetrics text. "{pid}" and "{timestamp}" in the path
+        are filled in.
+        """
+        path = path.format(pid=os.getpid(), timestamp=time.strftime("%Y%m%d-%H%M%S"))
+        if path.endswith(".json"):
+            text = json.dumps(self.as_dict(), indent=4, sort_keys=True)
+        else:
+            text = self.to_openmetrics()
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+
+CHARON_STATS = CharonRequestStats()
+
+_exit_report_settings = {}
+
+
+def register_exit_report(log_summary=False, dump_path=None):
+    """Log a summary and/or dump CHARON_STATS when the process exits. Can be
+    called repeatedly; the report is only made once.
+
+    :param bool log_summary: Log the summary table
+    :param str dump_path: Write the statistics here (see CharonRequestStats.dump)
+    """
+    if not (log_summary or dump_path):
+        return
+    if not _exit_report_settings:
+        atexit.register(_report_at_exit)
+    _exit_report_settings["log_summary"] = log_summary or _exit_report_settings.get("log_summary")
+    _exit_report_settings["dump_path"] = dump_path or _exit_report_settings.get("dump_path")
+
+
+def _report_at_exit():
+    if not CHARON_STATS.endpoints:
+        return
+    if _exit_report_settings.get("log_summary"):
+        LOG.info(CHARON_STATS.summary())
+    if _exit_report_settings.get("dump_path"):
+        try:
+            path = CHARON_STATS.dump(_exit_report_settings["dump_path"])
+            LOG.info('Charon request statistics written to "{}"'.format(path))
+        except (IOError, OSError) as e:
+            LOG.error('Could not write Charon request statistics: {}'.format(e))
+
+
+def endpoint_from_url(url):
+    """"http://charon/api/v1/seqrun/P1/P1_101/A/RUN" -> "seqrun" """
+    m = CHARON_URL_RE.match(url or "")
+    return m.group("endpoint") if m else "<other>"
+
+
+def find_caller():
+    """Return "module.function" for the innermost frame on this thread's
+    stack outside the Charon client and the libraries it uses."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        module_name = frame.f_globals.get("__name__", "")
+        if not module_name.startswith(CLIENT_MODULE_PREFIXES):
+            return "{}.{}".format(module_name, frame.f_code.co_name)
+        frame = frame.f_back
+    return UNKNOWN_CALLER
+
+
+def _escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,215 @@
+"""A local write-ahead journal for Charon updates that could not be sent.
+
+When Charon is unreachable (connection errors, timeouts, 502/503/504 after
+retries), the updates of a batch opened with a journal are stored in a SQLite
+file instead of being lost, and the work that produced them can be marked as
+done. The journal is drained later, e.g. by
+
+    ngi_pipeline_start.py journal replay
+
+or at the start of the next update_charon_with_local_jobs_status sweep.
+
+Every entry carries an idempotency key derived from its verb, URL and body;
+recording the same update again moves it to the end of the journal instead of
+adding a copy, so replaying is safe however often a sweep re-journals its work.
+Updates to a document are replayed in the order they were recorded, merged
+into one PUT.
+"""
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import time
+
+from ngi_pipeline.database.classes import CharonSession, is_charon_unavailable
+from ngi_pipeline.log.loggers import minimal_logger
+from ngi_pipeline.utils.classes import with_ngi_config
+
+from sqlalchemy import create_engine
+from sqlalchemy import Column, Float, Integer, String, Text
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+
+LOG = minimal_logger(__name__)
+
+Base = declarative_base()
+
+ReplayResult = collections.namedtuple('ReplayResult', ['sent', 'rejected', 'remaining'])
+
+
+class JournalEntry(Base):
+    __tablename__ = 'charonjournal'
+
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    idempotency_key = Column(String(40), unique=True, nullable=False)
+    method = Column(String(10), nullable=False)
+    url = Column(String(255), index=True, nullable=False)
+    label = Column(String(255))
+    data = Column(Text, nullable=False)
+    recorded_at = Column(Float, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    last_error = Column(Text)
+
+    def __repr__(self):
+        return "<JournalEntry({} {} {}: {})>".format(self.seq, self.method, self.label, self.data)
+
+
+@with_ngi_config
+def get_charon_journal(config=None, config_file_path=None):
+    """Return the journal at "charon_journal_db_path" in the database section
+    of the config, or next to the local job tracking database if not given.
+
+    :param dict config: The parsed ngi_pipeline config file (optional)
+    :param str config_file_path: The path to the ngi_pipeline config (optional)
+
+    :returns: The journal
+    :rtype: CharonJournal
+    :raises ValueError: If neither database path is configured
+    """
+    database_config = config.get("database") or {}
+    database_path = database_config.get("charon_journal_db_path")
+    if not database_path:
+        try:
+            database_path = os.path.join(os.path.dirname(database_config['record_tracking_db_path']),
+                                         "charon_journal.sql")
+        except KeyError:
+            raise ValueError('Cannot place the Charon journal: neither '
+                             '"charon_journal_db_path" nor "record_tracking_db_path" '
+                             'is set in the database section of the config')
+    return CharonJournal(database_path)
+
+
+class CharonJournal(object):
+    """An ordered, de-duplicated store of Charon updates awaiting delivery."""
+    def __init__(self, database_path):
+        """
+        :param str database_path: The path to the SQLite file (created if needed)
+        """
+        self.database_path = os.path.abspath(database_path)
+        database_dir = os.path.dirname(self.database_path)
+        if not os.path.exists(database_dir):
+            os.makedirs(database_dir)
+        self._engine = create_engine('sqlite:///{}'.format(self.database_path))
+        Base.metadata.create_all(self._engine)
+        self._Session = sessionmaker(bind=self._engine)
+
+    def __repr__(self):
+        return "<CharonJournal {} ({} pending)>".format(self.database_path, len(self))
+
+    def __len__(self):
+        with self._db_session() as session:
+            return session.query(JournalEntry).count()
+
+    @contextlib.contextmanager
+    def _db_session(self):
+        session = self._Session()
+        try:
+            yield session
+        finally:
+            session.close()
+
+    def record(self, url, data, label=None, error=None, method="PUT"):
+        """Store an update. An identical update already in the journal is
+        moved to the end rather than duplicated.
+
+        :param str url: The URL of the document
+        :param dict data: The fields to update
+        :param str label: A human-readable name for the document (e.g. "P123/P123_101")
+        :param error: Why the update could not be sent (optional)
+        :param str method: The HTTP verb
+
+        :returns: The idempotency key of the entry
+        :rtype: str
+        """
+        data_json = json.dumps(data, sort_keys=True)
+        key = idempotency_key(method, url, data_json)
+        with self._db_session() as session:
+            previous = session.query(JournalEntry).filter_by(idempotency_key=key).first()
+            attempts = 0
+            if previous is not None:
+                attempts = previous.attempts
+                session.delete(previous)
+                session.flush()
+            session.add(JournalEntry(idempotency_key=key, method=method, url=url,
+                                     label=label, data=data_json, recorded_at=time.time(),
+                                     attempts=attempts,
+                                     last_error=str(error) if error else None))
+            session.commit()
+        LOG.warn('Journaled Charon update of "{}" for later delivery{}'.format(
+                    label or url, ": {}".format(error) if error else ""))
+        return key
+
+    def has_pending(self, url):
+        """True if updates to the document at url are waiting in the journal."""
+        with self._db_session() as session:
+            return session.query(JournalEntry.seq).filter_by(url=url).first() is not None
+
+    def pending(self):
+        """All entries, oldest first.
+
+        :rtype: list of JournalEntry
+        """
+        with self._db_session() as session:
+            entries = session.query(JournalEntry).order_by(JournalEntry.seq).all()
+            session.expunge_all()
+            return entries
+
+    def replay(self, charon_session=None, max_workers=None):
+        """Send the journaled updates: one PUT per document, merging its
+        entries in the order recorded, sent concurrently. Delivered entries are
+        removed; so are entries Charon rejects (e.g. the document was deleted),
+        which are logged. Entries that fail because Charon is unavailable stay.
+
+        :param CharonSession charon_session: The session to send with (optional)
+        :param int max_workers: The maximum number of concurrent PUTs (optional)
+
+        :returns: The number of documents sent, rejected and still pending
+        :rtype: ReplayResult
+        """
+        charon_session = charon_session or CharonSession()
+        entries = self.pending()
+        if not entries:
+            return ReplayResult(0, 0, 0)
+        # url -> (label, merged data, [seq, ...])
+        documents = collections.OrderedDict()
+        for entry in entries:
+            label, data, seqs = documents.setdefault(entry.url, (entry.label, {}, []))
+            data.update(json.loads(entry.data))
+            seqs.append(entry.seq)
+        LOG.info("Replaying {} journaled Charon update(s) to {} document(s)".format(
+                    len(entries), len(documents)))
+        put = lambda url_document: charon_session.put(url_document[0],
+                                                      json.dumps(url_document[1][1]))
+        results = charon_session.map_concurrently(put, documents.items(),
+                                                  max_workers=max_workers,
+                                                  return_exceptions=True)
+        num_sent = num_rejected = 0
+        with self._db_session() as session:
+            for (url, (label, data, seqs)), result in zip(documents.items(), results):
+                if isinstance(result, Exception) and is_charon_unavailable(result):
+                    for entry in session.query(JournalEntry).filter(JournalEntry.seq.in_(seqs)):
+                        entry.attempts += 1
+                        entry.last_error = str(result)
+                    continue
+                if isinstance(result, Exception):
+                    LOG.error('Charon rejected the journaled update of "{}" ({}); '
+                              'dropping it: {}'.format(label, json.dumps(data), result))
+                    num_rejected += 1
+                else:
+                    num_sent += 1
+                session.query(JournalEntry).filter(JournalEntry.seq.in_(seqs)).\
+                        delete(synchronize_session=False)
+            session.commit()
+        result = ReplayResult(num_sent, num_rejected,
+                              len(documents) - num_sent - num_rejected)
+        if result.remaining:
+            LOG.warn("Charon is still unavailable; {} document update(s) remain "
+                     "journaled in {}".format(result.remaining, self.database_path))
+        return result
+
+
+def idempotency_key(method, url, data_json):
+    """A stable key for one update of one document."""
+    return hashlib.sha1("\n".join([method, url, data_json])).hexdigest()
@@ -0,0 +1,333 @@
+"""An optional local SQLite mirror of Charon project records.
+
+Reads are served from the mirror as long as the project was synced from Charon
+less than max_staleness seconds ago; otherwise the project is re-synced first.
+Writes go straight to Charon; every write made through the CharonSession,
+whether through the mirror or not, marks the project as stale.
+"""
+import contextlib
+import json
+import os
+import time
+
+from ngi_pipeline.database.classes import CharonError, CharonProjectTree, CharonSession
+from ngi_pipeline.log.loggers import minimal_logger
+from ngi_pipeline.utils.classes import with_ngi_config
+
+from sqlalchemy import create_engine
+from sqlalchemy import Column, Float, Integer, String, Text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+
+LOG = minimal_logger(__name__)
+
+Base = declarative_base()
+
+# One mirror per database file per process
+_MIRRORS = {}
+
+
+class MirroredDocument(Base):
+    __tablename__ = 'charondocument'
+
+    # e.g. "seqrun/P123/P123_456/A/140528_D00415_0049_BC423WACXX"
+    doc_key = Column(String(255), primary_key=True)
+    project_id = Column(String(50), index=True, nullable=False)
+    level = Column(String(10), nullable=False)
+    # Order of the document within its parent, as returned by Charon
+    position = Column(Integer)
+    modified = Column(String(50))
+    document = Column(Text, nullable=False)
+
+    def __repr__(self):
+        return "<MirroredDocument({})>".format(self.doc_key)
+
+
+class MirroredProject(Base):
+    __tablename__ = 'charonproject'
+
+    project_id = Column(String(50), primary_key=True)
+    # Seconds since the epoch
+    synced_at = Column(Float)
+
+    def __repr__(self):
+        return "<MirroredProject({}: synced at {})>".format(self.project_id, self.synced_at)
+
+
+@with_ngi_config
+def get_charon_read_session(config=None, config_file_path=None):
+    """Return the session that read-heavy code should query Charon through:
+    the local mirror if "mirror_max_staleness" is set in the charon section of
+    the config, otherwise a plain CharonSession.
+
+    :param dict config: The parsed ngi_pipeline config file (optional)
+    :param str config_file_path: The path to the ngi_pipeline config (optional)
+
+    :returns: A CharonMirror or CharonSession
+    :rtype: object
+    """
+    max_staleness = (config.get("charon") or {}).get("mirror_max_staleness")
+    if max_staleness is None:
+        return CharonSession()
+    database_config = config.get("database") or {}
+    database_path = database_config.get("charon_mirror_db_path")
+    if not database_path:
+        try:
+            database_path = os.path.join(os.path.dirname(database_config['record_tracking_db_path']),
+                                         "charon_mirror.sql")
+        except KeyError:
+            raise ValueError('Cannot place the Charon mirror: neither '
+                             '"charon_mirror_db_path" nor "record_tracking_db_path" '
+                             'is set in the database section of the config')
+    database_path = os.path.abspath(database_path)
+    mirror = _MIRRORS.get(database_path)
+    if mirror is None or mirror.max_staleness != float(max_staleness):
+        mirror = _MIRRORS[database_path] = CharonMirror(database_path, max_staleness)
+    return mirror
+
+
+class CharonMirror(object):
+    """Read interface compatible with CharonSession's project/sample/libprep/
+    seqrun getters, backed by a SQLite mirror of whole projects. Any other
+    attribute (writes, batch_updates, construct_charon_url, ...) is delegated
+    to the CharonSession, which tells the mirror about every write it sends.
+    """
+    def __init__(self, database_path, max_staleness, charon_session=None):
+        """
+        :param str database_path: The path to the SQLite file (created if needed)
+        :param float max_staleness: Re-sync a project if its mirror is older than this (seconds)
+        :param CharonSession charon_session: The session to sync from (optional)
+        """
+        self.database_path = os.path.abspath(database_path)
+        self.max_staleness = float(max_staleness)
+        self.charon_session = charon_session or CharonSession()
+        database_dir = os.path.dirname(self.database_path)
+        if not os.path.exists(database_dir):
+            os.makedirs(database_dir)
+        self._engine = create_engine('sqlite:///{}'.format(self.database_path))
+        Base.metadata.create_all(self._engine)
+        self._Session = sessionmaker(bind=self._engine)
+        # projectid -> (CharonProjectTree, synced_at)
+        self._trees = {}
+        # Projects already marked stale in the database since they were last synced
+        self._stale_projects = set()
+        # projectid -> time of the last write to it from this process
+        self._written_at = {}
+        self.charon_session.add_write_listener(self._invalidate_url)
+
+    def __repr__(self):
+        return "<CharonMirror {} (max staleness {}s)>".format(self.database_path,
+                                                              self.max_staleness)
+
+    def __getattr__(self, name):
+        if name == "charon_session":
+            raise AttributeError(name)
+        return getattr(self.charon_session, name)
+
+    @contextlib.contextmanager
+    def _db_session(self):
+        session = self._Session()
+        try:
+            yield session
+        finally:
+            session.close()
+
+    def invalidate_project(self, projectid):
+        """Mark a project as stale so the next read re-syncs it from Charon."""
+        self._trees.pop(projectid, None)
+        self._written_at[projectid] = time.time()
+        if projectid in self._stale_projects:
+            return
+        try:
+            with self._db_session() as session:
+                session.query(MirroredProject).filter_by(project_id=projectid).delete()
+                session.commit()
+            self._stale_projects.add(projectid)
+        except OperationalError as e:
+            LOG.warn('Could not mark project "{}" stale in the Charon mirror at '
+                     '"{}": {}'.format(projectid, self.database_path, e))
+
+    def _invalidate_url(self, method, url):
+        """Write listener: URLs are .../api/v1/<level>/<projectid>/..."""
+        path = url.split("/api/v1/", 1)[-1].split("/")
+        if len(path) > 1 and path[1]:
+            self.invalidate_project(path[1])
+
+    def sync_project(self, projectid):
+        """Fetch a project from Charon and store it in the mirror. Only
+        documents whose "modified" time (or content, if Charon gives none)
+        changed since the last sync are rewritten.
+
+        :param str projectid: The project id
+
+        :returns: The project tree as fetched from Charon
+        :rtype: CharonProjectTree
+        :raises CharonError: If the project cannot be fetched from Charon
+        """
+        synced_at = time.time()
+        tree = self.charon_session.project_get_tree(projectid)
+        documents = _documents_from_tree(projectid, tree)
+        try:
+            with self._db_session() as session:
+                existing = dict((row.doc_key, row) for row in
+                                session.query(MirroredDocument).filter_by(project_id=projectid))
+                num_changed = 0
+                for doc_key, level, position, document in documents:
+                    modified = document.get("modified")
+                    document_json = json.dumps(document, sort_keys=True)
+                    row = existing.pop(doc_key, None)
+                    if row is None:
+                        session.add(MirroredDocument(doc_key=doc_key, project_id=projectid,
+                                                     level=level, position=position,
+                                                     modified=modified, document=document_json))
+                    elif (modified and row.modified == modified and row.position == position) \
+                            or row.document == document_json:
+                        continue
+                    else:
+                        row.position = position
+                        row.modified = modified
+                        row.document = document_json
+                    num_changed += 1
+                for row in existing.values():
+                    session.delete(row)
+                session.merge(MirroredProject(project_id=projectid, synced_at=synced_at))
+                session.commit()
+            self._stale_projects.discard(projectid)
+            LOG.debug('Synced project "{}" to the Charon mirror ({} of {} documents changed, '
+                      '{} removed)'.format(projectid, num_changed, len(documents), len(existing)))
+        except OperationalError as e:
+            LOG.warn('Could not store project "{}" in the Charon mirror at "{}"; '
+                     'using it uncached: {}'.format(projectid, self.database_path, e))
+        self._trees[projectid] = (tree, synced_at)
+        return tree
+
+    def _load_tree(self, projectid):
+        """Return (tree, synced_at) from the database, or (None, None)."""
+        try:
+            with self._db_session() as session:
+                project = session.query(MirroredProject).get(projectid)
+                if project is None or project.synced_at is None:
+                    return None, None
+                rows = session.query(MirroredDocument).filter_by(project_id=projectid).\
+                        order_by(MirroredDocument.position).all()
+                rows = [(row.level, row.doc_key, json.loads(row.document)) for row in rows]
+                synced_at = project.synced_at
+        except OperationalError as e:
+            LOG.warn('Could not read the Charon mirror at "{}": {}'.format(self.database_path, e))
+            return None, None
+        tree = None
+        for level in ("project", "sample", "libprep", "seqrun"):
+            for row_level, doc_key, document in rows:
+                if row_level != level:
+                    continue
+                key_parts = doc_key.split("/")
+                if level == "project":
+                    tree = CharonProjectTree(document)
+                elif level == "sample":
+                    tree.add_sample(document)
+                elif level == "libprep":
+                    tree.add_libprep(key_parts[2], document)
+                else:
+                    tree.add_seqrun(key_parts[2], key_parts[3], document)
+        if tree is None:
+            return None, None
+        return tree, synced_at
+
+    def _get_tree(self, projectid):
+        if self.charon_session.current_batch() is not None:
+            # Inside an update batch, reads must see its pending updates
+            return self.charon_session.project_get_tree(projectid)
+        tree, synced_at = self._trees.get(projectid) or self._load_tree(projectid)
+        # A sync stored by another process may predate our own latest write
+        if tree is None or time.time() - synced_at > self.max_staleness or \
+                synced_at <= self._written_at.get(projectid, 0):
+            return self.sync_project(projectid)
+        self._trees[projectid] = (tree, synced_at)
+        return tree
+
+    # Project
+    def project_get(self, projectid):
+        return dict(self._get_tree(projectid).project)
+
+    def project_get_samples(self, projectid):
+        return {"samples": [dict(sample) for sample in
+                            self._get_tree(projectid).samples.values()]}
+
+    def project_get_tree(self, projectid, restrict_to_samples=None,
+                         restrict_to_libpreps=None, max_workers=None):
+        """As CharonSession.project_get_tree, served from the mirror. The
+        tree and its documents are copies, which the caller may modify."""
+        tree = self._get_tree(projectid)
+        tree_copy = CharonProjectTree(dict(tree.project))
+        tree_copy.add_samples([dict(sample) for sample in tree.samples.values()],
+                              restrict_to_samples)
+        for sample_id in tree_copy.samples:
+            for libprep in tree.get_libpreps(sample_id):
+                tree_copy.add_libprep(sample_id, dict(libprep))
+        for sample_id, libprep_id in tree_copy.libprep_keys(restrict_to_libpreps):
+            for seqrun in tree.get_seqruns(sample_id, libprep_id):
+                tree_copy.add_seqrun(sample_id, libprep_id, dict(seqrun))
+        return tree_copy
+
+    # Sample
+    def sample_get_tree(self, projectid, sampleid, max_workers=None):
+        """As CharonSession.sample_get_tree, served from the mirror."""
+        if self.charon_session.current_batch() is not None:
+            return self.charon_session.sample_get_tree(projectid, sampleid, max_workers)
+        tree = self.project_get_tree(projectid, restrict_to_samples=[sampleid])
+        tree.project = {'projectid': projectid}
+        return tree
+
+    def sample_get(self, projectid, sampleid):
+        return dict(self._get_document(projectid, sampleid))
+
+    def sample_get_libpreps(self, projectid, sampleid):
+        self._get_document(projectid, sampleid)
+        return {"libpreps": [dict(libprep) for libprep in
+                             self._get_tree(projectid).get_libpreps(sampleid)]}
+
+    # LibPrep
+    def libprep_get(self, projectid, sampleid, libprepid):
+        return dict(self._get_document(projectid, sampleid, libprepid))
+
+    def libprep_get_seqruns(self, projectid, sampleid, libprepid):
+        self._get_document(projectid, sampleid, libprepid)
+        return {"seqruns": [dict(seqrun) for seqrun in
+                            self._get_tree(projectid).get_seqruns(sampleid, libprepid)]}
+
+    # SeqRun
+    def seqrun_get(self, projectid, sampleid, libprepid, seqrunid):
+        return dict(self._get_document(projectid, sampleid, libprepid, seqrunid))
+
+    def _get_document(self, projectid, sampleid, libprepid=None, seqrunid=None):
+        tree = self._get_tree(projectid)
+        if seqrunid:
+            document = tree.seqruns.get((sampleid, libprepid), {}).get(seqrunid)
+        elif libprepid:
+            document = tree.libpreps.get(sampleid, {}).get(libprepid)
+        else:
+            document = tree.samples.get(sampleid)
+        if document is None:
+            raise CharonError('Charon access failure: not found in database '
+                              '(mirror of "{}")'.format("/".join(filter(None, (projectid, sampleid,
+                                                                               libprepid, seqrunid)))),
+                              404)
+        return document
+
+
+def _documents_from_tree(projectid, tree):
+    """Flatten a tree into (doc_key, level, position, document) tuples."""
+    documents = [("project/{}".format(projectid), "project", 0, tree.project)]
+    for s_position, (sample_id, sample) in enumerate(tree.samples.items()):
+        documents.append(("sample/{}/{}".format(projectid, sample_id), "sample",
+                          s_position, sample))
+        for l_position, (libprep_id, libprep) in enumerate(tree.libpreps[sample_id].items()):
+            documents.append(("libprep/{}/{}/{}".format(projectid, sample_id, libprep_id),
+                              "libprep", l_position, libprep))
+            for r_position, seqrun in enumerate(tree.get_seqruns(sample_id, libprep_id)):
+                documents.append(("seqrun/{}/{}/{}/{}".format(projectid, sample_id, libprep_id,
+                                                              seqrun['seqrunid']),
+                                  "seqrun", r_position, seqrun))
+    return documents
@@ -0,0 +1,159 @@
+"""An in-process cache of Charon GET responses, keyed by URL.
+
+A cached response is served without contacting Charon for ttl seconds. After
+that, if Charon sent an ETag with it, the next GET is made conditional
+(If-None-Match) and a "304 Not Modified" reply renews the cached copy instead
+of transferring the document again.
+
+Writes made through the same CharonSession drop the cached copies they make
+stale: the document itself, the listing it appears in and, for deletions,
+everything below it. Writes made by other processes are only noticed once the
+TTL has run out, so keep it short; see "cache_ttl" in the charon section of
+the config file.
+"""
+import collections
+import re
+import threading
+import time
+
+from ngi_pipeline.database.instrumentation import CHARON_STATS
+from ngi_pipeline.log.loggers import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+# Document levels and the number of ids in their URLs
+DOCUMENT_LEVELS = {"project": 1, "sample": 2, "libprep": 3, "seqrun": 4}
+# Level -> the listing its documents appear in
+LEVEL_LISTINGS = {"project": "projects", "sample": "samples",
+                  "libprep": "libpreps", "seqrun": "seqruns"}
+SAMPLE_PROJECTS_ENDPOINT = "projectidsfromsampleid"
+
+CHARON_PATH_RE = re.compile(r'.*/api/v1/(?P<endpoint>\w+)/?(?P<ids>[^?#]*)')
+
+CACHE_EVENTS = ("hit", "miss", "revalidated", "invalidated", "evicted")
+
+CachedResponse = collections.namedtuple('CachedResponse',
+                                        ['response', 'etag', 'stored_at', 'endpoint', 'ids'])
+
+
+class CharonResponseCache(object):
+    """Thread-safe TTL cache of successful Charon GET responses."""
+    def __init__(self, ttl, max_entries=10000):
+        """
+        :param float ttl: Seconds a response is served without asking Charon
+        :param int max_entries: Drop the least recently stored responses beyond this many
+        """
+        self.ttl = float(ttl)
+        self.max_entries = int(max_entries)
+        self._lock = threading.Lock()
+        # url -> CachedResponse, oldest first
+        self._entries = collections.OrderedDict()
+        self.counts = collections.Counter()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, fetch, url, headers=None, **kwargs):
+        """GET url through the cache.
+
+        :param function fetch: Makes the actual request: fetch(url, headers=..., **kwargs);
+                               must accept 304 responses
+        :param str url: The URL to get
+        :param dict headers: The headers to send
+
+        :returns: The (possibly cached) response
+        :rtype: requests.Response
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+        if entry is not None and time.time() - entry.stored_at < self.ttl:
+            self._count("hit")
+            return entry.response
+        if entry is not None and entry.etag:
+            headers = dict(headers or {}, **{"If-None-Match": entry.etag})
+        response = fetch(url, headers=headers, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            self._count("revalidated")
+            self._store(url, entry.response, entry.etag)
+            return entry.response
+        self._count("miss")
+        if response.status_code == 200:
+            self._store(url, response, response.headers.get("ETag"))
+        return response
+
+    def invalidate(self, method, url):
+        """Drop the cached responses a write to url makes stale.
+
+        :param str method: "POST", "PUT" or "DELETE"
+        :param str url: The URL written to
+        """
+        endpoint, ids = parse_charon_url(url)
+        if endpoint not in DOCUMENT_LEVELS:
+            self.clear()
+            return
+        if method == "POST":
+            # Creates a document below ids
+            parent_ids = ids
+        else:
+            parent_ids = ids[:-1]
+        listing = LEVEL_LISTINGS[endpoint]
+
+        def is_stale(entry):
+            if entry.endpoint == listing and entry.ids == parent_ids:
+                return True
+            if endpoint == "project" and entry.endpoint in ("project", "projects"):
+                # Projects are also fetched by name
+                return True
+            if method == "POST":
+                return endpoint == "sample" and entry.endpoint == SAMPLE_PROJECTS_ENDPOINT
+            if method == "DELETE":
+                return entry.ids[:len(ids)] == ids or \
+                        (endpoint == "sample" and entry.endpoint == SAMPLE_PROJECTS_ENDPOINT)
+            return entry.endpoint == endpoint and entry.ids == ids
+
+        with self._lock:
+            stale_urls = [cached_url for cached_url, entry in self._entries.items()
+                          if is_stale(entry)]
+            for cached_url in stale_urls:
+                del self._entries[cached_url]
+        self._count("invalidated", len(stale_urls))
+
+    def clear(self):
+        with self._lock:
+            num_entries = len(self._entries)
+            self._entries.clear()
+        self._count("invalidated", num_entries)
+
+    def stats(self):
+        """The hit/miss/revalidation/invalidation/eviction counts and the
+        number of responses currently cached."""
+        stats = dict((event, self.counts[event]) for event in CACHE_EVENTS)
+        stats["entries"] = len(self._entries)
+        lookups = stats["hit"] + stats["miss"] + stats["revalidated"]
+        stats["hit_ratio"] = float(stats["hit"] + stats["revalidated"]) / lookups if lookups else 0.0
+        return stats
+
+    def _store(self, url, response, etag):
+        endpoint, ids = parse_charon_url(url)
+        with self._lock:
+            self._entries.pop(url, None)
+            self._entries[url] = CachedResponse(response, etag, time.time(), endpoint, ids)
+            num_evicted = 0
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                num_evicted += 1
+        self._count("evicted", num_evicted)
+
+    def _count(self, event, count=1):
+        if count:
+            with self._lock:
+                self.counts[event] += count
+            CHARON_STATS.record_cache_event(event, count)
+
+
+def parse_charon_url(url):
+    """"http://charon/api/v1/libprep/P1/P1_101/A" -> ("libprep", ("P1", "P1_101", "A"))"""
+    m = CHARON_PATH_RE.match(url or "")
+    if not m:
+        return None, ()
+    return m.group("endpoint"), tuple(part for part in m.group("ids").split("/") if part)
@@ -21,3 +21,89 @@ def load_charon_variables(config=None, config_file_path=None):
         if var_value:
             vars_dict[var_name] = var_value
     return vars_dict
+
+
+# Defaults for the Charon HTTP transport; override under the "charon" config section
+CHARON_TRANSPORT_DEFAULTS = {
+    "pool_connections": 4,
+    "pool_maxsize": 16,
+    "max_retries": 3,
+    "retry_backoff_factor": 0.5,
+    "retry_status_codes": [502, 503, 504],
+    # Upper bound on concurrent requests when fetching/updating many documents
+    "max_concurrent_requests": 8,
+    # Seconds to serve repeated GETs from memory (None: no response cache)
+    "cache_ttl": None,
+    "cache_max_entries": 10000,
+    # (connect, read) in seconds
+    "timeout": {"default": [3.05, 30],
+                "get": [3.05, 15]},
+}
+
+@with_ngi_config
+def load_charon_transport_settings(config=None, config_file_path=None):
+    """Loads the connection pooling, retry, timeout and response cache
+    settings used by CharonSession from the "charon" section of the config, filling in
+    defaults for anything not specified.
+
+    Timeouts can be given per HTTP verb (get, post, put, delete) or as a
+    "default"; each value is either a single number or a [connect, read] pair.
+
+    :param dict config: The parsed ngi_pipeline config file (optional)
+    :param str config_file_path: The path to the ngi_pipeline config (optional)
+
+    :returns: A dict of the settings, with timeouts as {verb: (connect, read)}
+    :rtype: dict
+    :raises ValueError: If a timeout value cannot be parsed
+    """
+    charon_config = config.get("charon") or {}
+    settings = {}
+    for key, default in CHARON_TRANSPORT_DEFAULTS.items():
+        if key == "timeout":
+            continue
+        value = charon_config.get(key)
+        settings[key] = default if value is None else value
+    timeouts = dict(CHARON_TRANSPORT_DEFAULTS["timeout"])
+    timeouts.update(charon_config.get("timeout") or {})
+    default_timeout = _parse_timeout(timeouts["default"])
+    settings["timeout"] = {}
+    for verb in ("get", "post", "put", "delete"):
+        if timeouts.get(verb) is not None:
+            settings["timeout"][verb] = _parse_timeout(timeouts[verb])
+        else:
+            settings["timeout"][verb] = default_timeout
+    return settings
+
+
+def _parse_timeout(value):
+    """Return a (connect, read) tuple for a number or a two-element list."""
+    try:
+        if isinstance(value, (list, tuple)):
+            connect, read = value
+            return (float(connect), float(read))
+        return (float(value), float(value))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid Charon timeout value "{}"; must be a number '
+                         'or a [connect, read] pair'.format(value))
+
+
+@with_ngi_config
+def load_charon_instrumentation_settings(config=None, config_file_path=None):
+    """Loads the settings for reporting Charon request statistics at exit
+    from the "instrumentation" part of the "charon" config section:
+
+        charon:
+            instrumentation:
+                log_summary: true
+                # .json for JSON, anything else for OpenMetrics text
+                dump_path: /path/to/charon_requests-{pid}.prom
+
+    :param dict config: The parsed ngi_pipeline config file (optional)
+    :param str config_file_path: The path to the ngi_pipeline config (optional)
+
+    :returns: A dict with the keys "log_summary" and "dump_path"
+    :rtype: dict
+    """
+    instrumentation_config = (config.get("charon") or {}).get("instrumentation") or {}
+    return {"log_summary": bool(instrumentation_config.get("log_summary")),
+            "dump_path": instrumentation_config.get("dump_path")}
@@ -1,5 +1,4 @@
 import collections
-import glob
 import inspect
 import os
 import psutil
@@ -7,18 +6,21 @@ import re
 import time
 
 from ngi_pipeline.conductor.classes import NGIProject
-from ngi_pipeline.database.classes import CharonSession, CharonError
+from ngi_pipeline.database.classes import CharonSession, CharonBatchError, CharonError, \
+                                         is_charon_unavailable
+from ngi_pipeline.database.journal import get_charon_journal
 from ngi_pipeline.log.loggers import minimal_logger
 from ngi_pipeline.utils.communication import mail_analysis
 from ngi_pipeline.engines.piper_ngi.database import SampleAnalysis, get_db_session
 from ngi_pipeline.engines.piper_ngi.utils import create_exit_code_file_path, \
                                                  create_project_obj_from_analysis_log, \
                                                  get_finished_seqruns_for_sample
-from ngi_pipeline.engines.piper_ngi.parsers import parse_genotype_concordance, \
-                                                   parse_mean_coverage_from_qualimap, \
+from ngi_pipeline.engines.piper_ngi.parsers import parse_genotype_concordance_for_sample, \
+                                                   find_qualimap_genome_results, \
+                                                   harvest_qualimap_metrics, \
                                                    parse_deduplication_percentage,\
-                                                   parse_qualimap_reads,\
-                                                   parse_qualimap_coverage
+                                                   parse_qualimap_coverage, \
+                                                   parse_qualimap_reads
 from ngi_pipeline.utils.slurm import get_slurm_job_status, \
                                      kill_slurm_job_by_id
 from ngi_pipeline.utils.parsers import STHLM_UUSNP_SEQRUN_RE, \
@@ -26,6 +28,7 @@ from ngi_pipeline.utils.parsers import STHLM_UUSNP_SEQRUN_RE, \
 from sqlalchemy.exc import IntegrityError, OperationalError
 from ngi_pipeline.utils.charon import recurse_status_for_sample
 from ngi_pipeline.utils.classes import with_ngi_config
+from ngi_pipeline.utils.metrics_cache import use_metrics_cache
 from ngi_pipeline.utils.post_analysis import run_multiqc
 
 
@@ -34,14 +37,45 @@ LOG = minimal_logger(__name__)
 @with_ngi_config
 def update_charon_with_local_jobs_status(quiet=False, config=None, config_file_path=None):
     """Check the status of all locally-tracked jobs and update Charon accordingly.
+
+    Updates that cannot be delivered because Charon is unavailable are kept in
+    the Charon journal and the jobs are considered handled; Charon is not
+    contacted again for the remaining jobs, and the journal is replayed first
+    thing on the next call. While it cannot be drained, the jobs are not
+    checked at all.
     """
     if quiet and not config.get("quiet"):
         config['quiet'] = True
+    charon_session = CharonSession()
+    try:
+        journal = get_charon_journal(config=config)
+    except ValueError as e:
+        LOG.warn("Charon updates will not be journaled: {}".format(e))
+        journal = None
+    if journal is not None and len(journal):
+        if journal.replay(charon_session).remaining:
+            LOG.error("Charon is unavailable; not checking the locally-tracked "
+                      "jobs until the journaled updates have been delivered.")
+            return
+    # Results parsed by earlier sweeps are reused, if so configured
+    use_metrics_cache(config=config)
     LOG.info("Updating Charon with the status of all locally-tracked jobs...")
     multiqc_projects=set()
     with get_db_session() as session:
-        charon_session = CharonSession()
-        for sample_entry in session.query(SampleAnalysis).all():
+        sample_entries = session.query(SampleAnalysis).all()
+        exit_codes = [get_exit_code(workflow_name=sample_entry.workflow,
+                                    project_base_path=sample_entry.project_base_path,
+                                    project_name=sample_entry.project_name,
+                                    project_id=sample_entry.project_id,
+                                    sample_id=sample_entry.sample_id)
+                      for sample_entry in sample_entries]
+        # The lane qc metrics of all the samples that finished alignment are
+        # parsed together up front, one project qc dir at a time
+        qc_metrics = harvest_qc_metrics_for_samples(
+                [sample_entry for sample_entry, exit_code in zip(sample_entries, exit_codes)
+                 if exit_code == 0 and sample_entry.workflow == "merge_process_variantcall"],
+                config=config)
+        for sample_entry, piper_exit_code in zip(sample_entries, exit_codes):
             # Local names
             workflow = sample_entry.workflow
             project_name = sample_entry.project_name
@@ -52,11 +86,6 @@ def update_charon_with_local_jobs_status(quiet=False, config=None, config_file_p
             # Only one of these id fields (slurm, pid) will have a value
             slurm_job_id = sample_entry.slurm_job_id
             process_id = sample_entry.process_id
-            piper_exit_code = get_exit_code(workflow_name=workflow,
-                                            project_base_path=project_base_path,
-                                            project_name=project_name,
-                                            project_id=project_id,
-                                            sample_id=sample_id)
             label = "project/sample {}/{}".format(project_name, sample_id)
 
             if workflow not in ("merge_process_variantcall", "genotype_concordance",):
@@ -85,123 +114,82 @@ def update_charon_with_local_jobs_status(quiet=False, config=None, config_file_p
                                   info_text=error_text,
                                   workflow=workflow)
                 continue
+            delete_local_entry = False
+            batch = None
             try:
-                if piper_exit_code == 0:
-                    # 0 -> Job finished successfully
-                    if workflow == "merge_process_variantcall":
-                        sample_status_field = "analysis_status"
-                        seqrun_status_field = "alignment_status"
-                        set_status = "ANALYZED" # sample level
-                    elif workflow == "genotype_concordance":
-                        sample_status_field = seqrun_status_field = "genotype_status"
-                        set_status = "DONE" # sample level
-                    recurse_status = "DONE" # For the seqrun level
-                    info_text = ('Workflow "{}" for {} finished succesfully. '
-                                 'Recording status {} in Charon'.format(workflow,
-                                                                        label,
-                                                                        set_status))
-                    LOG.info(info_text)
-                    if not config.get('quiet'):
-                        mail_analysis(project_name=project_name,
-                                      sample_name=sample_id,
-                                      engine_name=engine,
-                                      level="INFO",
-                                      info_text=info_text,
-                                      workflow=workflow)
-                    charon_session.sample_update(projectid=project_id,
-                                                 sampleid=sample_id,
-                                                 **{sample_status_field: set_status})
-                    recurse_status_for_sample(project_obj,
-                                              status_field=seqrun_status_field,
-                                              status_value=recurse_status,
-                                              config=config)
-                    # Job is only deleted if the Charon status update succeeds
-                    session.delete(sample_entry)
-                    #add project to MultiQC
-                    multiqc_projects.add((project_base_path, project_id, project_name))
-
-
-                    if workflow == "merge_process_variantcall":
-                        # Parse seqrun output results / update Charon
-                        # This is a semi-optional step -- failure here will send an
-                        # email but not more than once. The record is still removed
-                        # from the local jobs database, so this will have to be done
-                        # manually if you want it done at all.
-                        piper_qc_dir = os.path.join(project_base_path, "ANALYSIS",
-                                                    project_id, "piper_ngi",
-                                                    "02_preliminary_alignment_qc")
-                        update_coverage_for_sample_seqruns(project_id, sample_id,
-                                                           piper_qc_dir)
-                        update_sample_duplication_and_coverage(project_id, sample_id,
-                                                           project_base_path)
+                # Updates to the same Charon document (e.g. status and
+                # coverage) are merged and sent together at the end of the block;
+                # if Charon is down they are journaled and sent later
+                with charon_session.batch_updates(journal=journal) as batch:
+                    if piper_exit_code == 0:
+                        # 0 -> Job finished successfully
+                        if workflow == "merge_process_variantcall":
+                            sample_status_field = "analysis_status"
+                            seqrun_status_field = "alignment_status"
+                            set_status = "ANALYZED" # sample level
+                        elif workflow == "genotype_concordance":
+                            sample_status_field = seqrun_status_field = "genotype_status"
+                            set_status = "DONE" # sample level
+                        recurse_status = "DONE" # For the seqrun level
+                        info_text = ('Workflow "{}" for {} finished succesfully. '
+                                     'Recording status {} in Charon'.format(workflow,
+                                                                            label,
+                                                                            set_status))
+                        LOG.info(info_text)
+                        if not config.get('quiet'):
+                            mail_analysis(project_name=project_name,
+                                          sample_name=sample_id,
+                                          engine_name=engine,
+                                          level="INFO",
+                                          info_text=info_text,
+                                          workflow=workflow)
+                        charon_session.sample_update(projectid=project_id,
+                                                     sampleid=sample_id,
+                                                     **{sample_status_field: set_status})
+                        recurse_status_for_sample(project_obj,
+                                                  status_field=seqrun_status_field,
+                                                  status_value=recurse_status,
+                                                  config=config)
+                        delete_local_entry = True
+                        #add project to MultiQC
+                        multiqc_projects.add((project_base_path, project_id, project_name))
+
+
+                        if workflow == "merge_process_variantcall":
+                            # Parse seqrun output results / update Charon
+                            # This is a semi-optional step -- a parsing failure here will
+                            # send an email but not more than once. The record is still
+                            # removed from the local jobs database, so this will have to be
+                            # done manually if you want it done at all. The resulting
+                            # updates go out with the status updates above, so if Charon
+                            # rejects them the record is kept and retried next time.
+                            piper_qc_dir = get_piper_qc_dir(project_base_path, project_id)
+                            update_coverage_for_sample_seqruns(project_id, sample_id,
+                                                               piper_qc_dir,
+                                                               qc_metrics=qc_metrics.get(piper_qc_dir))
+                            update_sample_duplication_and_coverage(project_id, sample_id,
+                                                               project_base_path)
 
                         
-                    elif workflow == "genotype_concordance":
-                        piper_gt_dir = os.path.join(project_base_path, "ANALYSIS",
-                                                    project_id, "piper_ngi",
-                                                    "03_genotype_concordance")
-                        try:
-                            update_gtc_for_sample(project_id, sample_id, piper_gt_dir)
-                        except (CharonError, IOError, ValueError) as e:
-                            LOG.error(e)
-                elif type(piper_exit_code) is int and piper_exit_code > 0:
-                    # 1 -> Job failed
-                    set_status = "FAILED"
-                    error_text = ('Workflow "{}" for {} failed. Recording status '
-                                  '{} in Charon.'.format(workflow, label, set_status))
-                    LOG.error(error_text)
-                    if not config.get('quiet'):
-                        mail_analysis(project_name=project_name,
-                                      sample_name=sample_id,
-                                      engine_name=engine,
-                                      level="ERROR",
-                                      info_text=error_text,
-                                      workflow=workflow)
-                    if workflow == "merge_process_variantcall":
-                        sample_status_field = "analysis_status"
-                        seqrun_status_field = "alignment_status"
-                    elif workflow == "genotype_concordance":
-                        sample_status_field = seqrun_status_field = "genotype_status"
-                    charon_session.sample_update(projectid=project_id,
-                                                 sampleid=sample_id,
-                                                 **{sample_status_field: set_status})
-                    recurse_status_for_sample(project_obj, status_field=seqrun_status_field,
-                                              status_value=set_status, config=config)
-                    # Job is only deleted if the Charon update succeeds
-                    session.delete(sample_entry)
-                else:
-                    # None -> Job still running OR exit code was never written (failure)
-                    JOB_FAILED = None
-                    if slurm_job_id:
-                        try:
-                            slurm_exit_code = get_slurm_job_status(slurm_job_id)
-                        except ValueError as e:
-                            slurm_exit_code = 1
-                        if slurm_exit_code is not None: # "None" indicates job is still running
-                            JOB_FAILED = True
-                    else:
-                        if not psutil.pid_exists(process_id):
-                            # Job did not write an exit code and is also not running
-                            JOB_FAILED = True
-                    if JOB_FAILED:
+                        elif workflow == "genotype_concordance":
+                            piper_gt_dir = os.path.join(project_base_path, "ANALYSIS",
+                                                        project_id, "piper_ngi",
+                                                        "03_genotype_concordance")
+                            try:
+                                update_gtc_for_sample(project_id, sample_id, piper_gt_dir)
+                            except (CharonError, IOError, ValueError) as e:
+                                LOG.error(e)
+                    elif type(piper_exit_code) is int and piper_exit_code > 0:
+                        # 1 -> Job failed
                         set_status = "FAILED"
-                        error_text = ('No exit code found but job not running '
-                                      'for {} / {}: setting status to {} in '
-                                      'Charon'.format(label, workflow, set_status))
-                        if slurm_job_id:
-                            exit_code_file_path = \
-                                create_exit_code_file_path(workflow_subtask=workflow,
-                                                           project_base_path=project_base_path,
-                                                           project_name=project_name,
-                                                           project_id=project_id,
-                                                           sample_id=sample_id)
-                            error_text += (' (slurm job id "{}", exit code file path '
-                                           '"{}")'.format(slurm_job_id, exit_code_file_path))
+                        error_text = ('Workflow "{}" for {} failed. Recording status '
+                                      '{} in Charon.'.format(workflow, label, set_status))
                         LOG.error(error_text)
                         if not config.get('quiet'):
                             mail_analysis(project_name=project_name,
                                           sample_name=sample_id,
-                                          engine_name=engine, level="ERROR",
+                                          engine_name=engine,
+                                          level="ERROR",
                                           info_text=error_text,
                                           workflow=workflow)
                         if workflow == "merge_process_variantcall":
@@ -212,55 +200,115 @@ def update_charon_with_local_jobs_status(quiet=False, config=None, config_file_p
                         charon_session.sample_update(projectid=project_id,
                                                      sampleid=sample_id,
                                                      **{sample_status_field: set_status})
-                        recurse_status_for_sample(project_obj,
-                                                  status_field=seqrun_status_field,
-                                                  status_value=set_status,
-                                                  config=config)
-                        # Job is only deleted if the Charon update succeeds
-                        LOG.debug("Deleting local entry {}".format(sample_entry))
-                        session.delete(sample_entry)
-                    else: # Job still running
-                        set_status = "UNDER_ANALYSIS"
-                        if workflow == "merge_process_variantcall":
-                            sample_status_field = "analysis_status"
-                            seqrun_status_field = "alignment_status"
-                            recurse_status = "RUNNING"
-                        elif workflow == "genotype_concordance":
-                            sample_status_field = seqrun_status_field = "genotype_status"
-                            recurse_status = "UNDER_ANALYSIS"
-                        try:
-                            remote_sample=charon_session.sample_get(projectid=project_id, sampleid=sample_id)
-                            charon_status = remote_sample.get(sample_status_field)
-                            if charon_status and not charon_status == set_status:
-                                LOG.warn('Tracking inconsistency for {}: Charon status '
-                                         'for field "{}" is "{}" but local process tracking '
-                                         'database indicates it is running. Setting value '
-                                         'in Charon to {}.'.format(label, sample_status_field,
-                                                                   charon_status, set_status))
-                                charon_session.sample_update(projectid=project_id,
-                                                             sampleid=sample_id,
-                                                             **{sample_status_field: set_status})
-                                recurse_status_for_sample(project_obj,
-                                                          status_field=seqrun_status_field,
-                                                          status_value=recurse_status,
-                                                          config=config)
-                        except CharonError as e:
-                            error_text = ('Unable to update/verify Charon '
-                                          'for {}: {}'.format(label, e))
+                        recurse_status_for_sample(project_obj, status_field=seqrun_status_field,
+                                                  status_value=set_status, config=config)
+                        delete_local_entry = True
+                    else:
+                        # None -> Job still running OR exit code was never written (failure)
+                        JOB_FAILED = None
+                        if slurm_job_id:
+                            try:
+                                slurm_exit_code = get_slurm_job_status(slurm_job_id)
+                            except ValueError as e:
+                                slurm_exit_code = 1
+                            if slurm_exit_code is not None: # "None" indicates job is still running
+                                JOB_FAILED = True
+                        else:
+                            if not psutil.pid_exists(process_id):
+                                # Job did not write an exit code and is also not running
+                                JOB_FAILED = True
+                        if JOB_FAILED:
+                            set_status = "FAILED"
+                            error_text = ('No exit code found but job not running '
+                                          'for {} / {}: setting status to {} in '
+                                          'Charon'.format(label, workflow, set_status))
+                            if slurm_job_id:
+                                exit_code_file_path = \
+                                    create_exit_code_file_path(workflow_subtask=workflow,
+                                                               project_base_path=project_base_path,
+                                                               project_name=project_name,
+                                                               project_id=project_id,
+                                                               sample_id=sample_id)
+                                error_text += (' (slurm job id "{}", exit code file path '
+                                               '"{}")'.format(slurm_job_id, exit_code_file_path))
                             LOG.error(error_text)
                             if not config.get('quiet'):
-                                mail_analysis(project_name=project_name, sample_name=sample_id,
+                                mail_analysis(project_name=project_name,
+                                              sample_name=sample_id,
                                               engine_name=engine, level="ERROR",
-                                              workflow=workflow, info_text=error_text)
+                                              info_text=error_text,
+                                              workflow=workflow)
+                            if workflow == "merge_process_variantcall":
+                                sample_status_field = "analysis_status"
+                                seqrun_status_field = "alignment_status"
+                            elif workflow == "genotype_concordance":
+                                sample_status_field = seqrun_status_field = "genotype_status"
+                            charon_session.sample_update(projectid=project_id,
+                                                         sampleid=sample_id,
+                                                         **{sample_status_field: set_status})
+                            recurse_status_for_sample(project_obj,
+                                                      status_field=seqrun_status_field,
+                                                      status_value=set_status,
+                                                      config=config)
+                            delete_local_entry = True
+                        else: # Job still running
+                            set_status = "UNDER_ANALYSIS"
+                            if workflow == "merge_process_variantcall":
+                                sample_status_field = "analysis_status"
+                                seqrun_status_field = "alignment_status"
+                                recurse_status = "RUNNING"
+                            elif workflow == "genotype_concordance":
+                                sample_status_field = seqrun_status_field = "genotype_status"
+                                recurse_status = "UNDER_ANALYSIS"
+                            try:
+                                remote_sample=charon_session.sample_get(projectid=project_id, sampleid=sample_id)
+                                charon_status = remote_sample.get(sample_status_field)
+                                if charon_status and not charon_status == set_status:
+                                    LOG.warn('Tracking inconsistency for {}: Charon status '
+                                             'for field "{}" is "{}" but local process tracking '
+                                             'database indicates it is running. Setting value '
+                                             'in Charon to {}.'.format(label, sample_status_field,
+                                                                       charon_status, set_status))
+                                    charon_session.sample_update(projectid=project_id,
+                                                                 sampleid=sample_id,
+                                                                 **{sample_status_field: set_status})
+                                    recurse_status_for_sample(project_obj,
+                                                              status_field=seqrun_status_field,
+                                                              status_value=recurse_status,
+                                                              config=config)
+                            except CharonError as e:
+                                if is_charon_unavailable(e):
+                                    raise
+                                error_text = ('Unable to update/verify Charon '
+                                              'for {}: {}'.format(label, e))
+                                LOG.error(error_text)
+                                if not config.get('quiet'):
+                                    mail_analysis(project_name=project_name, sample_name=sample_id,
+                                                  engine_name=engine, level="ERROR",
+                                                  workflow=workflow, info_text=error_text)
+                # Job is only deleted if the Charon updates succeed
+                if delete_local_entry:
+                    LOG.debug("Deleting local entry {}".format(sample_entry))
+                    session.delete(sample_entry)
             except CharonError as e:
                 error_text = ('Unable to update Charon for {}: '
                               '{}'.format(label, e))
+                if is_charon_unavailable(e):
+                    error_text += ('; Charon is unavailable, so the remaining jobs '
+                                   'will be checked on the next run')
                 LOG.error(error_text)
                 if not config.get('quiet'):
                     mail_analysis(project_name=project_name, sample_name=sample_id,
                                   engine_name=engine, level="ERROR",
                                   workflow=workflow, info_text=error_text)
+                if is_charon_unavailable(e):
+                    break
             except OSError as e:
+                if delete_local_entry and batch.flush_error is None:
+                    # Parsing the (semi-optional) qc results failed but the
+                    # status updates were still sent (or journaled) when the
+                    # batch closed; if Charon rejected them, the entry is kept
+                    session.delete(sample_entry)
                 error_text = ('Permissions error when trying to update Charon '
                               '"{}" status for "{}": {}'.format(workflow, label, e))
                 LOG.error(error_text)
@@ -268,6 +316,11 @@ def update_charon_with_local_jobs_status(quiet=False, config=None, config_file_p
                     mail_analysis(project_name=project_name, sample_name=sample_id,
                                   engine_name=engine, level="ERROR",
                                   workflow=workflow, info_text=error_text)
+            if batch is not None and batch.unavailable_error is not None:
+                LOG.error('Charon is unavailable ({}); the updates for {} have been '
+                          'journaled and the remaining jobs will be checked on the '
+                          'next run'.format(batch.unavailable_error, label))
+                break
         session.commit()
     #Run Multiqc
     for pj_tuple in multiqc_projects:
@@ -291,9 +344,8 @@ def update_gtc_for_sample(project_id, sample_id, piper_gtc_path, config=None, co
     :raises ValueError: If the specified sample has no data in the gtc file
     """
     gtc_file = os.path.join(piper_gtc_path, "{}.gt_concordance".format(sample_id))
-    try:
-        concordance_value = parse_genotype_concordance(gtc_file)[sample_id]
-    except KeyError:
+    concordance_value = parse_genotype_concordance_for_sample(gtc_file, sample_id)
+    if concordance_value is None:
         raise ValueError('Concordance data for sample "{}" not found in gt '
                          'concordance file "{}"'.format(sample_id, gtc_file))
     gtc_lower_bound = config.get("genotyping", {}).get("lower_bound_cutoff")
@@ -323,9 +375,12 @@ def update_sample_duplication_and_coverage(project_id, sample_id, project_base_p
 
     try:
         dup_pc=parse_deduplication_percentage(dup_file_path)
-    except:
+    except IOError as e:
         dup_pc=0
         LOG.error("Cannot find {}.metrics file for duplication rate at {}. Continuing.".format(sample_id, dup_file_path))
+    except ValueError as e:
+        dup_pc=0
+        LOG.error("Cannot parse duplication rate from {}: {}. Continuing.".format(dup_file_path, e))
     try:
         cov=parse_qualimap_coverage(genome_results_file_path)
         reads=parse_qualimap_reads(genome_results_file_path)
@@ -333,6 +388,10 @@ def update_sample_duplication_and_coverage(project_id, sample_id, project_base_p
         cov=0
         reads=0
         LOG.error("Cannot find genome_results.txt file for sample coverage at {}. Continuing.".format(genome_results_file_path))
+    except ValueError as e:
+        cov=0
+        reads=0
+        LOG.error("Cannot parse sample coverage from {}: {}. Continuing.".format(genome_results_file_path, e))
     try:
         charon_session = CharonSession()
         charon_session.sample_update(projectid=project_id,
@@ -355,8 +414,43 @@ def update_sample_duplication_and_coverage(project_id, sample_id, project_base_p
 
 
 
+def get_piper_qc_dir(project_base_path, project_id):
+    return os.path.join(project_base_path, "ANALYSIS", project_id, "piper_ngi",
+                        "02_preliminary_alignment_qc")
+
+
+@with_ngi_config
+def harvest_qc_metrics_for_samples(sample_entries, config=None, config_file_path=None):
+    """Parse the lane qc metrics of many samples at once, with one listing of
+    each project's Piper qc dir and a bounded pool of processes (the size of
+    which is set by piper.qc_harvest_processes in the config).
+
+    :param list sample_entries: The SampleAnalysis records of the samples
+
+    :returns: The metrics by Piper qc dir, each by (sample_id, fcid)
+    :rtype: dict
+    """
+    sample_ids_by_qc_dir = collections.OrderedDict()
+    for sample_entry in sample_entries:
+        piper_qc_dir = get_piper_qc_dir(sample_entry.project_base_path, sample_entry.project_id)
+        sample_ids_by_qc_dir.setdefault(piper_qc_dir, []).append(sample_entry.sample_id)
+    processes = config.get("piper", {}).get("qc_harvest_processes")
+    qc_metrics = {}
+    for piper_qc_dir, sample_ids in sample_ids_by_qc_dir.items():
+        LOG.info('Harvesting the lane qc metrics of {} samples from "{}"'.format(len(sample_ids),
+                                                                                piper_qc_dir))
+        try:
+            qc_metrics[piper_qc_dir] = harvest_qualimap_metrics(piper_qc_dir, sample_ids,
+                                                                processes=processes)
+        except OSError as e:
+            # e.g. the worker processes could not be started; the samples'
+            # metrics are then parsed one by one as they are updated
+            LOG.warn('Could not harvest the lane qc metrics from "{}": {}'.format(piper_qc_dir, e))
+    return qc_metrics
+
+
 @with_ngi_config
-def update_coverage_for_sample_seqruns(project_id, sample_id, piper_qc_dir,
+def update_coverage_for_sample_seqruns(project_id, sample_id, piper_qc_dir, qc_metrics=None,
                                        config=None, config_file_path=None):
     """Find all the valid seqruns for a particular sample, parse their
     qualimap output files, and update Charon with the mean autosomal
@@ -364,6 +458,9 @@ def update_coverage_for_sample_seqruns(project_id, sample_id, piper_qc_dir,
 
     :param str piper_qc_dir: The path to the Piper qc dir (02_preliminary_alignment_qc at time of writing)
     :param str sample_id: The sample name (e.g. P1170_105)
+    :param dict qc_metrics: The already harvested metrics of piper_qc_dir, from
+                            harvest_qualimap_metrics; seqruns missing from it
+                            are parsed here (optional)
 
     :raises OSError: If the qc path specified is missing or otherwise inaccessible
     :raises ValueError: If arguments are incorrect
@@ -371,38 +468,58 @@ def update_coverage_for_sample_seqruns(project_id, sample_id, piper_qc_dir,
     seqruns_by_libprep = get_finished_seqruns_for_sample(project_id, sample_id)
 
     charon_session = CharonSession()
-    for libprep_id, seqruns in seqruns_by_libprep.iteritems():
-        for seqrun_id in seqruns:
-            label = "{}/{}/{}/{}".format(project_id, sample_id, libprep_id, seqrun_id)
-            genome_results_file_paths=glob.glob(os.path.join(piper_qc_dir, "{}.{}*.qc".format(sample_id, seqrun_id.split('_')[-1]),"genome_results.txt"))
-            ma_coverage = parse_mean_coverage_from_qualimap(piper_qc_dir, sample_id, seqrun_id)
-
-            reads=0
-            for path in genome_results_file_paths:
-                try:
-                    reads += parse_qualimap_reads(path)
-                except IOError as e :
-                    LOG.error("Cannot find the genome_results.txt file to get the number of reads in {}".format(path))
-                except :
-                    LOG.error("Error in handling the genome_results.txt file located at {}".format(path))
-
-            LOG.info('Updating project/sample/libprep/seqrun "{}" in '
-                     'Charon with mean autosomal coverage "{}" and total reads {}'.format(label, ma_coverage, reads))
-            try:
-                charon_session.seqrun_update(projectid=project_id,
-                                             sampleid=sample_id,
-                                             libprepid=libprep_id,
-                                             seqrunid=seqrun_id,
-                                             total_reads=reads,
-                                             mean_autosomal_coverage=ma_coverage)
-            except CharonError as e:
-                error_text = ('Could not update project/sample/libprep/seqrun "{}" '
-                              'in Charon with mean autosomal coverage '
-                              '"{}": {}'.format(label, ma_coverage, e))
-                LOG.error(error_text)
-                if not config.get('quiet'):
-                    mail_analysis(project_name=project_id, sample_name=sample_id,
-                                  engine_name="piper_ngi", level="ERROR", info_text=error_text)
+    coverage_by_label = {}
+    def report_failure(label, error):
+        error_text = ('Could not update project/sample/libprep/seqrun "{}" '
+                      'in Charon with mean autosomal coverage '
+                      '"{}": {}'.format(label, coverage_by_label.get(label), error))
+        LOG.error(error_text)
+        if not config.get('quiet'):
+            mail_analysis(project_name=project_id, sample_name=sample_id,
+                          engine_name="piper_ngi", level="ERROR", info_text=error_text)
+    try:
+        with charon_session.batch_updates() as batch:
+            # Reported when the batch is flushed, which is later if this one is nested
+            batch.add_failure_handler(coverage_by_label, report_failure)
+            for libprep_id, seqruns in seqruns_by_libprep.iteritems():
+                for seqrun_id in seqruns:
+                    label = "{}/{}/{}/{}".format(project_id, sample_id, libprep_id, seqrun_id)
+                    seqrun_metrics = (qc_metrics or {}).get((sample_id, seqrun_id.split("_")[-1]))
+                    if seqrun_metrics is not None:
+                        ma_coverage = seqrun_metrics.mean_autosomal_coverage
+                        reads = seqrun_metrics.total_reads
+                    else:
+                        # Each lane's genome_results.txt is read at most once for both
+                        # coverage and reads, and not at all if they are cached
+                        ma_coverage = 0
+                        reads = 0
+                        for path in find_qualimap_genome_results(piper_qc_dir, sample_id, seqrun_id):
+                            # A lane that cannot be parsed is reported and left out
+                            try:
+                                ma_coverage += parse_qualimap_coverage(path)
+                                reads += parse_qualimap_reads(path)
+                            except (IOError, ValueError) as e:
+                                error_text = ('Cannot parse the Qualimap genome_results.txt '
+                                              'file "{}" for project/sample/libprep/seqrun '
+                                              '"{}": {}'.format(path, label, e))
+                                LOG.error(error_text)
+                                if not config.get('quiet'):
+                                    mail_analysis(project_name=project_id, sample_name=sample_id,
+                                                  engine_name="piper_ngi", level="ERROR",
+                                                  info_text=error_text)
+
+                    LOG.info('Updating project/sample/libprep/seqrun "{}" in '
+                             'Charon with mean autosomal coverage "{}" and total reads {}'.format(label, ma_coverage, reads))
+                    coverage_by_label[label] = ma_coverage
+                    charon_session.seqrun_update(projectid=project_id,
+                                                 sampleid=sample_id,
+                                                 libprepid=libprep_id,
+                                                 seqrunid=seqrun_id,
+                                                 total_reads=reads,
+                                                 mean_autosomal_coverage=ma_coverage)
+    except CharonBatchError:
+        # Already reported
+        pass
 
 
 
@@ -460,20 +577,22 @@ def record_process_sample(project, sample, workflow_subtask, analysis_module_nam
         try:
             LOG.info('Updating Charon status for project/sample '
                      '{}/{} key : {} value : {}'.format(project, sample, sample_status_field, sample_status_value))
-            CharonSession().sample_update(projectid=project.project_id,
-                                          sampleid=sample.name,
-                                          **{sample_status_field: sample_status_value,
-                                              sample_data_status_field: sample_data_status_value})
-            project_obj = create_project_obj_from_analysis_log(project.name,
-                                                               project.project_id,
-                                                               project.base_path,
-                                                               sample.name,
-                                                               workflow_subtask)
-            recurse_status_for_sample(project_obj,
-                                      status_field=seqrun_status_field,
-                                      status_value=seqrun_status_value,
-                                      extra_args=extra_args,
-                                      config=config)
+            charon_session = CharonSession()
+            with charon_session.batch_updates():
+                charon_session.sample_update(projectid=project.project_id,
+                                             sampleid=sample.name,
+                                             **{sample_status_field: sample_status_value,
+                                                 sample_data_status_field: sample_data_status_value})
+                project_obj = create_project_obj_from_analysis_log(project.name,
+                                                                   project.project_id,
+                                                                   project.base_path,
+                                                                   sample.name,
+                                                                   workflow_subtask)
+                recurse_status_for_sample(project_obj,
+                                          status_field=seqrun_status_field,
+                                          status_value=seqrun_status_value,
+                                          extra_args=extra_args,
+                                          config=config)
         except CharonError as e:
             error_text = ('Could not update Charon status for project/sample '
                           '{}/{} due to error: {}'.format(project, sample, e))
@@ -1,10 +1,15 @@
 """Here we will keep results parsers for the various output files produced by Piper."""
 import glob
+import gzip
+import multiprocessing
 import os
 import sys
 
 from collections import namedtuple
 from ngi_pipeline.log.loggers import minimal_logger
+from ngi_pipeline.utils.classes import memoized
+from ngi_pipeline.utils.filesystem import list_dir_entries
+from ngi_pipeline.utils.metrics_cache import PARSED_METRICS
 
 
 LOG = minimal_logger(__name__)
@@ -20,40 +25,90 @@ def parse_results_for_workflow(workflow_name, *args, **kwargs):
         raise NotImplementedError(error_msg)
     return parser_function(*args, **kwargs)
 
-def parse_qualimap_reads(genome_results_file):
-    globals_section= False
-    with open(genome_results_file, 'r') as f:
-        for line in f:
-            if line.startswith('>>>>>>> Globals'):
-                globals_section= True
-                continue
-            if globals_section:
-                if 'number of reads' in line:
-                    return int(line.split('=')[-1].strip().replace(',',''))
-    return 0
+# One line of the "Coverage per contig" section of a Qualimap genome_results.txt
+ContigCoverage = namedtuple('ContigCoverage', ['length', 'mapped_bases', 'mean_coverage',
+                                               'std_coverage'])
 
-    
+# The metrics in a Qualimap genome_results.txt; None where missing
+QualimapGenomeResults = namedtuple('QualimapGenomeResults',
+                                   ['reads', 'mapped_reads', 'duplicated_reads', 'mapped_bases',
+                                    'mean_coverage', 'std_coverage', 'contig_coverage',
+                                    'autosomal_coverage'])
 
-def parse_qualimap_coverage(genome_results_file):
+
+def _qualimap_number(value, convert=int):
+    """ "707,908,787 (98.8%)" -> 707908787, "33.5053X" -> 33.5053 """
+    if value is None:
+        return None
+    return convert(value.split()[0].replace(',', '').rstrip('X'))
+
+
+@memoized(maxsize=1024, validate_paths=True)
+def parse_qualimap_genome_results(genome_results_file):
+    """Read a Qualimap genome_results.txt once and return all the metrics
+    used by the pipeline. The result is reused until the file changes.
+
+    :param str genome_results_file: The path to the genome_results.txt file
+
+    :returns: The metrics; contig_coverage maps contig name to ContigCoverage (rows
+              that are not numeric are skipped) and autosomal_coverage is the mean
+              coverage of contigs 1-22 (0.0 if there are none)
+    :rtype: QualimapGenomeResults
+    :raises IOError: If the file cannot be read
+    :raises ValueError: If one of the global metrics is not a number
+    """
+    values = {}
+    contig_coverage = {}
     autosomal_cov_length = 0
     autosomal_cov_bases = 0
-    coverage_section = False
+    section = None
     with open(genome_results_file, 'r') as f:
         for line in f:
-            if line.startswith('>>>>>>> Coverage per contig'):
-                coverage_section = True
-                continue
-            if coverage_section:
-                line = line.strip()
-                if line:
-                    sections = line.split()
-                    if sections[0].isdigit() and int(sections[0]) <= 22:
-                        autosomal_cov_length += float(sections[1])
-                        autosomal_cov_bases += float(sections[2])
-        if autosomal_cov_length and autosomal_cov_bases:
-            return autosomal_cov_bases / autosomal_cov_length
-        else:
-            return 0.0
+            if line.startswith('>>>>>>>'):
+                section = line[7:].strip()
+            elif section == 'Coverage per contig':
+                fields = line.split()
+                try:
+                    if len(fields) >= 5:
+                        coverage = ContigCoverage(float(fields[1]), float(fields[2]),
+                                                  float(fields[3]), float(fields[4]))
+                    elif len(fields) >= 3:
+                        coverage = ContigCoverage(float(fields[1]), float(fields[2]), None, None)
+                    else:
+                        continue
+                except ValueError:
+                    # Not a contig row (e.g. the column names)
+                    continue
+                contig_coverage[fields[0]] = coverage
+                if fields[0].isdigit() and int(fields[0]) <= 22:
+                    autosomal_cov_length += coverage.length
+                    autosomal_cov_bases += coverage.mapped_bases
+            elif section in ('Globals', 'Coverage'):
+                key, sep, value = line.partition('=')
+                if sep:
+                    values.setdefault(key.strip(), value.strip())
+    duplicated_reads = next((value for key, value in values.items()
+                             if key.startswith('number of duplicated reads')), None)
+    return QualimapGenomeResults(
+            reads=_qualimap_number(values.get('number of reads')),
+            mapped_reads=_qualimap_number(values.get('number of mapped reads')),
+            duplicated_reads=_qualimap_number(duplicated_reads),
+            mapped_bases=_qualimap_number(values.get('number of mapped bases')),
+            mean_coverage=_qualimap_number(values.get('mean coverageData'), float),
+            std_coverage=_qualimap_number(values.get('std coverageData'), float),
+            contig_coverage=contig_coverage,
+            autosomal_coverage=(autosomal_cov_bases / autosomal_cov_length
+                                if autosomal_cov_length and autosomal_cov_bases else 0.0))
+
+
+@PARSED_METRICS.cached("qualimap_reads")
+def parse_qualimap_reads(genome_results_file):
+    return parse_qualimap_genome_results(genome_results_file).reads or 0
+
+
+@PARSED_METRICS.cached("qualimap_coverage")
+def parse_qualimap_coverage(genome_results_file):
+    return parse_qualimap_genome_results(genome_results_file).autosomal_coverage
 
 
 def parse_mean_autosomal_coverage_for_sample(piper_qc_dir, sample_id):
@@ -88,6 +143,26 @@ def parse_mean_coverage_from_qualimap(piper_qc_dir, sample_id, seqrun_id=None, f
     :raises OSError: If the qc path specified is missing or otherwise inaccessible
     :raises ValueError: If arguments are incorrect
     """
+    return sum(parse_qualimap_coverage(genome_result) for genome_result in
+               find_qualimap_genome_results(piper_qc_dir, sample_id, seqrun_id, fcid))
+
+
+def find_qualimap_genome_results(piper_qc_dir, sample_id, seqrun_id=None, fcid=None):
+    """Find the genome_results.txt of each lane of a sample OR seqrun (if
+    seqrun_id is passed) in piper_qc_dir.
+
+    :param str piper_qc_dir: The path to the Piper qc dir (02_preliminary_alignment_qc at time of writing)
+    :param str sample_id: The sample name (e.g. P1170_105)
+    :param str seqrun_id: The run id (e.g. 140821_D00458_0029_AC45JGANXX) (optional) (specify either this or fcid)
+    :param str fcid: The FCID (optional) (specify either this or seqrun_id)
+
+    :returns: The paths to the genome_results.txt files
+    :rtype: list
+
+    :raises OSError: If the qc path specified is missing or otherwise inaccessible,
+                     or if any of the lanes is missing its genome_results.txt
+    :raises ValueError: If arguments are incorrect
+    """
     try:
         if seqrun_id and fcid and (fcid != seqrun_id.split("_")[3]):
             raise ValueError(('seqrun_id and fcid both passed as arguments but do not '
@@ -114,74 +189,320 @@ def parse_mean_coverage_from_qualimap(piper_qc_dir, sample_id, seqrun_id=None, f
         piper_qc_dirs = glob.glob(piper_qc_path)
         if not piper_qc_dirs: # Something went wrong in the alignment or we can't parse the file format
             raise OSError('Piper qc directories under "{}" are missing or in an unexpected format when updating stats to Charon.'.format(piper_qc_path))
-    mean_autosomal_coverage = 0
-    # Examine each lane and update the dict with its alignment metrics
+    genome_results = []
     for qc_lane in piper_qc_dirs:
         genome_result = os.path.join(qc_lane, "genome_results.txt")
         # This means that if any of the lanes are missing results, the sequencing run is marked as a failure.
         if not os.path.isfile(genome_result):
             raise OSError('File "genome_results.txt" is missing from Piper result directory "{}"'.format(piper_qc_dir))
-        # Get the alignment results for this lane
-        mean_autosomal_coverage += parse_qualimap_coverage(genome_result)
-    return mean_autosomal_coverage
+        genome_results.append(genome_result)
+    return genome_results
 
+# The per-lane Qualimap metrics of a seqrun, summed over its lanes
+QualimapSeqrunMetrics = namedtuple('QualimapSeqrunMetrics', ['mean_autosomal_coverage',
+                                                             'total_reads', 'genome_results'])
 
+# The most processes harvest_qualimap_metrics uses by default, and the fewest
+# files worth handing to each of them
+QUALIMAP_HARVEST_PROCESSES = 4
+QUALIMAP_FILES_PER_PROCESS = 16
 
-def parse_genotype_concordance(genotype_concordance_file):
-    genotype_concordance_file = os.path.realpath(genotype_concordance_file)
-    concordance_data = []
-    gt_values_list = []
-    with open(genotype_concordance_file, 'r') as f:
-        for line in iter(f.readline, ''):
-            header_location = None
-            if line.startswith("#:GATKTable:GenotypeConcordance_Summary"):
-                header_values = [h.strip() for h in f.readline().strip().split('  ') if h.strip()]
-                header_values = [h.lower().replace("-", "_").replace(" ", "_") for h in header_values]
-                GTValue = namedtuple('GTValue', header_values)
-                f.readline() # Skip first ("ALL") summary line
-                data_location = f.tell()
+
+def _parse_lane_genome_results(genome_results_file):
+    """Parse one lane's genome_results.txt in a worker process. Only the
+    metrics summed per seqrun are sent back, as pickling the per-contig
+    coverage costs more than parsing it, with the file's size and mtime so
+    that they can be cached; errors are returned rather than raised so that
+    one bad lane does not stop the pool."""
+    try:
+        st = os.stat(genome_results_file)
+        genome_results = parse_qualimap_genome_results(genome_results_file)
+    except (IOError, OSError, ValueError) as e:
+        return genome_results_file, None, None, str(e)
+    return (genome_results_file, (genome_results.autosomal_coverage, genome_results.reads or 0),
+            (st.st_size, st.st_mtime), None)
+
+
+def find_qualimap_lane_dirs(piper_qc_dir, sample_ids):
+    """Find the lane qc directories of each sample and flowcell with a single
+    listing of piper_qc_dir. The directories are named
+    <sample>.<fcid>.<sample>.<lane>...; as in find_qualimap_genome_results,
+    the sample name may have its first underscore replaced by a hyphen, which
+    is only looked for if no directories use the name as it is.
+
+    :param str piper_qc_dir: The path to the Piper qc dir (02_preliminary_alignment_qc at time of writing)
+    :param list sample_ids: The sample names (e.g. P1170_105)
+
+    :returns: The paths to the lane directories by (sample_id, fcid)
+    :rtype: dict
+    """
+    sample_by_dir_name = {}
+    for sample_id in sample_ids:
+        sample_by_dir_name[sample_id] = (sample_id, False)
+        sample_by_dir_name.setdefault(sample_id.replace('_', '-', 1), (sample_id, True))
+    lane_dirs = {}
+    for entry in list_dir_entries(piper_qc_dir):
+        fields = entry.name.split('.', 3)
+        if len(fields) < 3 or not fields[2].startswith(fields[0]) or not entry.is_dir():
+            continue
+        sample_id, hyphenated = sample_by_dir_name.get(fields[0], (None, None))
+        if sample_id is not None:
+            lane_dirs.setdefault((sample_id, fields[1]), ([], []))[hyphenated].append(entry.path)
+    return {key: (lanes or hyphenated_lanes)
+            for key, (lanes, hyphenated_lanes) in lane_dirs.items()}
+
+
+def harvest_qualimap_metrics(piper_qc_dir, sample_ids, processes=None):
+    """Collect the per-lane Qualimap metrics of many samples at once: their
+    lane directories are found with one listing of piper_qc_dir and their
+    genome_results.txt files are parsed in parallel by a bounded pool of
+    processes (in this process if there are only a few files).
+
+    Seqruns with a lane whose genome_results.txt cannot be read are left out,
+    as are samples with no lane directories; find_qualimap_genome_results
+    gives the reason for these.
+
+    :param str piper_qc_dir: The path to the Piper qc dir (02_preliminary_alignment_qc at time of writing)
+    :param list sample_ids: The sample names (e.g. P1170_105)
+    :param int processes: The maximum number of worker processes (default QUALIMAP_HARVEST_PROCESSES)
+
+    :returns: The metrics of each seqrun by (sample_id, fcid)
+    :rtype: dict of QualimapSeqrunMetrics
+    """
+    lane_dirs = find_qualimap_lane_dirs(piper_qc_dir, sample_ids)
+    # Files parsed before (see utils.metrics_cache) are not parsed again
+    parsed = {}
+    genome_results_files = []
+    for key in sorted(lane_dirs):
+        for lane_dir in lane_dirs[key]:
+            genome_results_file = os.path.join(lane_dir, "genome_results.txt")
+            coverage = PARSED_METRICS.get("qualimap_coverage", genome_results_file)
+            reads = PARSED_METRICS.get("qualimap_reads", genome_results_file)
+            if coverage is None or reads is None:
+                genome_results_files.append(genome_results_file)
+            else:
+                parsed[genome_results_file] = ((coverage, reads), None)
+    if processes is None:
+        processes = min(QUALIMAP_HARVEST_PROCESSES, multiprocessing.cpu_count())
+    processes = min(int(processes), len(genome_results_files) // QUALIMAP_FILES_PER_PROCESS)
+    if processes > 1:
+        LOG.info("Parsing {} Qualimap genome_results.txt files with {} "
+                 "processes".format(len(genome_results_files), processes))
+        pool = multiprocessing.Pool(processes)
+        try:
+            chunksize = max(1, len(genome_results_files) // (processes * 4))
+            lane_results = list(pool.imap_unordered(_parse_lane_genome_results,
+                                                    genome_results_files, chunksize))
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        lane_results = map(_parse_lane_genome_results, genome_results_files)
+    for genome_results_file, results, file_stat, error in lane_results:
+        parsed[genome_results_file] = (results, error)
+        if results is not None:
+            PARSED_METRICS.put("qualimap_coverage", genome_results_file, results[0], file_stat)
+            PARSED_METRICS.put("qualimap_reads", genome_results_file, results[1], file_stat)
+    metrics = {}
+    for key, lanes in lane_dirs.items():
+        ma_coverage = 0
+        reads = 0
+        genome_results = []
+        for lane_dir in lanes:
+            genome_results_file = os.path.join(lane_dir, "genome_results.txt")
+            results, error = parsed[genome_results_file]
+            if results is None:
+                LOG.warn('Not harvesting Qualimap metrics for sample "{}" flowcell "{}": '
+                         '{}'.format(key[0], key[1], error))
+                break
+            ma_coverage += results[0]
+            reads += results[1]
+            genome_results.append(genome_results_file)
+        else:
+            metrics[key] = QualimapSeqrunMetrics(ma_coverage, reads, genome_results)
+    return metrics
+
+
+GTC_SUMMARY_HEADER = "#:GATKTable:GenotypeConcordance_Summary"
+
+
+def iter_genotype_concordance(genotype_concordance_file, sample_ids=None):
+    """Read the overall genotype concordance of each sample from the summary
+    section of a GATK GenotypeConcordance table, in one pass over the file
+    and stopping at the end of the section.
+
+    :param str genotype_concordance_file: The path to the concordance table
+    :param set sample_ids: Only these samples; reading stops once all are found (optional)
+
+    :returns: The sample names and concordance values, in file order
+    :rtype: generator of (str, float)
+    :raises IOError: If the file cannot be read
+    :raises ValueError: If the file has no summary section
+    """
+    remaining = set(sample_ids) if sample_ids is not None else None
+    with open(os.path.realpath(genotype_concordance_file), 'r') as f:
+        for line in f:
+            if line.startswith(GTC_SUMMARY_HEADER):
                 break
         else:
             raise ValueError('Unable to find genotype concordance summary '
                              'section in genotype file "{}"'.format(genotype_concordance_file))
-    with open(genotype_concordance_file, 'r') as f:
-        f.seek(data_location)
-        for line in iter(f.readline, ''):
-            if line.strip() != "":
-                try:
-                    gt_values_list.append(GTValue._make(line.strip().split()))
-                except TypeError as e:
-                    LOG.error('Unable to parse genotype concordance line "{}"; number '
-                              'of data fields does not match number of header fields '
-                              'fields ({}); skipping'.format(" ".join(line.strip().split()), e))
-                    continue
-            else:
+        header_values = [h.strip().lower().replace("-", "_").replace(" ", "_")
+                         for h in next(f, "").strip().split('  ') if h.strip()]
+        try:
+            sample_index = header_values.index("sample")
+            concordance_index = header_values.index("overall_genotype_concordance")
+        except ValueError:
+            raise ValueError('Unexpected genotype concordance summary header in genotype '
+                             'file "{}": {}'.format(genotype_concordance_file, header_values))
+        next(f, None) # Skip first ("ALL") summary line
+        for line in f:
+            fields = line.split()
+            if not fields:
                 break
-    samples_gtc_dict = {}
-    for gt_entry in gt_values_list:
+            if len(fields) != len(header_values):
+                LOG.error('Unable to parse genotype concordance line "{}"; number '
+                          'of data fields does not match number of header fields '
+                          'fields ({})'.format(" ".join(fields), len(header_values)))
+                continue
+            sample = fields[sample_index]
+            if remaining is not None and sample not in remaining:
+                continue
+            try:
+                concordance = float(fields[concordance_index])
+            except ValueError:
+                LOG.error('Unable to parse overall genotype concordance '
+                          'value for sample "{}" (value "{}" is not a '
+                          'number)'.format(sample, fields[concordance_index]))
+                continue
+            yield sample, concordance
+            if remaining is not None:
+                remaining.discard(sample)
+                if not remaining:
+                    return
+
+
+@PARSED_METRICS.cached("genotype_concordance")
+def parse_genotype_concordance(genotype_concordance_file):
+    return dict(iter_genotype_concordance(genotype_concordance_file))
+
+
+def parse_genotype_concordance_for_sample(genotype_concordance_file, sample_id):
+    """The overall genotype concordance of one sample, without reading the
+    other samples' rows of the table (unless they are already cached).
+
+    :param str genotype_concordance_file: The path to the concordance table
+    :param str sample_id: The sample name
+
+    :returns: The concordance value, or None if the sample is not in the table
+    :rtype: float
+    :raises IOError: If the file cannot be read
+    :raises ValueError: If the file has no summary section
+    """
+    samples_gtc_dict = PARSED_METRICS.get("genotype_concordance", genotype_concordance_file)
+    if samples_gtc_dict is not None:
+        return samples_gtc_dict.get(sample_id)
+    kind = "genotype_concordance:{}".format(sample_id)
+    concordance = PARSED_METRICS.get(kind, genotype_concordance_file)
+    if concordance is None:
+        for _, concordance in iter_genotype_concordance(genotype_concordance_file, [sample_id]):
+            PARSED_METRICS.put(kind, genotype_concordance_file, concordance)
+    return concordance
+
+def _picard_value(value):
+    """ "123" -> 123, "0.0123" -> 0.0123, "" or "?" -> None, other strings as they are """
+    if value in ("", "?"):
+        return None
+    try:
+        return int(value)
+    except ValueError:
         try:
-            samples_gtc_dict[gt_entry.sample] = float(gt_entry.overall_genotype_concordance)
-        except ValueError as e:
-            LOG.error('Unable to parse overall genotype concordance '
-                      'value for sample "{}" (value "{}" is not a '
-                      'number)'.format(gt_entry.sample,
-                                       gt_entry.overall_genotype_concordance))
-            continue
-    return samples_gtc_dict
+            return float(value)
+        except ValueError:
+            return value
+
+
+def parse_picard_metrics(metrics_file, metrics_class="DuplicationMetrics"):
+    """Read the rows of the METRICS CLASS block of a Picard metrics file,
+    which may be gzip-compressed. Reading stops at the end of the block, so
+    the histogram following it is not read.
+
+    :param str metrics_file: The path to the metrics file
+    :param str metrics_class: The class of the metrics, with or without its package
+                              (e.g. "DuplicationMetrics" or "picard.sam.DuplicationMetrics")
+
+    :returns: One dict per row (e.g. per library), mapping column name to value;
+              numbers are ints or floats and empty values None
+    :rtype: list of dict
+    :raises IOError: If the file cannot be read
+    :raises ValueError: If the file has no such block or the block is malformed
+    """
+    # Tell gzip files by their magic bytes rather than by a failed read
+    with open(metrics_file, 'rb') as f:
+        is_gzipped = f.read(2) == b"\x1f\x8b"
+    f = gzip.open(metrics_file, 'rb') if is_gzipped else open(metrics_file, 'r')
+    with f:
+        for line in f:
+            if line.startswith("## METRICS CLASS"):
+                class_name = line[len("## METRICS CLASS"):].strip()
+                if class_name == metrics_class or class_name.endswith("." + metrics_class):
+                    break
+        else:
+            raise ValueError('No "{}" metrics found in Picard metrics file '
+                             '"{}"'.format(metrics_class, metrics_file))
+        headers = next(f, "").rstrip("\r\n").split("\t")
+        if not headers[0] or headers[0].startswith("#"):
+            raise ValueError('The "{}" metrics in Picard metrics file "{}" have no '
+                             'header'.format(metrics_class, metrics_file))
+        rows = []
+        for line_num, line in enumerate(f, 1):
+            line = line.rstrip("\r\n")
+            if not line or line.startswith("#"):
+                break
+            values = line.split("\t")
+            if len(values) > len(headers):
+                raise ValueError('Row {} of the "{}" metrics in Picard metrics file "{}" has '
+                                 '{} values for {} columns'.format(line_num, metrics_class,
+                                                                    metrics_file, len(values),
+                                                                    len(headers)))
+            # Trailing empty values may be left out
+            values += [""] * (len(headers) - len(values))
+            rows.append(dict(zip(headers, map(_picard_value, values))))
+    return rows
+
+
+@PARSED_METRICS.cached("duplication_metrics")
+def parse_duplication_metrics(deduplication_file):
+    """Read the DuplicationMetrics (READ_PAIRS_EXAMINED, PERCENT_DUPLICATION,
+    ESTIMATED_LIBRARY_SIZE, ...) of the first library in a Picard
+    MarkDuplicates metrics file, which may be gzip-compressed.
+
+    :param str deduplication_file: The path to the metrics file
 
+    :returns: The metrics by column name
+    :rtype: dict
+    :raises IOError: If the file cannot be read
+    :raises ValueError: If the file has no DuplicationMetrics or they are malformed
+    """
+    rows = parse_picard_metrics(deduplication_file, "DuplicationMetrics")
+    if not rows:
+        raise ValueError('The DuplicationMetrics in Picard metrics file "{}" '
+                         'have no values'.format(deduplication_file))
+    return rows[0]
+
+
+@PARSED_METRICS.cached("deduplication_percentage")
 def parse_deduplication_percentage(deduplication_file):
+    """The percentage of duplicates in a Picard MarkDuplicates metrics file.
 
-    duplication_percentage=0
-    with open(deduplication_file, 'r') as f:
-        for line in iter(f.readline, ''):
-            if "## METRICS CLASS" in line and "picard.sam.DuplicationMetrics" in line:
-                try:
-                    headers=f.readline()
-                    values=f.readline()
-                    duplication_rate=values.split()[headers.split().index("PERCENT_DUPLICATION")]
-                    duplication_percentage=float(duplication_rate)*100
-                except:
-                    LOG.error("Unable to parse deduplication rate")
-                    continue
+    :param str deduplication_file: The path to the metrics file
 
-    return duplication_percentage
+    :rtype: float
+    :raises IOError: If the file cannot be read
+    :raises ValueError: If the file has no DuplicationMetrics or they are malformed
+    """
+    percent_duplication = parse_duplication_metrics(deduplication_file).get("PERCENT_DUPLICATION")
+    if not isinstance(percent_duplication, (int, float)):
+        raise ValueError('No PERCENT_DUPLICATION in the DuplicationMetrics in Picard metrics '
+                         'file "{}"'.format(deduplication_file))
+    return percent_duplication * 100
@@ -8,7 +8,7 @@ import subprocess
 import yaml
 
 from ngi_pipeline.conductor.classes import NGIProject
-from ngi_pipeline.database.classes import CharonSession
+from ngi_pipeline.database.mirror import get_charon_read_session
 from ngi_pipeline.log.loggers import log_process_non_blocking, minimal_logger
 from ngi_pipeline.utils.filesystem import execute_command_line, rotate_file, safe_makedir
 
@@ -234,21 +234,14 @@ def get_finished_seqruns_for_sample(project_id, sample_id,
     :returns: A dict of {libprep_01: [seqrun_01, ..., seqrun_nn], ...}
     :rtype: dict
     """
-    charon_session = CharonSession()
-    sample_libpreps = charon_session.sample_get_libpreps(projectid=project_id,
-                                                         sampleid=sample_id)
+    charon_tree = get_charon_read_session().sample_get_tree(project_id, sample_id)
     libpreps = collections.defaultdict(list)
-    for libprep in sample_libpreps['libpreps']:
+    for libprep in charon_tree.get_libpreps(sample_id):
         if libprep.get('qc') != "FAILED" or include_failed_libpreps:
             libprep_id = libprep['libprepid']
-            for seqrun in charon_session.libprep_get_seqruns(projectid=project_id,
-                                                             sampleid=sample_id,
-                                                             libprepid=libprep_id)['seqruns']:
+            for seqrun in charon_tree.get_seqruns(sample_id, libprep_id):
                 seqrun_id = seqrun['seqrunid']
-                aln_status = charon_session.seqrun_get(projectid=project_id,
-                                                       sampleid=sample_id,
-                                                       libprepid=libprep_id,
-                                                       seqrunid=seqrun_id).get('alignment_status')
+                aln_status = seqrun.get('alignment_status')
                 if aln_status == "DONE":
                     libpreps[libprep_id].append(seqrun_id)
                 else:
@@ -280,22 +273,15 @@ def get_valid_seqruns_for_sample(project_id, sample_id,
         raise ValueError('"status_field" argument must be one of {} '
                          '(value passed was "{}")'.format(", ".join(valid_status_values),
                                                           status_field))
-    charon_session = CharonSession()
-    sample_libpreps = charon_session.sample_get_libpreps(projectid=project_id,
-                                                         sampleid=sample_id)
+    charon_tree = get_charon_read_session().sample_get_tree(project_id, sample_id)
     libpreps = collections.defaultdict(list)
-    for libprep in sample_libpreps['libpreps']:
+    for libprep in charon_tree.get_libpreps(sample_id):
         if libprep.get('qc') != "FAILED" or include_failed_libpreps:
             libprep_id = libprep['libprepid']
-            for seqrun in charon_session.libprep_get_seqruns(projectid=project_id,
-                                                             sampleid=sample_id,
-                                                             libprepid=libprep_id)['seqruns']:
+            for seqrun in charon_tree.get_seqruns(sample_id, libprep_id):
                 seqrun_id = seqrun['seqrunid']
                 try:
-                    aln_status = charon_session.seqrun_get(projectid=project_id,
-                                                           sampleid=sample_id,
-                                                           libprepid=libprep_id,
-                                                           seqrunid=seqrun_id)[status_field]
+                    aln_status = seqrun[status_field]
                 except KeyError:
                     LOG.error('Field "{}" not available for seqrun "{}" in Charon '
                               'for project "{}" / sample "{}". Including as '
@@ -370,27 +356,18 @@ def check_for_preexisting_sample_runs(project_obj, sample_obj,
     """
     project_id = project_obj.project_id
     sample_id = sample_obj.name
-    charon_session = CharonSession()
-    sample_libpreps = charon_session.sample_get_libpreps(projectid=project_id,
-                                                         sampleid=sample_id)
-    for libprep in sample_libpreps['libpreps']:
-        libprep_id = libprep['libprepid']
-        for seqrun in charon_session.libprep_get_seqruns(projectid=project_id,
-                                                         sampleid=sample_id,
-                                                         libprepid=libprep_id)['seqruns']:
-            seqrun_id = seqrun['seqrunid']
-            aln_status = charon_session.seqrun_get(projectid=project_id,
-                                                   sampleid=sample_id,
-                                                   libprepid=libprep_id,
-                                                   seqrunid=seqrun_id).get(status_field)
-            if (aln_status == "RUNNING" or aln_status == "UNDER_ANALYSIS" and \
-                not restart_running_jobs) or \
-                (aln_status == "DONE" and not restart_finished_jobs):
-                raise RuntimeError('Project/Sample "{}/{}" has a preexisting '
-                                   'seqrun "{}" with status "{}"'.format(project_obj,
-                                                                         sample_obj,
-                                                                         seqrun_id,
-                                                                         aln_status))
+    charon_tree = get_charon_read_session().sample_get_tree(project_id, sample_id)
+    for _, libprep_id, seqrun in charon_tree.iter_seqruns(sample_id):
+        seqrun_id = seqrun['seqrunid']
+        aln_status = seqrun.get(status_field)
+        if (aln_status == "RUNNING" or aln_status == "UNDER_ANALYSIS" and \
+            not restart_running_jobs) or \
+            (aln_status == "DONE" and not restart_finished_jobs):
+            raise RuntimeError('Project/Sample "{}/{}" has a preexisting '
+                               'seqrun "{}" with status "{}"'.format(project_obj,
+                                                                     sample_obj,
+                                                                     seqrun_id,
+                                                                     aln_status))
 
 
 SBATCH_HEADER = """#!/bin/bash -l
@@ -1,13 +1,13 @@
 """QC workflow-specific code."""
 
 import os
-import re
 import shlex
 import subprocess
 import sys
 
 from ngi_pipeline.log.loggers import minimal_logger
 from ngi_pipeline.utils.classes import with_ngi_config
+from ngi_pipeline.utils.fastq import parse_fastq_names
 from ngi_pipeline.utils.filesystem import load_modules, safe_makedir
 from ngi_pipeline.utils.pyutils import flatten
 
@@ -195,15 +195,12 @@ def fastq_to_be_analysed(fastq_files, analysis_dir, output_footers):
     """
     #inititialise empty list
     fastq_to_analyze = []
-    for fastq_file in fastq_files:
-        m = re.match(r'([\w-]+).(fastq.*)', os.path.basename(fastq_file))
-        #fetch the FCid
-        fc_id = os.path.dirname(fastq_file).split("_")[-1]
-        if not m:
-            # fastq file name doesn't match expected pattern -- let be serious.. we do NOT process it
-            continue
-        linked_fastq_file_base = '{}_{}'.format(m.groups()[0], fc_id)
-        linked_fastq_file_name = '{}_{}.{}'.format( m.groups()[0], fc_id, m.groups()[1])
+    # fastq files whose names don't end in a fastq suffix -- let be serious.. we do NOT process them
+    for fastq_name in parse_fastq_names(fastq_files):
+        fastq_file = fastq_name.path
+        #the FCid is taken from the seqrun directory
+        linked_fastq_file_base = '{}_{}'.format(fastq_name.stem, fastq_name.flowcell)
+        linked_fastq_file_name = '{}.{}'.format(linked_fastq_file_base, fastq_name.suffix)
         linked_fastq_file_path = os.path.join(analysis_dir, linked_fastq_file_name)
         for output_file_tmpl in output_footers:
             output_file = os.path.join(analysis_dir, output_file_tmpl.format(linked_fastq_file_base))
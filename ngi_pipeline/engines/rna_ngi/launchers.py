@@ -1,12 +1,13 @@
-import re
 import os
 import glob
+import operator
 import shutil
 
 from ngi_pipeline.engines.rna_ngi.local_process_tracking import record_project_job, remove_analysis
 from ngi_pipeline.log.loggers import minimal_logger
 from ngi_pipeline.utils.communication import mail_analysis
 from ngi_pipeline.utils.classes import with_ngi_config
+from ngi_pipeline.utils.fastq import group_fastq_names, parse_fastq_names
 from ngi_pipeline.engines.utils import handle_sample_status, handle_libprep_status, handle_seqrun_status
 from ngi_pipeline.database.classes import CharonSession, CharonError
 from ngi_pipeline.utils.filesystem import load_modules, execute_command_line, \
@@ -84,19 +85,24 @@ def start_analysis(sbatch_path):
 
 
 def merge_fastq_files(dest_dir, fastq_files):
-    LOG.info("Merging files...")
-    sample_pattern=re.compile("^(.+)_S[0-9]+_.+_R([1-2])_")
-    while fastq_files:
-        tomerge=[]
-        tomerge.append(fastq_files.pop())
-        fq_bn=os.path.basename(tomerge[0])
-        sample_name=sample_pattern.match(fq_bn).group(1)
-        read_nb=sample_pattern.match(fq_bn).group(2)
-        for fq in fastq_files:
-            if sample_name in os.path.basename(fq) and "_R{}_".format(read_nb) in os.path.basename(fq):
-                tomerge.append(fq)
-                fastq_files.remove(fq)
+    """Concatenate the fastq files of each sample and read into
+    <dest_dir>/<sample_name>_R<read>.fastq.gz, the files of both reads in
+    the same order.
+
+    :param str dest_dir: The directory to write the merged files to
+    :param list fastq_files: The paths to the fastq files
 
+    :raises ValueError: If the sample or read of a file cannot be determined
+    """
+    LOG.info("Merging files...")
+    fastq_names = parse_fastq_names(sorted(fastq_files), fastq_only=False)
+    for fastq_name in fastq_names:
+        if fastq_name.index is None or fastq_name.read is None:
+            raise ValueError('Cannot determine the sample and read of fastq file '
+                             '"{}"'.format(fastq_name.path))
+    to_merge = group_fastq_names(fastq_names, operator.attrgetter("sample", "read"))
+    for (sample_name, read_nb), group in to_merge.items():
+        tomerge = [fastq_name.path for fastq_name in group]
         outfile=os.path.join(dest_dir, "{}_R{}.fastq.gz".format(sample_name, read_nb))
         LOG.info("merging {} as {}".format(", ".join(tomerge), outfile))
         with open(outfile, 'wb') as wfp:
@@ -105,11 +111,6 @@ def merge_fastq_files(dest_dir, fastq_files):
                     shutil.copyfileobj(rfp, wfp)
 
 
-
-
-
-
-
 def preprocess_analysis(analysis_object, fastq_files):
     analysis_path=os.path.join(analysis_object.project.base_path, "ANALYSIS", analysis_object.project.project_id, 'rna_ngi')
     safe_makedir(analysis_path)
@@ -0,0 +1,227 @@
+"""Time the Charon-heavy parts of the pipeline against a FakeCharon.
+
+For each project size, a synthetic project is loaded into the fake Charon and
+a matching flowcell is written to a temporary directory; then
+
+    organize   organize_projects_from_flowcell on the flowcell
+    analyze    piper_ngi.launchers.analyze on the organized project (sbatch and
+               sacct are stubbed out)
+    update     update_charon_with_local_jobs_status on the jobs analyze recorded
+               (half of them finished with an error, half still running)
+
+are run in turn. The wall time and the number of Charon requests of each are
+reported, e.g.
+
+    python -m ngi_pipeline.tests.benchmarks.bench_charon --sizes 10 100 --latency 0.005
+
+Only the temporary directory is touched: the config file is generated and
+NGI_CONFIG pointed at it before any of the pipeline is imported.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+
+WORKLOADS = ("organize", "analyze", "update")
+SLURM_ACCOUNT_DIR = "a2014205"
+
+BenchmarkResult = collections.namedtuple('BenchmarkResult',
+                                         ['workload', 'num_samples', 'seconds',
+                                          'num_requests', 'requests'])
+
+
+def write_benchmark_config(work_dir):
+    """Write a minimal ngi_pipeline config rooted in work_dir and return its path."""
+    base_root = os.path.join(work_dir, "proj")
+    config = {
+        "analysis": {"base_root": base_root,
+                     "sthlm_root": SLURM_ACCOUNT_DIR,
+                     "upps_root": "a2015179",
+                     "top_dir": "nobackup/NGI/analysis_ready",
+                     "best_practice_analysis": {
+                         "whole_genome_reseq": {"analysis_engine": "ngi_pipeline.engines.piper_ngi"}}},
+        "database": {"record_tracking_db_path": os.path.join(work_dir, "record_tracking.sql")},
+        "environment": {"project_id": SLURM_ACCOUNT_DIR,
+                        "flowcell_inbox": [os.path.join(base_root, SLURM_ACCOUNT_DIR, "archive")]},
+        "logging": {"log_file": os.path.join(work_dir, "ngi_pipeline.log")},
+        "piper": {"path_to_piper_qscripts": os.path.join(work_dir, "qscripts"),
+                  "threads": 16},
+        "supported_genomes": {"GRCh37": os.path.join(work_dir, "GRCh37.fasta")},
+        "quiet": True,
+    }
+    config_file_path = os.path.join(work_dir, "ngi_config.yaml")
+    with open(config_file_path, 'w') as f:
+        yaml.safe_dump(config, f, default_flow_style=False)
+    return config_file_path
+
+
+def create_synthetic_flowcell(work_dir, run_id, project_name, sample_ids):
+    """Write a CASAVA 2.5-style flowcell with an (empty) fastq pair per sample,
+    returning its path."""
+    from ngi_pipeline.tests.generate_test_data import generate_paired_sample_file_names
+
+    fc_dir = os.path.join(work_dir, "proj", SLURM_ACCOUNT_DIR, "archive", run_id)
+    project_dir = os.path.join(fc_dir, "Demultiplexing",
+                               project_name.replace(".", "__"))
+    for sample_id in sample_ids:
+        sample_dir = os.path.join(project_dir, "Sample_{}".format(sample_id))
+        os.makedirs(sample_dir)
+        for fastq in generate_paired_sample_file_names(sample_name=sample_id,
+                                                       barcode="ACGTAC", lane=1):
+            open(os.path.join(sample_dir, fastq), 'w').close()
+    return fc_dir
+
+
+class FakeSbatchProcess(object):
+    """Stands in for the Popen handle of an sbatch call."""
+    job_ids = iter(xrange(1000, sys.maxint))
+
+    def communicate(self):
+        return "Submitted batch job {}\n".format(next(self.job_ids)), ""
+
+
+def run_benchmarks(sizes, latency=0.0, error_rate=0.0, transport_settings=None,
+                   work_dir=None, workloads=WORKLOADS):
+    """Run the workloads for each project size.
+
+    :param list sizes: The numbers of samples in the synthetic projects
+    :param float latency: Seconds the fake Charon waits before each response
+    :param float error_rate: Fraction of Charon requests to fail with a 503
+    :param dict transport_settings: Extra charon config settings (e.g. max_retries)
+    :param str work_dir: Where to write the flowcells and analyses (default: a temp dir)
+    :param tuple workloads: Which of WORKLOADS to run
+
+    :returns: The results, in the order run
+    :rtype: list of BenchmarkResult
+    """
+    # The pipeline modules load the config when imported
+    from ngi_pipeline.conductor.classes import NGIAnalysis
+    from ngi_pipeline.conductor.flowcell import organize_projects_from_flowcell
+    from ngi_pipeline.engines.piper_ngi import launchers, local_process_tracking
+    from ngi_pipeline.engines.piper_ngi.utils import create_exit_code_file_path
+    from ngi_pipeline.tests.fake_charon import FakeCharon, fake_charon_session
+    from ngi_pipeline.tests.generate_test_data import generate_run_id
+    from ngi_pipeline.utils.config import load_yaml_config
+    import mock
+
+    config = load_yaml_config(os.environ["NGI_CONFIG"])
+    work_dir = work_dir or os.path.dirname(os.environ["NGI_CONFIG"])
+    results = []
+    with FakeCharon(latency=latency, error_rate=error_rate) as fake_charon, \
+            fake_charon_session(fake_charon, **(transport_settings or {})), \
+            mock.patch.object(launchers, "execute_command_line",
+                              side_effect=lambda *args, **kwargs: FakeSbatchProcess()), \
+            mock.patch.object(launchers, "get_slurm_job_status", return_value=None), \
+            mock.patch.object(local_process_tracking, "get_slurm_job_status", return_value=None), \
+            mock.patch.object(launchers.time, "sleep"):
+
+        def timed(workload, num_samples, function, *args, **kwargs):
+            fake_charon.reset_counts()
+            start = time.time()
+            return_value = function(*args, **kwargs)
+            requests = dict(fake_charon.request_counts)
+            results.append(BenchmarkResult(workload, num_samples, time.time() - start,
+                                           sum(requests.values()), requests))
+            return return_value
+
+        for size_num, num_samples in enumerate(sizes):
+            project_id = "P{}".format(9000 + size_num)
+            project_name = "T.Bench_{:02d}_01".format(size_num)
+            run_id = generate_run_id()
+            fake_charon.add_synthetic_project(project_id, num_samples, seqrun_ids=[run_id],
+                                              name=project_name)
+            sample_ids = ["{}_{}".format(project_id, 101 + i) for i in range(num_samples)]
+            fc_dir = create_synthetic_flowcell(work_dir, run_id, project_name, sample_ids)
+
+            projects = timed("organize", num_samples, organize_projects_from_flowcell,
+                             [fc_dir], quiet=True, config=config)
+            if "analyze" not in workloads:
+                continue
+            for project in projects:
+                analysis = NGIAnalysis(project=project, exec_mode="sbatch", quiet=True,
+                                       config=config)
+                timed("analyze", num_samples, launchers.analyze, analysis, config=config)
+            if "update" not in workloads:
+                continue
+            # Half of the jobs failed, the other half are still running
+            for project in projects:
+                for sample in list(project)[::2]:
+                    exit_code_path = create_exit_code_file_path("merge_process_variantcall",
+                                                                project.base_path,
+                                                                project.dirname,
+                                                                project.project_id,
+                                                                sample.name)
+                    with open(exit_code_path, 'w') as f:
+                        f.write("1\n")
+            timed("update", num_samples,
+                  local_process_tracking.update_charon_with_local_jobs_status,
+                  quiet=True, config=config)
+    return [result for result in results if result.workload in workloads]
+
+
+def print_results(results, output=sys.stdout):
+    print("{:<10} {:>8} {:>10} {:>10} {:>12}".format("workload", "samples", "seconds",
+                                                     "requests", "ms/sample"), file=output)
+    for result in results:
+        print("{:<10} {:>8} {:>10.3f} {:>10} {:>12.2f}".format(
+                    result.workload, result.num_samples, result.seconds,
+                    result.num_requests,
+                    1000 * result.seconds / max(result.num_samples, 1)), file=output)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-s", "--sizes", type=int, nargs="+", default=[10, 100, 1000],
+            help="The numbers of samples in the synthetic projects (default 10 100 1000)")
+    parser.add_argument("-l", "--latency", type=float, default=0.005,
+            help="Seconds the fake Charon waits before each response (default 0.005)")
+    parser.add_argument("-e", "--error-rate", type=float, default=0.0,
+            help="Fraction of Charon requests to fail with a 503 (default 0)")
+    parser.add_argument("-w", "--workload", dest="workloads", choices=WORKLOADS,
+            action="append", help="Only run these workloads (default all)")
+    parser.add_argument("--charon-setting", metavar="KEY=JSON_VALUE", action="append",
+            default=[], help="Extra charon config settings, e.g. max_retries=0")
+    parser.add_argument("-j", "--json", metavar="PATH",
+            help="Also write the results to this file as JSON")
+    parser.add_argument("-k", "--keep", action="store_true",
+            help="Keep the working directory")
+    parser.add_argument("-v", "--verbose", action="store_true",
+            help="Leave the pipeline's logging on")
+    args = parser.parse_args(argv)
+
+    transport_settings = {}
+    for setting in args.charon_setting:
+        key, _, value = setting.partition("=")
+        transport_settings[key] = json.loads(value)
+    work_dir = tempfile.mkdtemp(prefix="ngi_bench_")
+    os.environ["NGI_CONFIG"] = write_benchmark_config(work_dir)
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+    try:
+        results = run_benchmarks(args.sizes, latency=args.latency,
+                                 error_rate=args.error_rate,
+                                 transport_settings=transport_settings,
+                                 work_dir=work_dir,
+                                 workloads=tuple(args.workloads or WORKLOADS))
+    finally:
+        if args.keep:
+            print("Working directory: {}".format(work_dir), file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump([result._asdict() for result in results], f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""Time the fastq name parsing in utils.parsers and utils.fastq against the
+regular expressions and the quadratic merge grouping they replaced, on
+synthetic fastq paths, e.g.
+
+    python -m ngi_pipeline.tests.benchmarks.bench_fastq_names --names 100000
+
+The old merge grouping is quadratic in the number of files, so it is only run
+on the first --merge-names of them.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import logging
+import operator
+import os
+import re
+import sys
+import time
+
+from ngi_pipeline.tests.generate_test_data import generate_barcode, generate_run_id
+from ngi_pipeline.utils.fastq import group_fastq_names, parse_fastq_names
+from ngi_pipeline.utils.parsers import find_fastq_read_pairs, parse_lane_from_filename
+
+BenchmarkResult = collections.namedtuple('BenchmarkResult',
+                                         ['task', 'implementation', 'num_names', 'seconds'])
+
+
+def generate_fastq_paths(num_names, lanes=8, chunks=2):
+    """Paths like DATA/P101/P101_1001/A/<run_id>/P101_1001_S1_L001_R1_001.fastq.gz,
+    a pair per lane and chunk for as many samples as needed.
+
+    :param int num_names: The number of paths
+    :param int lanes: The number of lanes per sample
+    :param int chunks: The number of files per lane and read
+
+    :rtype: list
+    """
+    paths = []
+    run_dir = generate_run_id()
+    sample_num = 0
+    while len(paths) < num_names:
+        sample_num += 1
+        sample_name = "P101_{}".format(1000 + sample_num)
+        sample_dir = os.path.join("DATA", "P101", sample_name, "A", run_dir)
+        index = generate_barcode() if sample_num % 2 else "S{}".format(sample_num)
+        for lane in range(1, lanes + 1):
+            for chunk in range(1, chunks + 1):
+                for read in (1, 2):
+                    paths.append(os.path.join(sample_dir, "{}_{}_L00{}_R{}_{:03d}.fastq.gz".format(
+                                              sample_name, index, lane, read, chunk)))
+    return paths[:num_names]
+
+
+def find_fastq_read_pairs_regex(file_list):
+    """parsers.find_fastq_read_pairs as it was before utils.fastq (logging
+    removed); kept as the baseline."""
+    pt = re.compile(".*\.(fastq|fq)(\.gz|\.gzip|\.bz2)?$")
+    file_list = filter(pt.match, file_list)
+    file_format_pattern = re.compile(r'(.*)_(?:R\d|\d\.).*')
+    matches_dict = collections.defaultdict(list)
+    for file_pathname in file_list:
+        file_basename = os.path.basename(file_pathname)
+        fc_id = os.path.dirname(file_pathname).split("_")[-1]
+        pair_base = file_format_pattern.match(file_basename).groups()[0]
+        matches_dict["{}_{}".format(pair_base,fc_id)].append(file_pathname)
+    return dict(matches_dict)
+
+
+def find_fastq_read_pairs_table(file_list):
+    pairs = group_fastq_names(parse_fastq_names(file_list),
+                              operator.attrgetter("pair_base", "flowcell"))
+    return {"{}_{}".format(*pair_key): [fq.path for fq in group]
+            for pair_key, group in pairs.items()}
+
+
+def parse_lanes_regex(file_list):
+    """parsers.parse_lane_from_filename, as it was, over a list of files."""
+    lanes = []
+    for file_path in file_list:
+        sample_basename = os.path.basename(file_path)
+        match = re.match(r'(?P<lane>\d)_\d{6}_\w{10}_(?P<project>P\d{3})_(?P<sample>\d{3}).*', sample_basename) or \
+                re.match(r'.*_L\d{2}(?P<lane>\d{1}).*', sample_basename)
+        lanes.append(int(match.group('lane')))
+    return lanes
+
+
+def parse_lanes_table(file_list):
+    return [fq.lane for fq in parse_fastq_names(file_list)]
+
+
+def parse_lanes_parsers(file_list):
+    return [parse_lane_from_filename(file_path) for file_path in file_list]
+
+
+def group_for_merging_quadratic(fastq_files):
+    """The grouping in rna_ngi.launchers.merge_fastq_files as it was. It
+    removed files from the list it was iterating over, skipping the next one,
+    so a sample's files could be split over several groups (each written to,
+    and overwriting, the same merged file); the pieces are collected here."""
+    fastq_files = list(fastq_files)
+    groups = {}
+    sample_pattern=re.compile("^(.+)_S[0-9]+_.+_R([1-2])_")
+    while fastq_files:
+        tomerge=[]
+        tomerge.append(fastq_files.pop())
+        fq_bn=os.path.basename(tomerge[0])
+        sample_name=sample_pattern.match(fq_bn).group(1)
+        read_nb=sample_pattern.match(fq_bn).group(2)
+        for fq in fastq_files:
+            if sample_name in os.path.basename(fq) and "_R{}_".format(read_nb) in os.path.basename(fq):
+                tomerge.append(fq)
+                fastq_files.remove(fq)
+        groups.setdefault((sample_name, int(read_nb)), []).extend(tomerge)
+    return groups
+
+
+def group_for_merging_table(fastq_files):
+    return group_fastq_names(parse_fastq_names(sorted(fastq_files)),
+                             operator.attrgetter("sample", "read"))
+
+
+TASKS = collections.OrderedDict([
+    ("read pairs", collections.OrderedDict([("regex", find_fastq_read_pairs_regex),
+                                            ("parsers", find_fastq_read_pairs),
+                                            ("table", find_fastq_read_pairs_table)])),
+    ("lanes", collections.OrderedDict([("regex", parse_lanes_regex),
+                                       ("parsers", parse_lanes_parsers),
+                                       ("table", parse_lanes_table)])),
+    ("merge groups", collections.OrderedDict([("quadratic", group_for_merging_quadratic),
+                                              ("table", group_for_merging_table)])),
+])
+
+
+def run_benchmarks(num_names, merge_names=5000, repeats=3):
+    """Run each task with each implementation on num_names synthetic paths.
+
+    :param int num_names: The number of fastq paths
+    :param int merge_names: Run the merge grouping on this many of them
+    :param int repeats: Report the best of this many runs
+
+    :returns: The results, in the order run
+    :rtype: list of BenchmarkResult
+    """
+    paths = generate_fastq_paths(num_names)
+    # Only S<n>-indexed samples can be merged by the old code
+    merge_paths = [path for path in paths if "_S" in os.path.basename(path)][:merge_names]
+    results = []
+    for task, implementations in TASKS.items():
+        task_paths = merge_paths if task == "merge groups" else paths
+        outputs = []
+        for implementation, function in implementations.items():
+            best = None
+            for _ in range(repeats):
+                start = time.time()
+                output = function(task_paths)
+                seconds = time.time() - start
+                best = seconds if best is None else min(best, seconds)
+            outputs.append(output)
+            results.append(BenchmarkResult(task, implementation, len(task_paths), best))
+        if task == "merge groups":
+            outputs = [{key: sorted(fq if isinstance(fq, str) else fq.path for fq in group)
+                        for key, group in output.items()} for output in outputs]
+        if any(output != outputs[0] for output in outputs[1:]):
+            raise RuntimeError('The implementations of "{}" disagree'.format(task))
+    return results
+
+
+def print_results(results, output=sys.stdout):
+    print("{:<14} {:<10} {:>8} {:>10}".format("task", "impl", "names", "seconds"), file=output)
+    for result in results:
+        print("{:<14} {:<10} {:>8} {:>10.4f}".format(*result), file=output)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", "--names", type=int, default=100000,
+            help="The number of fastq paths (default 100000)")
+    parser.add_argument("-m", "--merge-names", type=int, default=5000,
+            help="Run the merge grouping on this many of them (default 5000)")
+    parser.add_argument("-r", "--repeats", type=int, default=3,
+            help="Report the best of this many runs (default 3)")
+    parser.add_argument("-j", "--json", metavar="PATH",
+            help="Also write the results to this file as JSON")
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.CRITICAL)
+    results = run_benchmarks(args.names, merge_names=args.merge_names, repeats=args.repeats)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump([result._asdict() for result in results], f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""Time conductor.flowcell.parse_flowcell against the glob-based parser it
+replaced, on synthetic flowcells made with generate_test_data, e.g.
+
+    python -m ngi_pipeline.tests.benchmarks.bench_parse_flowcell --samples 100 2000 --lanes 4
+
+Besides the wall time, the number of filesystem metadata calls made from
+Python (listdir, stat, lstat, access) by each parser is reported; on shared
+network filesystems each of those is a round-trip to the metadata server.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import contextlib
+import glob
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import mock
+
+from ngi_pipeline.conductor.flowcell import STHLM_PROJECT_RE, STHLM_X_PROJECT_RE, \
+                                            UPPSALA_PROJECT_RE, parse_flowcell
+from ngi_pipeline.tests.generate_test_data import create_large_demultiplexed_flowcell
+
+BenchmarkResult = collections.namedtuple('BenchmarkResult',
+                                         ['parser', 'num_samples', 'num_files', 'seconds',
+                                          'metadata_calls'])
+
+
+def parse_flowcell_glob(fc_dir):
+    """The glob-based parse_flowcell, as it was before it read each directory
+    only once (logging removed); kept as the baseline."""
+    projects = []
+    fc_dir = os.path.abspath(fc_dir)
+    samplesheet_path = os.path.join(fc_dir, "SampleSheet.csv")
+    if not os.path.exists(samplesheet_path):
+        samplesheet_path = None
+    fc_full_id = os.path.basename(fc_dir)
+    c2_5_path = os.path.join(fc_dir, "Demultiplexing")
+    c1_8_path = os.path.join(fc_dir, "Unaligned*")
+    if os.path.exists(c2_5_path):
+        data_dir = c2_5_path
+    else:
+        data_dir = c1_8_path
+    for project_dir in glob.glob(os.path.join(data_dir, "*")):
+        path, base_dir = os.path.split(project_dir)
+        if not base_dir: path, base_dir = os.path.split(path)
+        project_original_name = os.path.basename(base_dir).replace('Project_', '')
+        project_name = project_original_name.replace('__', '.')
+        if not (os.path.isdir(project_dir) and \
+                (UPPSALA_PROJECT_RE.match(project_name) or \
+                   STHLM_PROJECT_RE.match(project_name))):
+            continue
+        project_samples = []
+        sample_dir_pattern = os.path.join(project_dir, "*")
+        if STHLM_X_PROJECT_RE.match(project_name):
+            project_name = project_name.replace('_', '.', 1)
+        for sample_dir in glob.glob(sample_dir_pattern):
+            sample_name = os.path.basename(sample_dir).replace('Sample_', '')
+            fastq_file_pattern = os.path.join(sample_dir, "*.fastq.gz")
+            fastq_files = [os.path.basename(fq) for fq in glob.glob(fastq_file_pattern)]
+            project_samples.append({'sample_dir': os.path.basename(sample_dir),
+                                    'sample_name': sample_name,
+                                    'files': fastq_files})
+        if project_samples:
+            projects.append({'data_dir': os.path.relpath(os.path.dirname(project_dir), fc_dir),
+                             'project_dir': os.path.basename(project_dir),
+                             'project_name': project_name,
+                             'project_original_name': project_original_name,
+                             'samples': project_samples})
+    if not projects:
+        raise ValueError('No projects or no projects with sample found in '
+                         'flowcell directory {}'.format(fc_dir))
+    return {'fc_dir'    : fc_dir,
+            'fc_full_id': fc_full_id,
+            'projects': projects,
+            'samplesheet_path': samplesheet_path}
+
+
+PARSERS = collections.OrderedDict([("glob", parse_flowcell_glob),
+                                   ("scandir", parse_flowcell)])
+
+
+@contextlib.contextmanager
+def count_metadata_calls():
+    """Count the os.listdir/stat/lstat/access calls made within the block.
+    Calls made from C (e.g. inside scandir) are not seen; the stat() of a
+    DirEntry is counted separately by the caller."""
+    counts = collections.Counter()
+
+    def counting(name, original):
+        def counted(*args, **kwargs):
+            counts[name] += 1
+            return original(*args, **kwargs)
+        return counted
+
+    patches = [mock.patch.object(os, name, counting(name, getattr(os, name)))
+               for name in ("listdir", "stat", "lstat", "access")]
+    for patch in patches:
+        patch.start()
+    try:
+        yield counts
+    finally:
+        for patch in patches:
+            patch.stop()
+
+
+def run_benchmarks(sizes, lanes=1, repeats=3, work_dir=None):
+    """Parse a synthetic flowcell of each size with each parser.
+
+    :param list sizes: The numbers of samples in the flowcells
+    :param int lanes: The number of lanes (fastq pairs) per sample
+    :param int repeats: Report the best of this many runs
+    :param str work_dir: Where to create the flowcells (default: a temp dir)
+
+    :returns: The results, in the order run
+    :rtype: list of BenchmarkResult
+    """
+    results = []
+    for num_samples in sizes:
+        fc_dir = create_large_demultiplexed_flowcell(base_dir=work_dir or tempfile.mkdtemp(),
+                                                     num_samples=num_samples,
+                                                     lanes=range(1, lanes + 1))
+        try:
+            for parser_name, parser in PARSERS.items():
+                best = None
+                for _ in range(repeats):
+                    start = time.time()
+                    parser(fc_dir)
+                    seconds = time.time() - start
+                    best = seconds if best is None else min(best, seconds)
+                with count_metadata_calls() as counts:
+                    structure = parser(fc_dir)
+                num_files = sum(len(sample['files']) for project in structure['projects']
+                                for sample in project['samples'])
+                metadata_calls = sum(counts.values())
+                if parser is parse_flowcell:
+                    # One scandir per directory plus one stat per fastq
+                    metadata_calls += 3 + num_samples + num_files
+                results.append(BenchmarkResult(parser_name, num_samples, num_files, best,
+                                               metadata_calls))
+        finally:
+            if not work_dir:
+                shutil.rmtree(os.path.dirname(fc_dir))
+    return results
+
+
+def print_results(results, output=sys.stdout):
+    print("{:<10} {:>8} {:>8} {:>10} {:>15}".format("parser", "samples", "files",
+                                                    "seconds", "metadata calls"),
+          file=output)
+    for result in results:
+        print("{:<10} {:>8} {:>8} {:>10.4f} {:>15}".format(*result), file=output)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-s", "--samples", dest="sizes", type=int, nargs="+",
+            default=[100, 1000], help="The numbers of samples in the flowcells (default 100 1000)")
+    parser.add_argument("-l", "--lanes", type=int, default=1,
+            help="Fastq pairs per sample (default 1)")
+    parser.add_argument("-r", "--repeats", type=int, default=3,
+            help="Report the best of this many runs (default 3)")
+    parser.add_argument("-j", "--json", metavar="PATH",
+            help="Also write the results to this file as JSON")
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.CRITICAL)
+    results = run_benchmarks(args.sizes, lanes=args.lanes, repeats=args.repeats)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump([result._asdict() for result in results], f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from ngi_pipeline.tests.benchmarks.bench_charon import run_benchmarks, \
+                                                       write_benchmark_config
+
+
+class TestBenchCharon(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_run_benchmarks(self):
+        config_file_path = write_benchmark_config(self.work_dir)
+        with mock.patch.dict(os.environ, {"NGI_CONFIG": config_file_path}):
+            results = run_benchmarks([3], transport_settings={"max_retries": 0})
+        self.assertEqual([(r.workload, r.num_samples) for r in results],
+                         [("organize", 3), ("analyze", 3), ("update", 3)])
+        self.assertTrue(all(result.num_requests for result in results))
+        organize, analyze, update = results
+        # Each launched sample is marked as under analysis
+        self.assertEqual(analyze.requests["PUT sample"], 3)
+        # Two samples failed, one is still running
+        self.assertEqual(update.requests["PUT seqrun"], 2)
@@ -0,0 +1,15 @@
+import unittest
+
+from ngi_pipeline.tests.benchmarks.bench_fastq_names import run_benchmarks
+
+
+class TestBenchFastqNames(unittest.TestCase):
+
+    def test_run_benchmarks(self):
+        results = run_benchmarks(200, merge_names=64, repeats=1)
+        self.assertEqual([(r.task, r.implementation, r.num_names) for r in results],
+                         [("read pairs", "regex", 200), ("read pairs", "parsers", 200),
+                          ("read pairs", "table", 200),
+                          ("lanes", "regex", 200), ("lanes", "parsers", 200),
+                          ("lanes", "table", 200),
+                          ("merge groups", "quadratic", 64), ("merge groups", "table", 64)])
@@ -0,0 +1,11 @@
+import unittest
+
+from ngi_pipeline.tests.benchmarks.bench_parse_flowcell import run_benchmarks
+
+
+class TestBenchParseFlowcell(unittest.TestCase):
+
+    def test_run_benchmarks(self):
+        results = run_benchmarks([4], lanes=2, repeats=1)
+        self.assertEqual([(r.parser, r.num_samples, r.num_files) for r in results],
+                         [("glob", 4, 16), ("scandir", 4, 16)])
@@ -0,0 +1,225 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from ngi_pipeline.conductor.flowcell import organize_projects_from_flowcell, parse_flowcell
+from ngi_pipeline.tests.benchmarks.bench_parse_flowcell import parse_flowcell_glob
+from ngi_pipeline.tests.fake_charon import FakeCharon, fake_charon_session
+from ngi_pipeline.tests.generate_test_data import create_demultiplexed_flowcell, \
+                                                  create_large_demultiplexed_flowcell, \
+                                                  generate_run_id
+
+
+def _sorted_structure(fc_structure):
+    for project in fc_structure['projects']:
+        for sample in project['samples']:
+            sample.pop('file_info', None)
+            sample['files'].sort()
+        project['samples'].sort(key=lambda sample: sample['sample_dir'])
+    fc_structure['projects'].sort(key=lambda project: project['project_dir'])
+    return fc_structure
+
+
+class TestParseFlowcell(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parse_flowcell_casava_2_5(self):
+        fc_dir = create_large_demultiplexed_flowcell(base_dir=self.tmp_dir, num_projects=2,
+                                                     num_samples=5, lanes=(1, 2))
+        with open(os.path.join(fc_dir, "Demultiplexing", "Reports.html"), 'w') as f:
+            f.write("not a project")
+        fc_structure = parse_flowcell(fc_dir)
+        self.assertEqual(fc_structure['samplesheet_path'],
+                         os.path.join(fc_dir, "SampleSheet.csv"))
+        self.assertEqual(len(fc_structure['projects']), 2)
+        project = [project for project in fc_structure['projects']
+                   if project['samples'][0]['sample_name'] == "P101_101"][0]
+        sample = project['samples'][0]
+        self.assertEqual(sample['sample_name'], "P101_101")
+        self.assertEqual(len(sample['files']), 4)
+        # Sizes and mtimes come along with the names
+        fastq_path = os.path.join(fc_dir, "Demultiplexing",
+                                  project['project_dir'],
+                                  sample['sample_dir'], sample['files'][0])
+        self.assertEqual(sample['file_info'][sample['files'][0]],
+                         {'size': 0, 'mtime': os.stat(fastq_path).st_mtime})
+        self.assertEqual(_sorted_structure(fc_structure),
+                         _sorted_structure(parse_flowcell_glob(fc_dir)))
+
+    def test_parse_flowcell_casava_1_8(self):
+        fc_dir = create_demultiplexed_flowcell()
+        try:
+            fc_structure = parse_flowcell(fc_dir)
+            self.assertEqual(fc_structure['projects'][0]['data_dir'], "Unaligned")
+            self.assertEqual(_sorted_structure(fc_structure),
+                             _sorted_structure(parse_flowcell_glob(fc_dir)))
+        finally:
+            shutil.rmtree(os.path.dirname(fc_dir))
+
+    def test_parse_flowcell_no_projects(self):
+        with self.assertRaises(ValueError):
+            parse_flowcell(self.tmp_dir)
+        with self.assertRaises(OSError):
+            parse_flowcell(os.path.join(self.tmp_dir, "missing"))
+
+
+class TestOrganizeProjectsFromFlowcell(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = {"analysis": {"base_root": self.tmp_dir,
+                                    "sthlm_root": "ngi2016001",
+                                    "upps_root": "ngi2016003",
+                                    "top_dir": "nobackup/NGI"}}
+        inbox = os.path.join(self.tmp_dir, "ngi2016001", "incoming")
+        self.fc_dirs = [create_large_demultiplexed_flowcell(base_dir=inbox, num_samples=3,
+                                                            project_names=project_names)
+                        for project_names in (["J.Doe_14_01"], ["J.Doe_14_01", "A.Bee_15_02"])]
+        patches = [mock.patch("ngi_pipeline.conductor.flowcell.get_project_id_from_name",
+                              side_effect=lambda name: name.split(".")[0]),
+                   mock.patch("ngi_pipeline.conductor.flowcell."
+                              "determine_library_prep_from_samplesheet", return_value="A")]
+        self.get_project_id, self.get_libprep = [patch.start() for patch in patches]
+        for patch in patches:
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def organize(self, workers):
+        projects = organize_projects_from_flowcell(self.fc_dirs, workers=workers, quiet=True,
+                                                   config=self.config)
+        return sorted((project.project_id, sample.name, libprep.name, seqrun.name,
+                       sorted(seqrun.fastq_files))
+                      for project in projects for sample in project
+                      for libprep in sample for seqrun in libprep)
+
+    def test_organize_concurrently(self):
+        structure = self.organize(workers=2)
+        self.assertEqual(structure, self.organize(workers=1))
+        self.assertEqual([entry[:2] for entry in structure],
+                         [("A", "P102_101"), ("A", "P102_102"), ("A", "P102_103"),
+                          ("J", "P101_101"), ("J", "P101_101"), ("J", "P101_102"),
+                          ("J", "P101_102"), ("J", "P101_103"), ("J", "P101_103")])
+        # Each seqrun only links the fastq files of its own flowcell
+        data_dir = os.path.join(self.tmp_dir, "ngi2016001", "nobackup", "NGI", "DATA")
+        for project_id, sample_name, libprep_name, seqrun_name, fastq_files in structure:
+            seqrun_dir = os.path.join(data_dir, project_id, sample_name, libprep_name,
+                                      seqrun_name)
+            self.assertEqual(sorted(os.listdir(seqrun_dir)), fastq_files)
+            for fastq_file in fastq_files:
+                self.assertIn(seqrun_name,
+                              os.path.realpath(os.path.join(seqrun_dir, fastq_file)))
+        self.assertTrue(os.path.islink(os.path.join(data_dir, "J.Doe_14_01")))
+
+    def test_reorganize_from_manifest(self):
+        structure = self.organize(workers=1)
+        self.assertEqual(self.get_libprep.call_count, 18)
+        self.get_project_id.reset_mock()
+        self.get_libprep.reset_mock()
+        self.assertEqual(self.organize(workers=1), structure)
+        self.assertEqual((self.get_project_id.call_count, self.get_libprep.call_count), (0, 0))
+
+        # A new fastq pair in one sample: only that sample is set up again
+        sample_dir = os.path.join(self.fc_dirs[1], "Demultiplexing", "J__Doe_14_01",
+                                  "Sample_P101_102")
+        for read_num in (1, 2):
+            open(os.path.join(sample_dir, "P101_102_AAAAAA_L002_R{}_001.fastq.gz".format(read_num)),
+                 'w').close()
+        structure = self.organize(workers=1)
+        self.assertEqual(self.get_libprep.call_count, 4)
+        self.assertIn(("J", "P101_102", "A", os.path.basename(self.fc_dirs[1])),
+                      [entry[:4] for entry in structure
+                       if "P101_102_AAAAAA_L002_R2_001.fastq.gz" in entry[4]])
+        self.assertEqual(len(os.listdir(os.path.join(self.tmp_dir, "ngi2016001", "nobackup",
+                                                     "NGI", "flowcell_manifests"))), 2)
+
+    def test_reorganize_recreates_missing_links(self):
+        structure = self.organize(workers=1)
+        seqrun_dir = os.path.join(self.tmp_dir, "ngi2016001", "nobackup", "NGI", "DATA", "J",
+                                  "P101_101", "A", os.path.basename(self.fc_dirs[0]))
+        shutil.rmtree(seqrun_dir)
+        self.get_libprep.reset_mock()
+        self.assertEqual(self.organize(workers=1), structure)
+        # Only the sample that lost its links is set up again
+        self.assertEqual(self.get_libprep.call_count, 2)
+        self.assertEqual(len(os.listdir(seqrun_dir)), 2)
+
+    def test_reorganize_recreates_broken_links(self):
+        structure = self.organize(workers=1)
+        seqrun_dir = os.path.join(self.tmp_dir, "ngi2016001", "nobackup", "NGI", "DATA", "J",
+                                  "P101_101", "A", os.path.basename(self.fc_dirs[0]))
+        link = os.path.join(seqrun_dir, sorted(os.listdir(seqrun_dir))[0])
+        os.remove(link)
+        os.symlink(os.path.join(self.tmp_dir, "gone.fastq.gz"), link)
+        self.get_libprep.reset_mock()
+        self.organize(workers=1)
+        # The sample with the broken link is not taken from the manifest
+        self.assertEqual(self.get_libprep.call_count, 2)
+
+
+class TestLibraryPrepsFromCharon(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = {"analysis": {"base_root": self.tmp_dir,
+                                    "sthlm_root": "ngi2016001",
+                                    "upps_root": "ngi2016003",
+                                    "top_dir": "nobackup/NGI"}}
+        run_id = generate_run_id()
+        # No libpreps in the SampleSheet
+        self.fc_dir = create_large_demultiplexed_flowcell(
+                            base_dir=os.path.join(self.tmp_dir, "ngi2016001", "incoming"),
+                            num_samples=3, lanes=(1, 2, 3, 4), run_id=run_id,
+                            project_names=["J.Doe_14_01"])
+        self.fake_charon = FakeCharon()
+        self.fake_charon.start()
+        self.addCleanup(self.fake_charon.stop)
+        self.fake_charon.add_synthetic_project("P101", num_samples=3, seqrun_ids=[run_id])
+        # Two libpreps of P101_103 on the same flowcell
+        self.fake_charon.add_document("libprep", ("P101", "P101_103", "B"), qc="PASSED")
+        self.fake_charon.add_document("seqrun", ("P101", "P101_103", "B", run_id))
+        session_context = fake_charon_session(self.fake_charon)
+        session_context.__enter__()
+        self.addCleanup(session_context.__exit__, None, None, None)
+        patch = mock.patch("ngi_pipeline.conductor.flowcell.get_project_id_from_name",
+                           return_value="P101")
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.fake_charon.reset_counts()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_libpreps_resolved_once_per_sample(self):
+        project = organize_projects_from_flowcell([self.fc_dir], quiet=True,
+                                                  config=self.config)[0]
+        self.assertEqual(project.samples["P101_101"].libpreps.keys(), ["A"])
+        self.assertEqual(len(list(project.samples["P101_102"].libpreps["A"])[0].fastq_files), 8)
+        # Ambiguous: no libprep rather than the first match
+        self.assertEqual(project.samples["P101_103"].libpreps, {})
+        self.assertEqual(self.fake_charon.request_counts["GET libpreps"], 3)
+        self.assertEqual(self.fake_charon.request_counts["GET seqruns"], 4)
+
+    def test_charon_unavailable(self):
+        self.fake_charon.error_rate = 1
+        project = organize_projects_from_flowcell([self.fc_dir], quiet=True,
+                                                  fallback_libprep="Z", config=self.config)[0]
+        # Not the fallback libprep: the samples are skipped, and not recorded as organized
+        self.assertEqual([sample.libpreps for sample in project], [{}, {}, {}])
+        self.fake_charon.error_rate = 0
+        project = organize_projects_from_flowcell([self.fc_dir], quiet=True,
+                                                  fallback_libprep="Z", config=self.config)[0]
+        self.assertEqual(project.samples["P101_101"].libpreps.keys(), ["A"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import time
+import unittest
+
+from ngi_pipeline.database.async_classes import AsyncCharonSession
+from ngi_pipeline.database.classes import CharonError
+from ngi_pipeline.tests.fake_charon import FakeCharon
+from ngi_pipeline.utils.charon import find_projects_from_samples_async
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+# Seconds each fake Charon response takes
+LATENCY = 0.1
+
+
+class TestAsyncCharonSession(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.fake_charon = FakeCharon(latency=LATENCY)
+        self.fake_charon.add_synthetic_project("P1", num_samples=2, libpreps_per_sample=2,
+                                               seqrun_ids=["sr1", "sr2"])
+        self.fake_charon.add_synthetic_project("P2", num_samples=1)
+        return self.fake_charon.make_app()
+
+    def setUp(self):
+        super(TestAsyncCharonSession, self).setUp()
+        self.fake_charon.base_url = self.get_url("")
+        config = self.fake_charon.config
+        config["charon"].update({"max_retries": 0, "max_concurrent_requests": 50})
+        self.charon_session = AsyncCharonSession(config=config)
+
+    def tearDown(self):
+        self.charon_session.close()
+        super(TestAsyncCharonSession, self).tearDown()
+
+    @gen_test
+    def test_project_get_tree(self):
+        start = time.time()
+        tree = yield self.charon_session.project_get_tree("P1")
+        elapsed = time.time() - start
+        self.assertEqual(list(tree.samples.keys()), ["P1_101", "P1_102"])
+        self.assertEqual([s["seqrunid"] for s in tree.get_seqruns("P1_101", "A")],
+                         ["sr1", "sr2"])
+        self.assertEqual([(s, l, r["seqrunid"]) for s, l, r in tree.iter_seqruns("P1_102")],
+                         [("P1_102", "A", "sr1"), ("P1_102", "A", "sr2"),
+                          ("P1_102", "B", "sr1"), ("P1_102", "B", "sr2")])
+        # 2 + 2 + 4 requests, but only three round trips
+        self.assertEqual(sum(self.fake_charon.request_counts.values()), 8)
+        self.assertLess(elapsed, 5 * LATENCY)
+
+    @gen_test
+    def test_requests_overlap(self):
+        start = time.time()
+        docs = yield [self.charon_session.project_get("P1") for _ in range(20)]
+        self.assertEqual(len(docs), 20)
+        self.assertLess(time.time() - start, 10 * LATENCY)
+
+    @gen_test
+    def test_find_projects_from_samples(self):
+        projects = yield find_projects_from_samples_async(["P1_101", "P2_101", "P9_999", "X_1"],
+                                                          charon_session=self.charon_session)
+        self.assertEqual(dict(projects), {"P1": {"P1_101"}, "P2": {"P2_101"}})
+
+    @gen_test
+    def test_errors_match_charon_session(self):
+        with self.assertRaises(CharonError) as cm:
+            yield self.charon_session.project_get("P9")
+        self.assertEqual(cm.exception.status_code, 404)
+        self.fake_charon.error_rate = 1
+        self.fake_charon.error_code = 500
+        with self.assertRaises(CharonError) as cm:
+            yield self.charon_session.project_get("P1")
+        self.assertEqual(cm.exception.status_code, 500)
+
+
+if __name__ == '__main__':
+    unittest.main()
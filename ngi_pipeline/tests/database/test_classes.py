@@ -2,9 +2,15 @@ import json
 import requests
 import unittest
 
-from ngi_pipeline.database.classes import CharonSession, CharonError
+from ngi_pipeline.database.classes import CharonSession, CharonBatchError, CharonError, \
+                                         build_charon_retry
+from ngi_pipeline.database.utils import load_charon_transport_settings
 from ngi_pipeline.tests.generate_test_data import generate_run_id
 
+# For the tests that replace the session's requests: no Charon is contacted
+OFFLINE_CHARON_CONFIG = {"charon": {"charon_api_token": "offline",
+                                    "charon_base_url": "http://charon.invalid"}}
+
 class TestCharonFunctions(unittest.TestCase):
 
     @classmethod
@@ -144,3 +150,164 @@ class TestCharonFunctions(unittest.TestCase):
 
     def test_17_project_delete(self):
         self.session.project_delete(projectid=self.p_id)
+
+
+class TestCharonTransportSettings(unittest.TestCase):
+
+    def test_load_charon_transport_settings_defaults(self):
+        settings = load_charon_transport_settings(config={"charon": {}})
+        self.assertEqual(settings["max_retries"], 3)
+        self.assertEqual(settings["timeout"]["get"], (3.05, 15.0))
+        self.assertEqual(settings["timeout"]["put"], (3.05, 30.0))
+
+    def test_load_charon_transport_settings_per_verb(self):
+        config = {"charon": {"pool_maxsize": 32,
+                             "timeout": {"default": 10, "put": [1, 60]}}}
+        settings = load_charon_transport_settings(config=config)
+        self.assertEqual(settings["pool_maxsize"], 32)
+        self.assertEqual(settings["timeout"]["post"], (10.0, 10.0))
+        self.assertEqual(settings["timeout"]["put"], (1.0, 60.0))
+
+    def test_load_charon_transport_settings_invalid_timeout(self):
+        with self.assertRaises(ValueError):
+            load_charon_transport_settings(config={"charon": {"timeout": {"get": "soon"}}})
+
+    def test_build_charon_retry(self):
+        settings = load_charon_transport_settings(config={"charon": {"max_retries": 5}})
+        retry = build_charon_retry(settings)
+        self.assertEqual(retry.total, 5)
+        self.assertTrue(retry.is_retry("GET", status_code=503))
+        self.assertFalse(retry.is_retry("POST", status_code=503))
+
+
+class TestCharonProjectTree(unittest.TestCase):
+
+    class FakeResponse(object):
+        def __init__(self, data):
+            self.data = data
+        def json(self):
+            return self.data
+
+    def setUp(self):
+        CharonSession._instances.pop(CharonSession, None)
+        self.session = CharonSession(config=OFFLINE_CHARON_CONFIG)
+        documents = {
+            ("project", "P1"): {"projectid": "P1", "status": "OPEN"},
+            ("samples", "P1"): {"samples": [{"sampleid": "P1_101"},
+                                            {"sampleid": "P1_102"}]},
+            ("sample", "P1", "P1_101"): {"sampleid": "P1_101", "status": "STALE"},
+            ("libpreps", "P1", "P1_101"): {"libpreps": [{"libprepid": "A", "qc": "PASSED"}]},
+            ("libpreps", "P1", "P1_102"): {"libpreps": []},
+            ("seqruns", "P1", "P1_101", "A"): {"seqruns": [{"seqrunid": "sr1",
+                                                            "alignment_status": "DONE"}]},
+        }
+        self.requested_urls = []
+        def fake_get(url, *args, **kwargs):
+            self.requested_urls.append(url)
+            key = tuple(url.split("/api/v1/")[1].split("/"))
+            return self.FakeResponse(documents[key])
+        self.session.get = fake_get
+
+    def tearDown(self):
+        del self.session.get
+        CharonSession._instances.pop(CharonSession, None)
+
+    def test_project_get_tree(self):
+        tree = self.session.project_get_tree("P1", max_workers=4)
+        self.assertEqual(tree.project["status"], "OPEN")
+        self.assertEqual(list(tree.samples.keys()), ["P1_101", "P1_102"])
+        self.assertEqual(tree.get_libpreps("P1_102"), [])
+        self.assertEqual(tree.get_seqruns("P1_101", "A")[0]["alignment_status"], "DONE")
+        self.assertEqual([(s, l, sr["seqrunid"]) for s, l, sr in tree.iter_seqruns()],
+                         [("P1_101", "A", "sr1")])
+        self.assertEqual(len(self.requested_urls), 5)
+
+    def test_project_get_tree_sees_pending_batch_updates(self):
+        self.session.put = lambda *args, **kwargs: requests.Response()
+        with self.session.batch_updates():
+            self.session.seqrun_update("P1", "P1_101", "A", "sr1", alignment_status="RUNNING")
+            tree = self.session.project_get_tree("P1")
+        self.assertEqual(tree.get_seqruns("P1_101", "A")[0]["alignment_status"], "RUNNING")
+
+    def test_project_get_tree_restrict_to_samples(self):
+        tree = self.session.project_get_tree("P1", restrict_to_samples=["P1_102"])
+        self.assertEqual(list(tree.samples.keys()), ["P1_102"])
+        with self.assertRaises(CharonError):
+            self.session.project_get_tree("P1", restrict_to_samples=["P1_999"])
+
+    def test_sample_get_tree(self):
+        tree = self.session.sample_get_tree("P1", "P1_101")
+        self.assertEqual(tree.project, {"projectid": "P1"})
+        self.assertEqual(tree.samples["P1_101"]["status"], "STALE")
+        self.assertEqual([(s, l, sr["seqrunid"]) for s, l, sr in tree.iter_seqruns()],
+                         [("P1_101", "A", "sr1")])
+        # Neither the project document nor the other samples are fetched
+        self.assertEqual(len(self.requested_urls), 3)
+
+
+class TestCharonUpdateBatch(unittest.TestCase):
+
+    def setUp(self):
+        CharonSession._instances.pop(CharonSession, None)
+        self.session = CharonSession(config=OFFLINE_CHARON_CONFIG)
+        self.puts = []
+        def fake_put(url, data=None, *args, **kwargs):
+            self.puts.append((url, json.loads(data)))
+            if "FAIL" in url:
+                raise CharonError("Charon access failure: not found", 404)
+            return requests.Response()
+        self.session.put = fake_put
+
+    def tearDown(self):
+        CharonSession._instances.pop(CharonSession, None)
+
+    def test_updates_merged_per_document(self):
+        with self.session.batch_updates(max_workers=2):
+            self.session.sample_update("P1", "P1_101", analysis_status="ANALYZED")
+            self.session.seqrun_update("P1", "P1_101", "A", "sr1", alignment_status="DONE")
+            with self.session.batch_updates():
+                self.session.sample_update("P1", "P1_101", duplication_pc=12.5)
+                self.session.seqrun_update("P1", "P1_101", "A", "sr1",
+                                           mean_autosomal_coverage=30)
+            self.assertEqual(self.puts, [])
+        self.assertEqual(len(self.puts), 2)
+        puts = dict(self.puts)
+        self.assertEqual(puts[self.session.construct_charon_url("sample", "P1", "P1_101")],
+                         {"sampleid": "P1_101", "analysis_status": "ANALYZED",
+                          "duplication_pc": 12.5})
+        self.assertEqual(puts[self.session.construct_charon_url("seqrun", "P1", "P1_101", "A", "sr1")],
+                         {"seqrunid": "sr1", "alignment_status": "DONE",
+                          "mean_autosomal_coverage": "30"})
+
+    def test_failures_reported_per_document(self):
+        with self.assertRaises(CharonBatchError) as cm:
+            with self.session.batch_updates():
+                self.session.sample_update("P1", "P1_101", analysis_status="FAILED")
+                self.session.sample_update("P1", "P1_FAIL", analysis_status="FAILED")
+        self.assertEqual(list(cm.exception.failures.keys()), ["P1/P1_FAIL"])
+        self.assertEqual(cm.exception.status_code, 404)
+        self.assertEqual(len(self.puts), 2)
+
+    def test_nested_failures_reported_at_outermost_flush(self):
+        reported = []
+        with self.assertRaises(CharonBatchError):
+            with self.session.batch_updates():
+                self.session.sample_update("P1", "P1_FAIL", analysis_status="FAILED")
+                with self.session.batch_updates() as batch:
+                    labels = set(["P1/P1_FAIL/A/sr1", "P1/P1_101/A/sr1"])
+                    batch.add_failure_handler(labels, lambda label, error:
+                                                      reported.append(label))
+                    self.session.seqrun_update("P1", "P1_FAIL", "A", "sr1",
+                                               alignment_status="DONE")
+                    self.session.seqrun_update("P1", "P1_101", "A", "sr1",
+                                               alignment_status="DONE")
+                self.assertEqual(reported, [])
+        # Only the failures of the nested block's own updates
+        self.assertEqual(reported, ["P1/P1_FAIL/A/sr1"])
+
+    def test_failed_flush_recorded_when_block_raises(self):
+        with self.assertRaises(OSError):
+            with self.session.batch_updates() as batch:
+                self.session.sample_update("P1", "P1_FAIL", analysis_status="ANALYZED")
+                raise OSError("qc dir missing")
+        self.assertEqual(list(batch.flush_error.failures.keys()), ["P1/P1_FAIL"])
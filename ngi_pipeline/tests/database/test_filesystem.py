@@ -4,6 +4,7 @@ import unittest
 from ngi_pipeline.conductor.classes import NGIProject, NGISample, NGILibraryPrep, NGISeqRun
 from ngi_pipeline.database.classes import CharonSession, CharonError
 from ngi_pipeline.database.filesystem import create_charon_entries_from_project
+from ngi_pipeline.tests.fake_charon import FakeCharon, fake_charon_session
 from ngi_pipeline.tests.generate_test_data import generate_run_id
 
 class TestCharonFunctions(unittest.TestCase):
@@ -44,3 +45,89 @@ class TestCharonFunctions(unittest.TestCase):
         finally:
             charon_session = CharonSession()
             charon_session.project_delete(project_obj.project_id)
+
+
+class TestCreateCharonEntriesFromProject(unittest.TestCase):
+
+    def setUp(self):
+        self.fake_charon = FakeCharon(seed=1)
+        self.fake_charon.start()
+        # GETs and PUTs are retried by the transport, POSTs are not
+        self.session_context = fake_charon_session(self.fake_charon, max_retries=5,
+                                                   retry_backoff_factor=0)
+        self.session_context.__enter__()
+        self.project_obj = NGIProject(name="Y.Mom_14_01", dirname="Y.Mom_14_01",
+                                      project_id="P100000", base_path=tempfile.mkdtemp())
+        for sample_num in range(10):
+            sample_obj = self.project_obj.add_sample(name="P100000_{}".format(101 + sample_num),
+                                                     dirname="P100000_{}".format(101 + sample_num))
+            for libprep_id in ("A", "B"):
+                libprep_obj = sample_obj.add_libprep(name=libprep_id, dirname=libprep_id)
+                libprep_obj.add_seqrun(name="sr1", dirname="sr1")
+
+    def tearDown(self):
+        self.session_context.__exit__(None, None, None)
+        self.fake_charon.stop()
+
+    def test_creates_only_missing_documents(self):
+        self.fake_charon.add_document("project", ("P100000",), name="Y.Mom_14_01")
+        self.fake_charon.add_document("sample", ("P100000", "P100000_101"),
+                                      analysis_status="ANALYZED")
+        create_charon_entries_from_project(self.project_obj)
+        self.assertEqual(len(self.fake_charon.documents["sample"]), 10)
+        self.assertEqual(len(self.fake_charon.documents["seqrun"]), 20)
+        self.assertEqual(self.fake_charon.request_counts["POST sample"], 9)
+        # Existing documents are left alone
+        self.assertEqual(self.fake_charon.documents["sample"][("P100000", "P100000_101")]
+                                                  ["analysis_status"], "ANALYZED")
+        # A second run only reads
+        self.fake_charon.reset_counts()
+        create_charon_entries_from_project(self.project_obj)
+        self.assertEqual(set(key.split()[0] for key in self.fake_charon.request_counts), {"GET"})
+
+    def test_force_overwrite_updates_changed_documents(self):
+        create_charon_entries_from_project(self.project_obj)
+        self.fake_charon.documents["libprep"][("P100000", "P100000_103", "B")]["qc"] = "FAILED"
+        self.fake_charon.reset_counts()
+        create_charon_entries_from_project(self.project_obj, force_overwrite=True)
+        self.assertEqual(self.fake_charon.request_counts["PUT libprep"], 1)
+        self.assertEqual(self.fake_charon.request_counts["PUT seqrun"], 0)
+        self.assertEqual(self.fake_charon.documents["libprep"][("P100000", "P100000_103", "B")]
+                                                  ["qc"], "PASSED")
+
+    def test_only_failed_documents_retried(self):
+        self.fake_charon.add_document("project", ("P100000",), name="Y.Mom_14_01")
+        self.fake_charon.error_rate = 0.2
+        try:
+            create_charon_entries_from_project(self.project_obj)
+        except CharonError:
+            pass
+        self.fake_charon.error_rate = 0
+        self.fake_charon.reset_counts()
+        create_charon_entries_from_project(self.project_obj)
+        self.assertEqual(len(self.fake_charon.documents["seqrun"]), 20)
+        # Failed creations were retried; few documents were left for the second run
+        num_created = sum(count for key, count in self.fake_charon.request_counts.items()
+                          if key.startswith("POST"))
+        self.assertLess(num_created, 10)
+
+    def test_force_overwrite_updates_project(self):
+        create_charon_entries_from_project(self.project_obj)
+        self.fake_charon.documents["project"][("P100000",)]["status"] = "CLOSED"
+        self.fake_charon.reset_counts()
+        create_charon_entries_from_project(self.project_obj, force_overwrite=True)
+        self.assertEqual(self.fake_charon.request_counts["PUT project"], 1)
+        self.assertEqual(self.fake_charon.documents["project"][("P100000",)]["status"], "OPEN")
+
+    def test_delete_existing_deletes_every_level(self):
+        create_charon_entries_from_project(self.project_obj)
+        seqrun_key = ("P100000", "P100000_101", "A", "sr1")
+        self.fake_charon.documents["seqrun"][seqrun_key]["alignment_status"] = "DONE"
+        self.fake_charon.reset_counts()
+        create_charon_entries_from_project(self.project_obj, delete_existing=True)
+        self.assertEqual(self.fake_charon.request_counts["DELETE seqrun"], 20)
+        self.assertEqual(self.fake_charon.request_counts["DELETE libprep"], 20)
+        self.assertEqual(self.fake_charon.request_counts["DELETE sample"], 10)
+        self.assertEqual(len(self.fake_charon.documents["seqrun"]), 20)
+        self.assertEqual(self.fake_charon.documents["seqrun"][seqrun_key]["alignment_status"],
+                         "NOT_RUNNING")
@@ -0,0 +1,72 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ngi_pipeline.database.instrumentation import CharonRequestStats, CHARON_STATS, \
+                                                  endpoint_from_url
+from ngi_pipeline.tests.fake_charon import FakeCharon, fake_charon_session
+
+
+def update_all_seqruns(charon_session, projectid):
+    tree = charon_session.project_get_tree(projectid)
+    with charon_session.batch_updates():
+        for sample_id, libprep_id, seqrun in tree.iter_seqruns():
+            charon_session.seqrun_update(projectid, sample_id, libprep_id,
+                                         seqrun["seqrunid"], alignment_status="DONE")
+
+
+class TestCharonRequestStats(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = CharonRequestStats()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_endpoint_from_url(self):
+        self.assertEqual(endpoint_from_url("http://charon/api/v1/seqrun/P1/P1_101/A/R"), "seqrun")
+        self.assertEqual(endpoint_from_url("http://charon/other"), "<other>")
+
+    def test_record_and_report(self):
+        for seconds in (0.001, 0.02, 0.02, 3):
+            self.stats.record("GET", "http://c/api/v1/sample/P1/P1_101", 200, seconds,
+                              bytes_received=100)
+        self.stats.record("PUT", "http://c/api/v1/sample/P1/P1_101", 404, 0.01,
+                          bytes_sent=10)
+        get_stats = self.stats.endpoints[("GET", "sample")]
+        self.assertEqual(get_stats.num_requests, 4)
+        self.assertEqual(get_stats.bytes_received, 400)
+        self.assertEqual(get_stats.quantile(0.5), 0.025)
+        self.assertEqual(get_stats.quantile(1), 3)
+        self.assertEqual(self.stats.endpoints[("PUT", "sample")].num_errors, 1)
+        caller = "{}.test_record_and_report".format(__name__)
+        self.assertEqual(self.stats.callers[(caller, "GET", "sample")], 4)
+        self.assertIn("{} issued 4 GET sample".format(caller), self.stats.summary())
+
+        metrics = self.stats.to_openmetrics()
+        self.assertIn('charon_requests_total{method="PUT",endpoint="sample",code="404"} 1', metrics)
+        self.assertIn('charon_request_duration_seconds_bucket{method="GET",endpoint="sample",le="0.025"} 3',
+                      metrics)
+        self.assertIn('charon_request_duration_seconds_bucket{method="GET",endpoint="sample",le="+Inf"} 4',
+                      metrics)
+        self.assertTrue(metrics.endswith("# EOF\n"))
+
+        json_path = self.stats.dump(os.path.join(self.tmp_dir, "stats-{pid}.json"))
+        self.assertEqual(os.path.basename(json_path), "stats-{}.json".format(os.getpid()))
+        with open(json_path) as f:
+            self.assertEqual(json.load(f)["endpoints"]["GET sample"]["requests"], 4)
+
+    def test_session_requests_attributed_to_caller(self):
+        with FakeCharon() as fake_charon:
+            fake_charon.add_synthetic_project("P1", num_samples=3, seqrun_ids=["R1", "R2"])
+            with fake_charon_session(fake_charon, max_retries=0) as charon_session:
+                CHARON_STATS.reset()
+                update_all_seqruns(charon_session, "P1")
+        caller = "{}.update_all_seqruns".format(__name__)
+        # Requests made from the thread pools count towards the caller too
+        self.assertEqual(CHARON_STATS.callers[(caller, "GET", "seqruns")], 3)
+        self.assertEqual(CHARON_STATS.callers[(caller, "PUT", "seqrun")], 6)
+        self.assertEqual(CHARON_STATS.endpoints[("PUT", "seqrun")].status_codes[204], 6)
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ngi_pipeline.database.classes import CharonBatchError
+from ngi_pipeline.database.journal import CharonJournal
+from ngi_pipeline.tests.fake_charon import FakeCharon, fake_charon_session
+
+
+class TestCharonJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.journal = CharonJournal(os.path.join(self.tmp_dir, "charon_journal.sql"))
+        self.fake_charon = FakeCharon()
+        self.fake_charon.start()
+        self.fake_charon.add_synthetic_project("P1", num_samples=2, seqrun_ids=["sr1"])
+        self.session_context = fake_charon_session(self.fake_charon, max_retries=0)
+        self.charon_session = self.session_context.__enter__()
+
+    def tearDown(self):
+        self.session_context.__exit__(None, None, None)
+        self.fake_charon.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def sample_status(self, sampleid):
+        return self.fake_charon.documents["sample"][("P1", sampleid)]["analysis_status"]
+
+    def test_unavailable_updates_journaled_and_replayed(self):
+        self.fake_charon.error_rate = 1
+        with self.charon_session.batch_updates(journal=self.journal) as batch:
+            self.charon_session.sample_update("P1", "P1_101", analysis_status="ANALYZED")
+            self.charon_session.seqrun_update("P1", "P1_101", "A", "sr1",
+                                              alignment_status="DONE")
+        self.assertEqual(batch.unavailable_error.status_code, 503)
+        self.assertEqual(len(self.journal), 2)
+        self.assertEqual(self.journal.pending()[0].label, "P1/P1_101")
+        # Still down: nothing is lost
+        self.assertEqual(self.journal.replay(self.charon_session).remaining, 2)
+        self.assertEqual(self.journal.pending()[0].attempts, 1)
+
+        self.fake_charon.error_rate = 0
+        self.assertEqual(self.journal.replay(self.charon_session), (2, 0, 0))
+        self.assertEqual(len(self.journal), 0)
+        self.assertEqual(self.sample_status("P1_101"), "ANALYZED")
+        self.assertEqual(self.fake_charon.documents["seqrun"][("P1", "P1_101", "A", "sr1")]
+                                                  ["alignment_status"], "DONE")
+
+    def test_journal_keeps_order_and_deduplicates(self):
+        url = self.charon_session.construct_charon_url("sample", "P1", "P1_101")
+        self.journal.record(url, {"analysis_status": "FAILED"}, label="P1/P1_101")
+        self.journal.record(url, {"analysis_status": "ANALYZED"}, label="P1/P1_101")
+        self.journal.record(url, {"analysis_status": "FAILED"}, label="P1/P1_101")
+        self.assertEqual([e.data for e in self.journal.pending()],
+                         ['{"analysis_status": "ANALYZED"}', '{"analysis_status": "FAILED"}'])
+        # Later updates to a journaled document queue up behind it
+        with self.charon_session.batch_updates(journal=self.journal) as batch:
+            self.charon_session.sample_update("P1", "P1_101", analysis_status="ANALYZED")
+            self.charon_session.sample_update("P1", "P1_102", analysis_status="ANALYZED")
+        # Queued behind the journal, but not because Charon is unavailable
+        self.assertIsNone(batch.unavailable_error)
+        self.assertEqual(self.sample_status("P1_101"), "TO_ANALYZE")
+        self.assertEqual(self.sample_status("P1_102"), "ANALYZED")
+        self.assertEqual(len(self.journal), 3)
+        self.journal.replay(self.charon_session)
+        self.assertEqual(self.sample_status("P1_101"), "ANALYZED")
+
+    def test_rejected_updates_dropped(self):
+        url = self.charon_session.construct_charon_url("sample", "P1", "P1_999")
+        self.journal.record(url, {"analysis_status": "FAILED"}, label="P1/P1_999")
+        self.assertEqual(self.journal.replay(self.charon_session), (0, 1, 0))
+        self.assertEqual(len(self.journal), 0)
+
+    def test_refused_updates_still_raise(self):
+        with self.assertRaises(CharonBatchError):
+            with self.charon_session.batch_updates(journal=self.journal):
+                self.charon_session.sample_update("P1", "P1_999", analysis_status="FAILED")
+        self.assertEqual(len(self.journal), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
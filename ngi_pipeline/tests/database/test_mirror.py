@@ -0,0 +1,112 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from ngi_pipeline.database.classes import CharonError, CharonProjectTree
+from ngi_pipeline.database.mirror import CharonMirror
+
+
+class FakeCharonSession(object):
+    """Serves a fixed project tree and counts the fetches."""
+    def __init__(self):
+        self.num_fetches = 0
+        self.updates = []
+        self.seqrun_status = "RUNNING"
+        self.write_listeners = []
+
+    def add_write_listener(self, listener):
+        self.write_listeners.append(listener)
+
+    def current_batch(self):
+        return None
+
+    def project_get_tree(self, projectid):
+        self.num_fetches += 1
+        tree = CharonProjectTree({"projectid": projectid, "status": "OPEN"})
+        tree.add_sample({"sampleid": "P1_101", "modified": "2015-01-01"})
+        tree.add_sample({"sampleid": "P1_102", "modified": "2015-01-01"})
+        tree.add_libprep("P1_101", {"libprepid": "A", "qc": "PASSED"})
+        tree.add_seqrun("P1_101", "A", {"seqrunid": "sr1",
+                                        "alignment_status": self.seqrun_status})
+        return tree
+
+    def sample_update(self, projectid, sampleid, **kwargs):
+        self.updates.append((projectid, sampleid, kwargs))
+        for listener in self.write_listeners:
+            listener('PUT', "http://charon/api/v1/sample/{}/{}".format(projectid, sampleid))
+
+
+class TestCharonMirror(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, "charon_mirror.sql")
+        self.charon = FakeCharonSession()
+        self.mirror = CharonMirror(self.db_path, max_staleness=3600,
+                                   charon_session=self.charon)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_reads_served_from_mirror(self):
+        self.assertEqual(self.mirror.project_get("P1")["status"], "OPEN")
+        self.assertEqual([s["sampleid"] for s in self.mirror.project_get_samples("P1")["samples"]],
+                         ["P1_101", "P1_102"])
+        self.assertEqual(self.mirror.seqrun_get("P1", "P1_101", "A", "sr1")["alignment_status"],
+                         "RUNNING")
+        self.assertEqual(self.mirror.sample_get_libpreps("P1", "P1_102"), {"libpreps": []})
+        self.assertEqual([sr["seqrunid"] for _, _, sr in
+                          self.mirror.sample_get_tree("P1", "P1_101").iter_seqruns()], ["sr1"])
+        self.assertEqual(self.charon.num_fetches, 1)
+        with self.assertRaises(CharonError):
+            self.mirror.sample_get("P1", "P1_999")
+
+    def test_mirror_persists_across_instances(self):
+        self.mirror.project_get("P1")
+        other_mirror = CharonMirror(self.db_path, max_staleness=3600,
+                                    charon_session=self.charon)
+        tree = other_mirror.project_get_tree("P1", restrict_to_samples=["P1_101"])
+        self.assertEqual(list(tree.samples.keys()), ["P1_101"])
+        self.assertEqual(tree.get_seqruns("P1_101", "A")[0]["seqrunid"], "sr1")
+        self.assertEqual(self.charon.num_fetches, 1)
+
+    def test_stale_project_is_resynced(self):
+        self.mirror.project_get("P1")
+        self.mirror.max_staleness = 0
+        time.sleep(0.01)
+        self.charon.seqrun_status = "DONE"
+        self.assertEqual(self.mirror.seqrun_get("P1", "P1_101", "A", "sr1")["alignment_status"],
+                         "DONE")
+        self.assertEqual(self.charon.num_fetches, 2)
+
+    def test_writes_pass_through_and_invalidate(self):
+        self.mirror.project_get("P1")
+        self.mirror.sample_update("P1", "P1_101", analysis_status="ANALYZED")
+        self.assertEqual(self.charon.updates, [("P1", "P1_101", {"analysis_status": "ANALYZED"})])
+        self.mirror.project_get("P1")
+        self.assertEqual(self.charon.num_fetches, 2)
+
+    def test_writes_bypassing_the_mirror_invalidate(self):
+        self.mirror.project_get("P1")
+        # e.g. the jobs sweep, which writes through the CharonSession itself
+        self.charon.sample_update("P1", "P1_102", analysis_status="ANALYZED")
+        self.charon.seqrun_status = "DONE"
+        self.assertEqual(self.mirror.seqrun_get("P1", "P1_101", "A", "sr1")["alignment_status"],
+                         "DONE")
+        self.assertEqual(self.charon.num_fetches, 2)
+        # Another process sharing the database does not reuse the stale copy either
+        other_mirror = CharonMirror(self.db_path, max_staleness=3600,
+                                    charon_session=FakeCharonSession())
+        self.charon.sample_update("P1", "P1_102", analysis_status="FAILED")
+        other_mirror.project_get("P1")
+        self.assertEqual(other_mirror.charon_session.num_fetches, 1)
+
+    def test_project_tree_is_a_copy(self):
+        tree = self.mirror.project_get_tree("P1")
+        tree.samples["P1_101"]["status"] = "ABORTED"
+        del tree.samples["P1_102"]
+        tree = self.mirror.project_get_tree("P1")
+        self.assertEqual(list(tree.samples), ["P1_101", "P1_102"])
+        self.assertNotIn("status", tree.samples["P1_101"])
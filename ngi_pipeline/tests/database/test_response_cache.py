@@ -0,0 +1,84 @@
+import time
+import unittest
+
+from ngi_pipeline.database.instrumentation import CHARON_STATS
+from ngi_pipeline.database.response_cache import parse_charon_url
+from ngi_pipeline.tests.fake_charon import FakeCharon, fake_charon_session
+
+
+class TestCharonResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.fake_charon = FakeCharon()
+        self.fake_charon.start()
+        self.fake_charon.add_synthetic_project("P1", num_samples=2, seqrun_ids=["sr1"])
+        self.session_context = fake_charon_session(self.fake_charon, cache_ttl=60)
+        self.charon_session = self.session_context.__enter__()
+        self.fake_charon.reset_counts()
+
+    def tearDown(self):
+        self.session_context.__exit__(None, None, None)
+        self.fake_charon.stop()
+
+    def test_repeated_gets_served_from_cache(self):
+        first = self.charon_session.sample_get("P1", "P1_101")
+        first["status"] = "mutated by the caller"
+        second = self.charon_session.sample_get("P1", "P1_101")
+        self.assertEqual(second["status"], "NEW")
+        self.assertEqual(self.fake_charon.request_counts["GET sample"], 1)
+        stats = self.charon_session.response_cache.stats()
+        self.assertEqual((stats["hit"], stats["miss"], stats["entries"]), (1, 1, 1))
+
+    def test_writes_invalidate(self):
+        self.charon_session.sample_get("P1", "P1_101")
+        self.charon_session.sample_get("P1", "P1_102")
+        self.charon_session.project_get_samples("P1")
+        self.charon_session.sample_update("P1", "P1_101", status="STALE")
+        self.assertEqual(self.charon_session.sample_get("P1", "P1_101")["status"], "STALE")
+        self.assertEqual([s["status"] for s in
+                          self.charon_session.project_get_samples("P1")["samples"]],
+                         ["STALE", "NEW"])
+        # The sibling was not touched
+        self.charon_session.sample_get("P1", "P1_102")
+        self.assertEqual(self.fake_charon.request_counts["GET sample"], 3)
+        self.assertEqual(self.fake_charon.request_counts["GET samples"], 2)
+
+        self.charon_session.libprep_get_seqruns("P1", "P1_102", "A")
+        self.charon_session.sample_delete("P1", "P1_102")
+        self.assertEqual(self.charon_session.project_get_samples("P1")["samples"][0]["sampleid"],
+                         "P1_101")
+        self.assertNotIn(self.charon_session.construct_charon_url("seqruns", "P1", "P1_102", "A"),
+                         self.charon_session.response_cache._entries)
+
+    def test_updates_sent_by_batch_invalidate(self):
+        self.charon_session.seqrun_get("P1", "P1_101", "A", "sr1")
+        with self.charon_session.batch_updates():
+            self.charon_session.seqrun_update("P1", "P1_101", "A", "sr1",
+                                              alignment_status="DONE")
+        self.assertEqual(self.charon_session.seqrun_get("P1", "P1_101", "A",
+                                                        "sr1")["alignment_status"], "DONE")
+        self.assertEqual(self.fake_charon.request_counts["GET seqrun"], 2)
+
+    def test_expired_responses_revalidated_with_etag(self):
+        self.charon_session.response_cache.ttl = 0.01
+        CHARON_STATS.reset()
+        self.charon_session.project_get("P1")
+        time.sleep(0.02)
+        self.assertEqual(self.charon_session.project_get("P1")["projectid"], "P1")
+        self.assertEqual(self.fake_charon.request_counts["GET project"], 2)
+        self.assertEqual(self.charon_session.response_cache.stats()["revalidated"], 1)
+        self.assertEqual(CHARON_STATS.cache_events["revalidated"], 1)
+        self.assertEqual(CHARON_STATS.endpoints[("GET", "project")].status_codes[304], 1)
+        # A changed document is transferred again
+        time.sleep(0.02)
+        self.fake_charon.documents["project"][("P1",)]["status"] = "CLOSED"
+        self.assertEqual(self.charon_session.project_get("P1")["status"], "CLOSED")
+
+    def test_parse_charon_url(self):
+        self.assertEqual(parse_charon_url("http://charon/api/v1/libprep/P1/P1_101/A"),
+                         ("libprep", ("P1", "P1_101", "A")))
+        self.assertEqual(parse_charon_url("http://charon/api/v1/projects"), ("projects", ()))
+
+
+if __name__ == '__main__':
+    unittest.main()
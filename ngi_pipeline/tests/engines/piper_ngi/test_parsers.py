@@ -0,0 +1,215 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from ngi_pipeline.engines.piper_ngi import parsers
+from ngi_pipeline.engines.piper_ngi.parsers import find_qualimap_genome_results, \
+                                                   harvest_qualimap_metrics, \
+                                                   iter_genotype_concordance, \
+                                                   parse_deduplication_percentage, \
+                                                   parse_duplication_metrics, \
+                                                   parse_genotype_concordance, \
+                                                   parse_genotype_concordance_for_sample, \
+                                                   parse_mean_coverage_from_qualimap, \
+                                                   parse_qualimap_genome_results
+
+GENOME_RESULTS = """BamQC report
+-----------------------------------
+
+>>>>>>> Input
+
+     bam file = P1_101.AHFCWKCCXX.P1_101.1.bam
+
+>>>>>>> Globals
+
+     number of windows = 400
+     number of reads = 1,000,000
+     number of mapped reads = 990,000 (99%)
+     number of duplicated reads (flagged) = 50,000
+     number of mapped bases = 148,500,000 bp
+
+>>>>>>> Coverage
+
+     mean coverageData = 30.5X
+     std coverageData = 12.25X
+
+>>>>>>> Coverage per contig
+
+\t1\t1000\t30000\t30.0\t10.0
+\t2\t3000\t30000\t10.0\t5.0
+\tX\t1000\t90000\t90.0\t20.0
+"""
+
+GT_CONCORDANCE = """#:GATKReport.v1.1:5
+#:GATKTable:7:3:%s:%s:%.8f:%.8f:%.8f:%.8f:%.8f:%.8f:;
+#:GATKTable:GenotypeConcordance_Counts
+Sample  NO_CALL_HOM_REF  HOM_REF_HOM_REF
+ALL     10               20
+
+#:GATKTable:4:4:%s:%.8f:%.8f:%.8f:;
+#:GATKTable:GenotypeConcordance_Summary:Per-sample summary statistics
+Sample     Non-Reference Sensitivity  Non-Reference Discrepancy  Overall_Genotype_Concordance
+ALL        0.990                      0.010                      0.991
+P1_101     0.990                      0.010                      0.995
+P1_102     0.980                      0.020
+P1_103     0.980                      0.020                      NaN%
+P1_104     0.970                      0.030                      0.975
+
+#:GATKTable:GenotypeConcordance_CompProportions
+Sample  P1_105
+ALL     1.0
+"""
+
+DUPLICATION_METRICS = """## htsjdk.samtools.metrics.StringHeader
+# picard.sam.markduplicates.MarkDuplicates INPUT=[P1_101.bam] OUTPUT=P1_101.dedup.bam
+## htsjdk.samtools.metrics.StringHeader
+# Started on: Fri Jan 01 00:00:00 CET 2016
+
+## METRICS CLASS\tpicard.sam.DuplicationMetrics
+LIBRARY\tUNPAIRED_READS_EXAMINED\tREAD_PAIRS_EXAMINED\tUNMAPPED_READS\tPERCENT_DUPLICATION\tESTIMATED_LIBRARY_SIZE
+P1_101_lib A\t1000\t500000\t2000\t0.0525\t
+P1_101_lib B\t10\t5000\t20\t0.01\t100000
+
+## HISTOGRAM\tjava.lang.Double
+BIN\tVALUE
+1.0\t1.0
+"""
+
+
+class TestQualimapParsers(unittest.TestCase):
+
+    def setUp(self):
+        self.qc_dir = tempfile.mkdtemp()
+        for lane in (1, 2):
+            lane_dir = os.path.join(self.qc_dir, "P1_101.AHFCWKCCXX.P1_101.{}.qc".format(lane))
+            os.mkdir(lane_dir)
+            with open(os.path.join(lane_dir, "genome_results.txt"), 'w') as f:
+                f.write(GENOME_RESULTS)
+        self.genome_results = os.path.join(lane_dir, "genome_results.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.qc_dir)
+
+    def test_parse_qualimap_genome_results(self):
+        results = parse_qualimap_genome_results(self.genome_results)
+        self.assertEqual((results.reads, results.mapped_reads, results.duplicated_reads,
+                          results.mapped_bases), (1000000, 990000, 50000, 148500000))
+        self.assertEqual((results.mean_coverage, results.std_coverage), (30.5, 12.25))
+        self.assertEqual(sorted(results.contig_coverage), ["1", "2", "X"])
+        self.assertEqual(results.contig_coverage["X"].mean_coverage, 90.0)
+        # Contigs 1-22 only
+        self.assertEqual(results.autosomal_coverage, 15.0)
+
+    def test_malformed_contig_rows_skipped(self):
+        with open(self.genome_results, 'w') as f:
+            f.write(GENOME_RESULTS.replace("\tX\t1000\t90000\t90.0\t20.0",
+                                           "\tName\tLength\tMapped bases\tMean coverage\t"
+                                           "Standard deviation\n\tX\t1000\t90000\tnan%\t-"))
+        results = parse_qualimap_genome_results(self.genome_results)
+        self.assertEqual(sorted(results.contig_coverage), ["1", "2"])
+        self.assertEqual(results.autosomal_coverage, 15.0)
+
+    def test_reparsed_when_changed(self):
+        self.assertEqual(parse_qualimap_genome_results(self.genome_results).reads, 1000000)
+        with open(self.genome_results, 'w') as f:
+            f.write(GENOME_RESULTS.replace("1,000,000", "2,000,000 "))
+        self.assertEqual(parse_qualimap_genome_results(self.genome_results).reads, 2000000)
+
+    def test_mean_coverage_from_qualimap(self):
+        self.assertEqual(len(find_qualimap_genome_results(self.qc_dir, "P1_101",
+                                                          fcid="AHFCWKCCXX")), 2)
+        self.assertEqual(parse_mean_coverage_from_qualimap(
+                self.qc_dir, "P1_101", seqrun_id="160101_ST-E00201_0123_AHFCWKCCXX"), 30.0)
+        with self.assertRaises(OSError):
+            find_qualimap_genome_results(self.qc_dir, "P1_102")
+
+    def _add_lane(self, lane_dir_name, genome_results=GENOME_RESULTS):
+        lane_dir = os.path.join(self.qc_dir, lane_dir_name)
+        os.mkdir(lane_dir)
+        if genome_results is not None:
+            with open(os.path.join(lane_dir, "genome_results.txt"), 'w') as f:
+                f.write(genome_results)
+
+    def test_harvest_qualimap_metrics(self):
+        self._add_lane("P1_101.BHFCWKCCXX.P1_101.1.qc",
+                       GENOME_RESULTS.replace("1,000,000", "3,000,000"))
+        self._add_lane("P1-102.AHFCWKCCXX.P1-102.1.qc")
+        self._add_lane("P1_103.AHFCWKCCXX.P1_103.1.qc")
+        self._add_lane("P1_103.AHFCWKCCXX.P1_103.2.qc", genome_results=None)
+        self._add_lane("P1_104.AHFCWKCCXX.P1_104.1.qc")
+        for processes in (1, 2):
+            with patch.object(parsers, "QUALIMAP_FILES_PER_PROCESS", 1):
+                metrics = harvest_qualimap_metrics(self.qc_dir, ["P1_101", "P1_102", "P1_103"],
+                                                   processes=processes)
+            # P1_103's second lane has no results and P1_104 was not asked for
+            self.assertEqual(sorted(metrics), [("P1_101", "AHFCWKCCXX"), ("P1_101", "BHFCWKCCXX"),
+                                               ("P1_102", "AHFCWKCCXX")])
+            self.assertEqual(metrics["P1_101", "AHFCWKCCXX"][:2], (30.0, 2000000))
+            self.assertEqual(metrics["P1_101", "BHFCWKCCXX"][:2], (15.0, 3000000))
+            self.assertEqual(len(metrics["P1_102", "AHFCWKCCXX"].genome_results), 1)
+
+
+class TestGenotypeConcordanceParsers(unittest.TestCase):
+
+    def setUp(self):
+        self.gtc_dir = tempfile.mkdtemp()
+        self.gtc_file = os.path.join(self.gtc_dir, "P1_101.gt_concordance")
+        with open(self.gtc_file, 'w') as f:
+            f.write(GT_CONCORDANCE)
+
+    def tearDown(self):
+        shutil.rmtree(self.gtc_dir)
+
+    def test_parse_genotype_concordance(self):
+        # P1_102 has too few fields and P1_103 no number
+        self.assertEqual(parse_genotype_concordance(self.gtc_file),
+                         {"P1_101": 0.995, "P1_104": 0.975})
+        self.assertEqual(list(iter_genotype_concordance(self.gtc_file, ["P1_104", "P1_105"])),
+                         [("P1_104", 0.975)])
+        with open(self.gtc_file, 'w') as f:
+            f.write(GT_CONCORDANCE.split("#:GATKTable:4:4")[0])
+        with self.assertRaises(ValueError):
+            parse_genotype_concordance(self.gtc_file)
+
+    def test_parse_genotype_concordance_for_sample(self):
+        self.assertEqual(parse_genotype_concordance_for_sample(self.gtc_file, "P1_101"), 0.995)
+        self.assertIsNone(parse_genotype_concordance_for_sample(self.gtc_file, "P1_105"))
+
+
+class TestPicardMetricsParsers(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.metrics_dir)
+
+    def write_metrics(self, contents, file_name="P1_101.metrics", open_f=open):
+        metrics_file = os.path.join(self.metrics_dir, file_name)
+        with open_f(metrics_file, 'w') as f:
+            f.write(contents)
+        return metrics_file
+
+    def test_parse_duplication_metrics(self):
+        for metrics_file in (self.write_metrics(DUPLICATION_METRICS),
+                             self.write_metrics(DUPLICATION_METRICS, "P1_101.metrics.gz", gzip.open)):
+            self.assertEqual(parse_duplication_metrics(metrics_file),
+                             {"LIBRARY": "P1_101_lib A", "UNPAIRED_READS_EXAMINED": 1000,
+                              "READ_PAIRS_EXAMINED": 500000, "UNMAPPED_READS": 2000,
+                              "PERCENT_DUPLICATION": 0.0525, "ESTIMATED_LIBRARY_SIZE": None})
+            self.assertEqual(parse_deduplication_percentage(metrics_file), 5.25)
+
+    def test_malformed_metrics(self):
+        for contents in (DUPLICATION_METRICS.split("## METRICS")[0],
+                         DUPLICATION_METRICS.replace("\t100000", "\t100000\t1"),
+                         DUPLICATION_METRICS.replace("\t0.0525", "\tNaN%")):
+            with self.assertRaises(ValueError):
+                parse_deduplication_percentage(self.write_metrics(contents))
+
+
+if __name__ == '__main__':
+    unittest.main()
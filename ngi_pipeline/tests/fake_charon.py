@@ -0,0 +1,309 @@
+"""An in-process stand-in for Charon, for tests and benchmarks.
+
+FakeCharon implements the parts of the Charon REST API that CharonSession and
+AsyncCharonSession use (the project/sample/libprep/seqrun documents, their
+listings and projectidsfromsampleid) on an in-memory store. Every response can
+be delayed (to model network latency) and a fraction of them can be failed
+(to model an overloaded server).
+
+    with FakeCharon(latency=0.005) as fake_charon:
+        fake_charon.add_synthetic_project("P1000", num_samples=100)
+        with fake_charon_session(fake_charon) as charon_session:
+            charon_session.project_get_tree("P1000")
+        print(fake_charon.request_counts)
+"""
+import collections
+import contextlib
+import datetime
+import json
+import random
+import threading
+
+from ngi_pipeline.database.classes import CharonSession
+from ngi_pipeline.tests.generate_test_data import generate_run_id
+from tornado import gen, web
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+
+# Levels of the hierarchy and the number of ids in a document's URL
+DOCUMENT_LEVELS = collections.OrderedDict([("project", 1), ("sample", 2),
+                                           ("libprep", 3), ("seqrun", 4)])
+# Listing name -> level listed
+LISTINGS = {"projects": "project", "samples": "sample",
+            "libpreps": "libprep", "seqruns": "seqrun"}
+
+
+class FakeCharon(object):
+    """An in-memory Charon served over HTTP from a background thread."""
+
+    def __init__(self, latency=0, error_rate=0, error_code=503,
+                 api_token="fake-charon-token", seed=None):
+        """
+        :param float latency: Seconds to wait before each response
+        :param float error_rate: Fraction of requests (0-1) to fail with error_code
+        :param int error_code: The status code of the injected failures
+        :param str api_token: The X-Charon-API-token requests must carry (None to not check)
+        :param int seed: Seed for choosing which requests fail (optional)
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.api_token = api_token
+        self._random = random.Random(seed)
+        # {level: OrderedDict(id tuple: document)}
+        self.documents = dict((level, collections.OrderedDict()) for level in DOCUMENT_LEVELS)
+        # e.g. {"GET sample": 12}
+        self.request_counts = collections.Counter()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._io_loop = None
+        self.base_url = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def __repr__(self):
+        return "<FakeCharon {}>".format(self.base_url or "(not started)")
+
+    @property
+    def config(self):
+        """A config dict pointing CharonSession/AsyncCharonSession at this server."""
+        return {"charon": {"charon_base_url": self.base_url,
+                           "charon_api_token": self.api_token or "unused"}}
+
+    def make_app(self):
+        """Return the tornado Application serving the API (e.g. for AsyncHTTPTestCase)."""
+        return web.Application([(r"/api/v1/(\w+)/?(.*)", FakeCharonHandler,
+                                 {"fake_charon": self})],
+                               # Failures are expected; don't fill the log with them
+                               log_function=lambda handler: None)
+
+    def start(self):
+        """Serve on a free localhost port from a daemon thread; sets base_url."""
+        sockets = bind_sockets(0, "127.0.0.1")
+        self.base_url = "http://127.0.0.1:{}".format(sockets[0].getsockname()[1])
+        started = threading.Event()
+
+        def serve():
+            self._io_loop = IOLoop()
+            self._io_loop.make_current()
+            server = HTTPServer(self.make_app())
+            server.add_sockets(sockets)
+            started.set()
+            self._io_loop.start()
+            server.stop()
+            self._io_loop.close(all_fds=True)
+
+        self._thread = threading.Thread(target=serve, name="FakeCharon")
+        self._thread.daemon = True
+        self._thread.start()
+        started.wait()
+
+    def stop(self):
+        if self._thread is not None:
+            self._io_loop.add_callback(self._io_loop.stop)
+            self._thread.join()
+            self._thread = None
+
+    def reset_counts(self):
+        self.request_counts.clear()
+
+    ## Populating the store
+    def add_document(self, level, ids, **fields):
+        """Store a document, returning it.
+
+        :param str level: "project", "sample", "libprep" or "seqrun"
+        :param tuple ids: e.g. ("P123", "P123_101", "A") for a libprep
+        """
+        document = dict(fields)
+        document.update(zip(_id_fields(level), ids))
+        now = datetime.datetime.utcnow().isoformat()
+        document.setdefault("created", now)
+        document["modified"] = now
+        with self._lock:
+            self.documents[level][tuple(ids)] = document
+        return document
+
+    def add_synthetic_project(self, projectid, num_samples, libpreps_per_sample=1,
+                              seqruns_per_libprep=1, seqrun_ids=None, **project_fields):
+        """Add a project with samples <projectid>_101, _102, ..., each with
+        libpreps A, B, ... each with the same seqruns.
+
+        :param list seqrun_ids: The seqrun ids to use (default: random run ids)
+
+        :returns: The project document
+        :rtype: dict
+        """
+        if seqrun_ids is None:
+            seqrun_ids = [generate_run_id() for _ in range(seqruns_per_libprep)]
+        project_fields.setdefault("name", "T.Synthetic_{}_01".format(projectid[-2:]))
+        project_fields.setdefault("status", "OPEN")
+        project_fields.setdefault("best_practice_analysis", "whole_genome_reseq")
+        project_fields.setdefault("sequencing_facility", "NGI-S")
+        project = self.add_document("project", (projectid,), **project_fields)
+        for sample_num in range(num_samples):
+            sampleid = "{}_{}".format(projectid, 101 + sample_num)
+            self.add_document("sample", (projectid, sampleid), status="NEW",
+                              analysis_status="TO_ANALYZE", total_autosomal_coverage=0)
+            for libprep_num in range(libpreps_per_sample):
+                libprepid = chr(ord("A") + libprep_num)
+                self.add_document("libprep", (projectid, sampleid, libprepid), qc="PASSED")
+                for seqrunid in seqrun_ids:
+                    self.add_document("seqrun", (projectid, sampleid, libprepid, seqrunid),
+                                      alignment_status="NOT_RUNNING",
+                                      mean_autosomal_coverage=0, total_reads=1000000)
+        return project
+
+    ## Request handling, called on the server thread
+    def should_fail(self):
+        return self.error_rate and self._random.random() < self.error_rate
+
+    def get_document(self, level, ids):
+        if level == "project":
+            # Charon also finds projects by name
+            if ids in self.documents[level]:
+                return self.documents[level][ids]
+            for document in self.documents[level].values():
+                if document.get("name") == ids[0]:
+                    return document
+            return None
+        return self.documents[level].get(ids)
+
+    def list_documents(self, level, parent_ids):
+        return [document for ids, document in self.documents[level].items()
+                if ids[:-1] == parent_ids]
+
+    def delete_document(self, level, ids):
+        """Delete a document and everything below it."""
+        for child_level in list(DOCUMENT_LEVELS)[list(DOCUMENT_LEVELS).index(level):]:
+            for child_ids in list(self.documents[child_level]):
+                if child_ids[:len(ids)] == ids:
+                    del self.documents[child_level][child_ids]
+
+
+class FakeCharonHandler(web.RequestHandler):
+
+    def initialize(self, fake_charon):
+        self.fake_charon = fake_charon
+
+    @gen.coroutine
+    def prepare(self):
+        fake_charon = self.fake_charon
+        kind = self.path_args[0]
+        fake_charon.request_counts["{} {}".format(self.request.method, kind)] += 1
+        if fake_charon.latency:
+            yield gen.sleep(fake_charon.latency)
+        if fake_charon.api_token and \
+                self.request.headers.get("X-Charon-API-token") != fake_charon.api_token:
+            raise web.HTTPError(401)
+        if fake_charon.should_fail():
+            raise web.HTTPError(fake_charon.error_code)
+
+    def _parse(self, kind, path):
+        ids = tuple(part for part in path.split("/") if part)
+        if kind in DOCUMENT_LEVELS:
+            num_ids = DOCUMENT_LEVELS[kind]
+            if len(ids) not in (num_ids - 1, num_ids):
+                raise web.HTTPError(404)
+            return kind, ids
+        elif kind in LISTINGS:
+            return LISTINGS[kind], ids
+        raise web.HTTPError(404)
+
+    def _body(self):
+        try:
+            return json.loads(self.request.body)
+        except ValueError:
+            raise web.HTTPError(400)
+
+    def _write_json(self, data, status_code=200):
+        self.set_status(status_code)
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(data))
+
+    def get(self, kind, path):
+        fake_charon = self.fake_charon
+        if kind == "projectidsfromsampleid":
+            sampleid = path.strip("/")
+            self._write_json(sorted(set(ids[0] for ids in fake_charon.documents["sample"]
+                                        if ids[1] == sampleid)))
+            return
+        level, ids = self._parse(kind, path)
+        with fake_charon._lock:
+            if kind in LISTINGS:
+                self._write_json({kind: fake_charon.list_documents(level, ids)})
+                return
+            document = fake_charon.get_document(level, ids)
+            if document is None or len(ids) != DOCUMENT_LEVELS[level]:
+                raise web.HTTPError(404)
+            self._write_json(document)
+
+    def post(self, kind, path):
+        level, parent_ids = self._parse(kind, path)
+        if kind in LISTINGS or len(parent_ids) != DOCUMENT_LEVELS[level] - 1:
+            raise web.HTTPError(405)
+        data = self._body()
+        document_id = data.get(_id_fields(level)[-1])
+        if not document_id:
+            raise web.HTTPError(400)
+        ids = parent_ids + (document_id,)
+        with self.fake_charon._lock:
+            if ids in self.fake_charon.documents[level]:
+                raise web.HTTPError(400)
+            if parent_ids and self.fake_charon.get_document(list(DOCUMENT_LEVELS)[DOCUMENT_LEVELS[level] - 2],
+                                                            parent_ids) is None:
+                raise web.HTTPError(404)
+        fields = dict((key, value) for key, value in data.items() if value is not None)
+        self._write_json(self.fake_charon.add_document(level, ids, **fields), 201)
+
+    def put(self, kind, path):
+        level, ids = self._parse(kind, path)
+        if kind in LISTINGS or len(ids) != DOCUMENT_LEVELS[level]:
+            raise web.HTTPError(405)
+        data = self._body()
+        with self.fake_charon._lock:
+            document = self.fake_charon.get_document(level, ids)
+            if document is None:
+                raise web.HTTPError(404)
+            document.update(data)
+            document["modified"] = datetime.datetime.utcnow().isoformat()
+        self.set_status(204)
+
+    def delete(self, kind, path):
+        level, ids = self._parse(kind, path)
+        if kind in LISTINGS or len(ids) != DOCUMENT_LEVELS[level]:
+            raise web.HTTPError(405)
+        with self.fake_charon._lock:
+            if self.fake_charon.get_document(level, ids) is None:
+                raise web.HTTPError(404)
+            self.fake_charon.delete_document(level, ids)
+        self.set_status(204)
+
+
+@contextlib.contextmanager
+def fake_charon_session(fake_charon, **transport_settings):
+    """Make CharonSession() return a session connected to fake_charon within
+    the block, restoring the previous session afterwards.
+
+    :param FakeCharon fake_charon: A started FakeCharon
+    :param dict transport_settings: Extra settings for the charon config section
+                                    (e.g. max_retries=0)
+    """
+    config = fake_charon.config
+    config["charon"].update(transport_settings)
+    previous_session = CharonSession._instances.pop(CharonSession, None)
+    try:
+        yield CharonSession(config=config)
+    finally:
+        CharonSession._instances.pop(CharonSession, None)
+        if previous_session is not None:
+            CharonSession._instances[CharonSession] = previous_session
+
+
+def _id_fields(level):
+    return [name + "id" for name in list(DOCUMENT_LEVELS)[:DOCUMENT_LEVELS[level]]]
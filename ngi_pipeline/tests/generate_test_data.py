@@ -135,6 +135,47 @@ def create_demultiplexed_flowcell():
     return run_dir
 
 
+def create_large_demultiplexed_flowcell(base_dir=None, num_projects=1, num_samples=100,
+                                        lanes=(1,), run_id=None, project_names=None):
+    """Create a CASAVA 2.5-style flowcell with many samples, each with an
+    (empty) fastq pair per lane; for benchmarking the flowcell parsing.
+
+    140704_D00123_0321_BC423WACXX/
+    |--- SampleSheet.csv
+    |--- Demultiplexing
+         |--- J__Doe_14_01
+              |--- Sample_P101_101
+                   |--- P101_101_AGCTGC_L001_R1_001.fastq.gz
+                   |--- P101_101_AGCTGC_L001_R2_001.fastq.gz
+
+    :param list project_names: Use these names (e.g. "J.Doe_14_01") rather
+                               than random ones; sets num_projects
+
+    :returns: The path to the flowcell directory
+    :rtype: str
+    """
+    if not base_dir: base_dir = tempfile.mkdtemp()
+    if not run_id: run_id = generate_run_id()
+    run_dir = os.path.join(base_dir, run_id)
+    os.makedirs(os.path.join(run_dir, "Demultiplexing"))
+    open(os.path.join(run_dir, "SampleSheet.csv"), 'w').close()
+    if not project_names:
+        project_names = ["{}_{:02d}_01".format(generate_project_name()[:-6], project_num % 100)
+                         for project_num in xrange(num_projects)]
+    for project_num, project_name in enumerate(project_names):
+        project_dir = os.path.join(run_dir, "Demultiplexing", project_name.replace(".", "__"))
+        for sample_num in xrange(num_samples):
+            sample_name = "P{}_{}".format(101 + project_num, 101 + sample_num)
+            sample_dir = os.path.join(project_dir, "Sample_{}".format(sample_name))
+            os.makedirs(sample_dir)
+            barcode = generate_barcode()
+            for lane in lanes:
+                for fq in generate_paired_sample_file_names(sample_name=sample_name,
+                                                            barcode=barcode, lane=lane):
+                    open(os.path.join(sample_dir, fq), 'w').close()
+    return run_dir
+
+
 def generate_runParameters():
     """Generate a dummy runParameters.xml file.
     This contains only the "FCPosition" parameter."
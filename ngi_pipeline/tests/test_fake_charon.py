@@ -0,0 +1,65 @@
+import time
+import unittest
+
+from ngi_pipeline.database.classes import CharonError
+from ngi_pipeline.tests.fake_charon import FakeCharon, fake_charon_session
+
+
+class TestFakeCharon(unittest.TestCase):
+
+    def setUp(self):
+        self.fake_charon = FakeCharon()
+        self.fake_charon.start()
+
+    def tearDown(self):
+        self.fake_charon.stop()
+
+    def test_crud(self):
+        with fake_charon_session(self.fake_charon, max_retries=0) as charon_session:
+            charon_session.project_create("P1", name="A.Test_15_01")
+            charon_session.sample_create("P1", "P1_101", analysis_status="TO_ANALYZE")
+            charon_session.libprep_create("P1", "P1_101", "A")
+            charon_session.seqrun_create("P1", "P1_101", "A", "run1")
+            self.assertEqual(charon_session.project_get("A.Test_15_01")["projectid"], "P1")
+            charon_session.sample_update("P1", "P1_101", analysis_status="ANALYZED")
+            self.assertEqual(charon_session.sample_get("P1", "P1_101")["analysis_status"],
+                             "ANALYZED")
+            self.assertEqual(charon_session.sample_get_projects("P1_101"), ["P1"])
+            tree = charon_session.project_get_tree("P1")
+            self.assertEqual([seqrun["seqrunid"] for _, _, seqrun in tree.iter_seqruns()],
+                             ["run1"])
+            charon_session.sample_delete("P1", "P1_101")
+            with self.assertRaises(CharonError) as cm:
+                charon_session.seqrun_get("P1", "P1_101", "A", "run1")
+            self.assertEqual(cm.exception.status_code, 404)
+            with self.assertRaises(CharonError) as cm:
+                charon_session.project_create("P1")
+            self.assertEqual(cm.exception.status_code, 400)
+        self.assertEqual(self.fake_charon.request_counts["POST sample"], 1)
+
+    def test_synthetic_project(self):
+        self.fake_charon.add_synthetic_project("P2", num_samples=3, libpreps_per_sample=2,
+                                               seqrun_ids=["run1", "run2"])
+        with fake_charon_session(self.fake_charon, max_retries=0) as charon_session:
+            tree = charon_session.project_get_tree("P2")
+        self.assertEqual(list(tree.samples), ["P2_101", "P2_102", "P2_103"])
+        self.assertEqual(len(list(tree.iter_seqruns())), 12)
+
+    def test_latency_and_errors(self):
+        self.fake_charon.add_synthetic_project("P3", num_samples=1)
+        self.fake_charon.latency = 0.05
+        with fake_charon_session(self.fake_charon, max_retries=0) as charon_session:
+            start = time.time()
+            charon_session.project_get("P3")
+            self.assertGreaterEqual(time.time() - start, 0.05)
+            self.fake_charon.latency = 0
+            self.fake_charon.error_rate = 1
+            with self.assertRaises(CharonError) as cm:
+                charon_session.project_get("P3")
+            self.assertEqual(cm.exception.status_code, 503)
+        with fake_charon_session(self.fake_charon, max_retries=2,
+                                 retry_backoff_factor=0) as charon_session:
+            self.fake_charon.reset_counts()
+            with self.assertRaises(CharonError):
+                charon_session.project_get("P3")
+            self.assertEqual(self.fake_charon.request_counts["GET project"], 3)
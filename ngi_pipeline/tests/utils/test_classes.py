@@ -1,6 +1,13 @@
 import contextlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
 
-from ngi_pipeline.utils.classes import with_ngi_config
+import mock
+
+from ngi_pipeline.utils.classes import memoized, with_ngi_config
 
 # This isn't being called by nosetests, I think due to the fact
 # that it gets renamed as "with_config" despite the fact that I've
@@ -11,6 +18,60 @@ from ngi_pipeline.utils.classes import with_ngi_config
 def test_with_ngi_config(config=None, config_file_path=None):
     assert(config)
 
+
+class TestMemoized(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def record(self, *args):
+        self.calls.append(args)
+        return len(self.calls)
+
+    def test_unbounded(self):
+        cached = memoized(self.record)
+        self.assertEqual([cached(1), cached(2), cached(1)], [1, 2, 1])
+        self.assertEqual(cached([1]), 3) # unhashable: not cached
+        self.assertEqual(cached.cache_info()[:2], (1, 2))
+
+    def test_maxsize(self):
+        cached = memoized(maxsize=2)(self.record)
+        for arg in (1, 2, 1, 3, 1, 2):
+            cached(arg)
+        # 2 was the least recently used when 3 came in
+        self.assertEqual(self.calls, [(1,), (2,), (3,), (2,)])
+        self.assertEqual(cached.cache_info(), (2, 4, 2, 0, 2, 2))
+
+    def test_ttl(self):
+        cached = memoized(ttl=60)(self.record)
+        cached("a")
+        cached("a")
+        with mock.patch("time.time", return_value=time.time() + 61):
+            cached("a")
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(cached.cache_info().invalidations, 1)
+
+    def test_validate_paths(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "SampleSheet.csv")
+            with open(path, 'w') as f:
+                f.write("a")
+            cached = memoized(validate_paths=True)(self.record)
+            cached(path)
+            cached(path)
+            with open(path, 'w') as f:
+                f.write("ab")
+            cached(path)
+            os.remove(path)
+            cached(path)
+            cached(path)
+            self.assertEqual(len(self.calls), 3)
+            self.assertEqual(cached.cache_info().invalidations, 2)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
 if __name__=="__main__":
     test_with_ngi_config()
     test_context_manager()
@@ -0,0 +1,68 @@
+import unittest
+
+from ngi_pipeline.utils.fastq import fastq_lane, fastq_pair_base, fastq_stem, \
+                                    group_fastq_names, parse_fastq_name, parse_fastq_names
+
+
+class TestFastqNames(unittest.TestCase):
+
+    def test_fastq_suffix(self):
+        self.assertEqual(parse_fastq_name("P1_101_L001_R1_001.fastq.gz")[1:3],
+                         ("P1_101_L001_R1_001", "fastq.gz"))
+        self.assertEqual(parse_fastq_name("a.b.fq")[1:3], ("a.b", "fq"))
+        self.assertEqual(parse_fastq_name("P1_101.fastq.gz.md5")[1:3],
+                         ("P1_101.fastq.gz.md5", None))
+
+    def test_parse_illumina_names(self):
+        seqrun_dir = "/DATA/P1/P1_101/A/160101_ST-E00201_0123_AHFCWKCCXX"
+        fq = parse_fastq_name(seqrun_dir + "/P1_101_S1_L002_R2_001.fastq.gz")
+        self.assertEqual((fq.sample, fq.index, fq.lane, fq.read, fq.chunk, fq.flowcell),
+                         ("P1_101", "S1", 2, 2, "001", "AHFCWKCCXX"))
+        self.assertEqual(fq.pair_base, "P1_101_S1_L002")
+        fq = parse_fastq_name("NA10860_NR_TAAGGC_L005_R1_001.fastq.gz")
+        self.assertEqual((fq.sample, fq.index, fq.lane, fq.read), ("NA10860_NR", "TAAGGC", 5, 1))
+        fq = parse_fastq_name("P1_101_L001_R1.fastq.gz")
+        self.assertEqual((fq.sample, fq.index, fq.lane, fq.read, fq.chunk),
+                         ("P1_101", None, 1, 1, None))
+        fq = parse_fastq_name("P1_101_CGATGT_L003_R1_001_trimmed.fq.gz")
+        self.assertEqual((fq.sample, fq.lane, fq.read), ("P1_101_CGATGT_L003_R1_001_trimmed", 3, None))
+
+    def test_parse_sthlm_names(self):
+        fq = parse_fastq_name("1_140220_AH8AMJADXX_P673_101_2.fastq.gz")
+        self.assertEqual((fq.sample, fq.index, fq.lane, fq.read), ("P673_101", None, 1, 2))
+        self.assertEqual(fq.pair_base, "1_140220_AH8AMJADXX_P673_101")
+
+    def test_parse_fastq_names_skips_other_files(self):
+        table = parse_fastq_names(["a/P1_101_L001_R1.fastq.gz", "a/SampleSheet.csv",
+                                   "a/P1_101_L001_R2.fastq.gz"])
+        self.assertEqual([fq.read for fq in table], [1, 2])
+
+    def test_parse_fastq_names_with_newline(self):
+        table = parse_fastq_names(["a/P1_101_L001_R1.fastq.gz", "a/odd\nname.fastq.gz",
+                                   "a/P1_101_L001_R2.fastq.gz"])
+        self.assertEqual([(fq.path, fq.stem) for fq in table],
+                         [("a/P1_101_L001_R1.fastq.gz", "P1_101_L001_R1"),
+                          ("a/odd\nname.fastq.gz", "odd\nname"),
+                          ("a/P1_101_L001_R2.fastq.gz", "P1_101_L001_R2")])
+
+    def test_single_fields(self):
+        self.assertEqual(fastq_stem("P1_101_L001_R1_001.fastq.gz"), "P1_101_L001_R1_001")
+        self.assertIsNone(fastq_stem("P1_101.fastq.gz.md5"))
+        self.assertEqual(fastq_pair_base("P1_101_S1_L002_R2_001.fastq.gz"), "P1_101_S1_L002")
+        self.assertEqual(fastq_pair_base("1_140220_AH8AMJADXX_P673_101_2.fastq.gz"),
+                         "1_140220_AH8AMJADXX_P673_101")
+        self.assertIsNone(fastq_pair_base("SampleSheet.csv"))
+        self.assertEqual(fastq_lane("P1_101_S1_L010_R2_001.fastq.gz"), 10)
+        self.assertEqual(fastq_lane("1_140220_AH8AMJADXX_P673_101_2.fastq.gz"), 1)
+        self.assertIsNone(fastq_lane("P1_101_R1.fastq.gz"))
+
+    def test_group_fastq_names(self):
+        table = parse_fastq_names(["P1_101_S1_L001_R1_001.fastq.gz", "P1_102_S2_L001_R1_001.fastq.gz",
+                                   "P1_101_S1_L002_R1_001.fastq.gz", "P1_101_S1_L001_R2_001.fastq.gz"])
+        groups = group_fastq_names(table, lambda fq: (fq.sample, fq.read))
+        self.assertEqual(sorted((key, [fq.lane for fq in group]) for key, group in groups.items()),
+                         [(("P1_101", 1), [1, 2]), (("P1_101", 2), [1]), (("P1_102", 1), [1])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,12 +4,15 @@ import shlex
 import socket
 import subprocess
 import tempfile
+import time
 import unittest
 import filecmp
 
+from ngi_pipeline.utils import filesystem
 from ngi_pipeline.utils.filesystem import chdir, curdir_tmpdir, do_rsync, execute_command_line, \
                                           load_modules, safe_makedir, do_hardlink, do_symlink, \
-                                          locate_flowcell, locate_project
+                                          locate_flowcell, locate_project, LinkPlan, \
+                                          recreate_project_from_filesystem, get_symlink_index
 
 class TestFilesystemUtils(unittest.TestCase):
     def setUp(self):
@@ -103,6 +106,89 @@ class TestFilesystemUtils(unittest.TestCase):
         do_symlink([src_file_path], dst_tmp_dir)
         assert(filecmp.cmp(src_file_path, dst_file_path))
 
+    def test_link_plan(self):
+        src_dir = os.path.join(self.tmp_dir, "src")
+        safe_makedir(src_dir)
+        for file_name in ("file1.txt", "file2.txt"):
+            open(os.path.join(src_dir, file_name), 'w').close()
+        os.symlink(os.path.join(src_dir, "file1.txt"), os.path.join(src_dir, "link.txt"))
+        src_link_dir = os.path.join(self.tmp_dir, "src_link")
+        os.symlink(src_dir, src_link_dir)
+        dst_dir = os.path.join(self.tmp_dir, "dst", "A", "fc")
+        blocked_dir = os.path.join(src_dir, "file2.txt", "fc")
+
+        link_plan = LinkPlan()
+        link_plan.add([os.path.join(src_link_dir, file_name) for file_name in
+                       ("file1.txt", "file2.txt", "link.txt")], dst_dir)
+        link_plan.add([os.path.join(src_dir, "file1.txt")], blocked_dir)
+        self.assertEqual(len(link_plan), 4)
+        errors = link_plan.execute(max_workers=2)
+        self.assertEqual(errors.keys(), [blocked_dir])
+        self.assertEqual(link_plan.num_created, 3)
+        self.assertEqual(os.readlink(os.path.join(dst_dir, "file2.txt")),
+                         os.path.join(os.path.realpath(src_dir), "file2.txt"))
+        self.assertEqual(os.readlink(os.path.join(dst_dir, "link.txt")),
+                         os.path.join(os.path.realpath(src_dir), "file1.txt"))
+        # Links already made are skipped
+        link_plan.add([os.path.join(src_dir, "file1.txt")], dst_dir)
+        self.assertEqual(link_plan.execute(), {})
+        self.assertEqual((link_plan.num_created, link_plan.num_existing), (3, 1))
+        # Broken links and links to other files are errors, not existing links
+        stale_dir = os.path.join(self.tmp_dir, "dst", "B", "fc")
+        safe_makedir(stale_dir)
+        os.symlink(os.path.join(src_dir, "file1.txt"), os.path.join(stale_dir, "file2.txt"))
+        broken_dir = os.path.join(self.tmp_dir, "dst", "C", "fc")
+        safe_makedir(broken_dir)
+        os.symlink(os.path.join(src_dir, "gone.txt"), os.path.join(broken_dir, "file2.txt"))
+        link_plan.add([os.path.join(src_dir, "file2.txt")], stale_dir)
+        link_plan.add([os.path.join(src_dir, "file2.txt")], broken_dir)
+        self.assertEqual(sorted(link_plan.execute()), [stale_dir, broken_dir])
+        self.assertEqual((link_plan.num_created, link_plan.num_existing), (3, 1))
+
+    def test_recreate_project_from_filesystem(self):
+        data_dir = os.path.join(self.tmp_dir, "DATA")
+        project_dir = os.path.join(data_dir, "P1")
+        seqrun_dir = os.path.join(project_dir, "P1_101", "A", "150101_ST1_0001_AFC1")
+        safe_makedir(os.path.join(seqrun_dir, "subdir"))
+        safe_makedir(os.path.join(project_dir, "P1_101", "A", "not_a_seqrun"))
+        safe_makedir(os.path.join(project_dir, "P1_102", "B"))
+        for fastq_path in (os.path.join(seqrun_dir, "P1_101_L001_R1_001.fastq.gz"),
+                           os.path.join(seqrun_dir, "subdir", "P1_101_L001_R2_001.fq"),
+                           os.path.join(seqrun_dir, "P1_101.log"),
+                           os.path.join(project_dir, "README")):
+            open(fastq_path, 'w').close()
+        os.symlink(project_dir, os.path.join(data_dir, "J.Doe_15_01"))
+        for use_symlink_index in (True, False):
+            project_obj = recreate_project_from_filesystem(project_dir, config={},
+                                                           use_symlink_index=use_symlink_index)
+            self.assertEqual((project_obj.name, project_obj.project_id, project_obj.base_path),
+                             ("J.Doe_15_01", "P1", self.tmp_dir))
+            self.assertEqual(sorted(project_obj.samples), ["P1_101", "P1_102"])
+            self.assertEqual(project_obj.samples["P1_101"].libpreps["A"].seqruns.keys(),
+                             ["150101_ST1_0001_AFC1"])
+            self.assertEqual(sorted(project_obj.samples["P1_101"].libpreps["A"].
+                                    seqruns["150101_ST1_0001_AFC1"].fastq_files),
+                             ["P1_101_L001_R1_001.fastq.gz", "P1_101_L001_R2_001.fq"])
+        # Through the symlink, and without one
+        self.assertEqual(recreate_project_from_filesystem(os.path.join(data_dir, "J.Doe_15_01"),
+                                                          config={}).project_id, "P1")
+        os.remove(os.path.join(data_dir, "J.Doe_15_01"))
+        self.assertEqual(recreate_project_from_filesystem(project_dir, config={}).name, "P1")
+
+    def test_get_symlink_index(self):
+        data_dir = os.path.join(self.tmp_dir, "DATA")
+        safe_makedir(os.path.join(data_dir, "P1"))
+        os.symlink(os.path.join(data_dir, "P1"), os.path.join(data_dir, "J.Doe_15_01"))
+        expected = {os.path.realpath(os.path.join(data_dir, "P1")):
+                    os.path.join(data_dir, "J.Doe_15_01")}
+        # Changed just now: indexed again each time until it has settled
+        self.assertEqual(get_symlink_index(data_dir), expected)
+        self.assertNotIn(data_dir, filesystem._SYMLINK_INDEXES)
+        past = time.time() - 60
+        os.utime(data_dir, (past, past))
+        self.assertEqual(get_symlink_index(data_dir), expected)
+        self.assertIn(data_dir, filesystem._SYMLINK_INDEXES)
+
     def test_safe_makedir_singledir(self):
         # Should test that this doesn't overwrite an existing dir as well
         single_dir = os.path.join(self.tmp_dir, "single_directory")
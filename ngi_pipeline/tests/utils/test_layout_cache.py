@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from ngi_pipeline.utils.layout_cache import DirectoryLayoutCache
+
+
+class TestDirectoryLayoutCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = DirectoryLayoutCache(max_entries=2)
+        self.data_dir = self.make_tree({"P1_101": {"A": ["P1_101_L001_R1.fastq.gz"]},
+                                        "P1_102": {}, "notes.txt": None})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_tree(self, tree, dirname=None):
+        dirname = dirname or os.path.join(self.tmp_dir, "DATA")
+        os.mkdir(dirname)
+        for name, contents in tree.items():
+            path = os.path.join(dirname, name)
+            if isinstance(contents, dict):
+                self.make_tree(contents, path)
+            elif isinstance(contents, list):
+                os.mkdir(path)
+                for file_name in contents:
+                    open(os.path.join(path, file_name), 'w').close()
+                self.age(path)
+            else:
+                open(path, 'w').close()
+        self.age(dirname)
+        return dirname
+
+    def age(self, dirname, seconds=60):
+        past = time.time() - seconds
+        os.utime(dirname, (past, past))
+
+    def test_list_dir_cached_until_changed(self):
+        entries = self.cache.list_dir(self.data_dir)
+        self.assertEqual([e.name for e in entries], ["P1_101", "P1_102", "notes.txt"])
+        self.assertEqual([e.is_dir() for e in entries], [True, True, False])
+        self.assertEqual(entries[0].path, os.path.join(self.data_dir, "P1_101"))
+        self.cache.list_dir(self.data_dir)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+        os.mkdir(os.path.join(self.data_dir, "P1_103"))
+        self.assertIn("P1_103", [e.name for e in self.cache.list_dir(self.data_dir)])
+        # Changed just now: listed again each time until it has settled
+        self.cache.list_dir(self.data_dir)
+        self.assertEqual(self.cache.stats()["misses"], 3)
+        self.age(self.data_dir)
+        self.cache.list_dir(self.data_dir)
+        self.cache.list_dir(self.data_dir)
+        self.assertEqual(self.cache.stats()["hits"], 2)
+
+    def test_missing_directory(self):
+        self.cache.list_dir(self.data_dir)
+        shutil.rmtree(self.data_dir)
+        with self.assertRaises(OSError):
+            self.cache.list_dir(self.data_dir)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_walk_matches_os_walk(self):
+        os.symlink(os.path.join(self.data_dir, "P1_101"), os.path.join(self.data_dir, "link"))
+        self.age(self.data_dir)
+        expected = [(root, sorted(dirnames), sorted(filenames))
+                    for root, dirnames, filenames in os.walk(self.data_dir)]
+        self.assertEqual(sorted(self.cache.walk(self.data_dir)), sorted(expected))
+
+    def test_eviction(self):
+        for dirname in ("P1_101", "P1_102", "P1_101/A"):
+            self.cache.list_dir(os.path.join(self.data_dir, dirname))
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+        # The least recently used one went
+        self.cache.list_dir(os.path.join(self.data_dir, "P1_102"))
+        self.assertEqual(self.cache.stats()["misses"], 3)
+
+    def test_save_and_load(self):
+        index_path = os.path.join(self.tmp_dir, "layouts.json")
+        self.cache.list_dir(self.data_dir)
+        self.cache.list_dir(os.path.join(self.data_dir, "P1_101"))
+        self.cache.save(index_path)
+
+        loaded = DirectoryLayoutCache()
+        loaded.load(index_path)
+        self.assertEqual(len(loaded), 2)
+        self.assertEqual([e.name for e in loaded.list_dir(self.data_dir)],
+                         ["P1_101", "P1_102", "notes.txt"])
+        self.assertEqual(loaded.stats()["hits"], 1)
+        # Stale entries from the index are not used
+        open(os.path.join(self.data_dir, "P1_101", "new.txt"), 'w').close()
+        self.assertEqual([e.name for e in loaded.list_dir(os.path.join(self.data_dir, "P1_101"))],
+                         ["A", "new.txt"])
+
+        DirectoryLayoutCache().load(os.path.join(self.tmp_dir, "missing.json"))
+
+
+if __name__ == '__main__':
+    unittest.main()
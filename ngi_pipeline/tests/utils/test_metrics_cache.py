@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from ngi_pipeline.utils.metrics_cache import ParsedMetricsCache
+
+
+class TestParsedMetricsCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = ParsedMetricsCache(max_entries=2)
+        self.metrics_file = self.write_file("P1_101.metrics", "1.5")
+        self.calls = []
+
+        @self.cache.cached("duplication")
+        def parse(path):
+            self.calls.append(path)
+            with open(path) as f:
+                return float(f.read())
+        self.parse = parse
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_file(self, name, contents, seconds=60):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as f:
+            f.write(contents)
+        past = time.time() - seconds
+        os.utime(path, (past, past))
+        return path
+
+    def test_cached_until_changed(self):
+        self.assertEqual(self.parse(self.metrics_file), 1.5)
+        self.assertEqual(self.parse(self.metrics_file), 1.5)
+        self.assertEqual(len(self.calls), 1)
+        self.write_file("P1_101.metrics", "12.5", seconds=30)
+        self.assertEqual(self.parse(self.metrics_file), 12.5)
+        self.assertEqual(len(self.calls), 2)
+        # Changed just now: parsed again each time until it has settled
+        self.write_file("P1_101.metrics", "2.5", seconds=0)
+        self.parse(self.metrics_file)
+        self.parse(self.metrics_file)
+        self.assertEqual(len(self.calls), 4)
+
+    def test_errors_not_cached(self):
+        missing_file = os.path.join(self.tmp_dir, "P1_102.metrics")
+        for _ in range(2):
+            with self.assertRaises(IOError):
+                self.parse(missing_file)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_bounded(self):
+        for sample in ("P1_102", "P1_103", "P1_104"):
+            self.parse(self.write_file("{}.metrics".format(sample), "1.0"))
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_save_and_load(self):
+        index_path = os.path.join(self.tmp_dir, "parsed_metrics.json")
+        self.parse(self.metrics_file)
+        self.cache.save(index_path)
+        # Another process saves a value meanwhile
+        other_cache = ParsedMetricsCache()
+        other_file = self.write_file("P1_102.metrics", "3.0")
+        other_cache.put("duplication", other_file, 3.0)
+        other_cache.load(index_path)
+        other_cache.save(index_path)
+
+        new_cache = ParsedMetricsCache()
+        new_cache.load(index_path)
+        self.assertEqual(new_cache.get("duplication", self.metrics_file), 1.5)
+        self.assertEqual(new_cache.get("duplication", other_file), 3.0)
+        self.write_file("P1_101.metrics", "2.0", seconds=30)
+        self.assertIsNone(new_cache.get("duplication", self.metrics_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,7 +6,8 @@ import unittest
 
 from ngi_pipeline.utils.parsers import get_flowcell_id_from_dirtree, parse_lane_from_filename, \
                                        find_fastq_read_pairs, find_fastq_read_pairs_from_dir, \
-                                       determine_library_prep_from_samplesheet
+                                       determine_library_prep_from_samplesheet, \
+                                       index_samplesheet
 from ngi_pipeline.tests import generate_test_data as gtd
 
 class TestCommon(unittest.TestCase):
@@ -86,3 +87,27 @@ class TestCommon(unittest.TestCase):
                                                                          project_id="YM01",
                                                                          sample_id="Sample_CEP-NA10860-PCR-free,",
                                                                          lane_num=2)
+
+    def test_index_samplesheet(self):
+        ss_v25 = tempfile.mkstemp()[1]
+        samplesheet_v25_text = [
+            "[Header],,,,,,,,",
+            "[Data],,,,,,,,",
+            "Lane,Sample_ID,Sample_Name,Sample_Plate,Sample_Well,I7_Index_ID,index,Sample_Project,Description",
+            "1,Sample_P1_101,P1_101,,,,AGTTCC,Project_YM01,LIBRARY_NAME:A;SOMETHING:else",
+            "1,Sample_P1_101,P1_101,,,,AGTTCC,Project_YM01,LIBRARY_NAME:B",
+            "2,Sample_P1_101,P1_101,,,,AGTTCC,YM01,SOMETHING:else",
+            "x,Sample_P1_102,P1_102,,,,ATGTCA,YM01,LIBRARY_NAME:C",
+            "3,Sample_P1_102,P1_102,,,,ATGTCA,YM01,"]
+        with open(ss_v25, 'w') as f:
+            f.write("\n".join(samplesheet_v25_text))
+        samplesheet_index = index_samplesheet(ss_v25)
+        self.assertIs(samplesheet_index, index_samplesheet(ss_v25))
+        self.assertEqual(len(samplesheet_index), 2)
+        # The first row for a sample and lane counts
+        self.assertEqual(samplesheet_index.get_library_prep("YM01", "P1_101", "1"), "A")
+        with self.assertRaises(ValueError): # No LIBRARY_NAME
+            samplesheet_index.get_library_prep("YM01", "P1_101", 2)
+        for lane_num in (1, 3):
+            with self.assertRaises(ValueError):
+                samplesheet_index.get_library_prep("YM01", "P1_102", lane_num)
@@ -1,5 +1,8 @@
 import collections
 import functools
+import os
+import threading
+import time
 
 from ngi_pipeline.utils.config import load_yaml_config, locate_ngi_config
 
@@ -31,23 +34,78 @@ class with_ngi_config(object):
         return self.f(**kwargs)
 
 
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'invalidations',
+                                               'maxsize', 'currsize'])
+
+
 class memoized(object):
     """
     Decorator, caches results of function calls.
+
+    Used bare (@memoized) every result is kept. With arguments, e.g.
+    @memoized(maxsize=64, ttl=3600, validate_paths=True), at most maxsize
+    results are kept, the least recently used going first, each for at most
+    ttl seconds; with validate_paths a result is only reused while the files
+    named by the string arguments have the same mtime and size as when it
+    was computed. cache_info() gives the hits, misses, evictions and
+    invalidations (expired or changed on disk) so far.
     """
-    def __init__(self, func):
+    def __new__(cls, func=None, **options):
+        if func is None:
+            # @memoized(maxsize=...): return the decorator
+            return functools.partial(cls, **options)
+        return super(memoized, cls).__new__(cls)
+    def __init__(self, func, maxsize=None, ttl=None, validate_paths=False):
         self.func   = func
-        self.cached = {}
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.validate_paths = validate_paths
+        # args -> (result, time computed, file stats), least recently used first
+        self.cached = collections.OrderedDict()
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
         functools.update_wrapper(self, func)
     def __call__(self, *args):
-        if not isinstance(args, collections.Hashable):
+        try:
+            hash(args)
+        except TypeError:
             return self.func(*args)
-        if args in self.cached:
-            return self.cached[args]
-        else:
-            return_val = self.func(*args)
-            self.cached[args] = return_val
-            return return_val
+        file_stats = self._file_stats(args) if self.validate_paths else None
+        with self._lock:
+            entry = self.cached.pop(args, None)
+            if entry is not None:
+                if (self.ttl is None or time.time() - entry[1] <= self.ttl) and \
+                        entry[2] == file_stats:
+                    self.cached[args] = entry
+                    self.counts["hits"] += 1
+                    return entry[0]
+                self.counts["invalidations"] += 1
+            self.counts["misses"] += 1
+        return_val = self.func(*args)
+        with self._lock:
+            self.cached[args] = (return_val, time.time(), file_stats)
+            while self.maxsize is not None and len(self.cached) > self.maxsize:
+                self.cached.popitem(last=False)
+                self.counts["evictions"] += 1
+        return return_val
+    @staticmethod
+    def _file_stats(args):
+        file_stats = []
+        for arg in args:
+            if isinstance(arg, basestring):
+                try:
+                    st = os.stat(arg)
+                except OSError:
+                    file_stats.append(None)
+                else:
+                    file_stats.append((st.st_mtime, st.st_size))
+        return tuple(file_stats)
+    def cache_info(self):
+        return CacheInfo(self.counts["hits"], self.counts["misses"], self.counts["evictions"],
+                         self.counts["invalidations"], self.maxsize, len(self.cached))
+    def cache_clear(self):
+        with self._lock:
+            self.cached.clear()
     def __repr__(self):
         return self.func.__doc__
     # This ensures that attribute access (e.g. obj.attr)
@@ -0,0 +1,173 @@
+"""Parsing of fastq file names, shared by the engines.
+
+The names come in two formats:
+
+    <sample-name>_<index>_<lane>_<read>_<chunk>.fastq.gz
+    e.g. P567_102_AAAAAA_L001_R1_001.fastq.gz or NA10860_NR_S1_L005_R1_001.fastq.gz
+    (Standard Illumina format)
+
+    <lane_num>_<date>_<fcid>_<project>_<sample_num>_<read>.fastq[.gz]
+    e.g. 1_140220_AH8AMJADXX_P673_101_1.fastq.gz
+    (SciLifeLab Sthlm format, obsolete)
+
+parse_fastq_names turns a list of paths into a table of FastqName rows,
+matching all the file names against one pattern in a single pass;
+group_fastq_names then groups the rows in linear time, e.g. into the files
+to merge per sample and read. Code needing only one field of each name is
+faster off with fastq_stem, fastq_pair_base or fastq_lane, which match a
+pattern for just that field.
+"""
+import collections
+import re
+
+# path: as given
+# stem, suffix: the file name without / with its fastq suffix ("fastq.gz"); suffix is
+#               None if the file name does not end in .fastq or .fq (optionally
+#               followed by .gz, .gzip or .bz2)
+# sample, index, lane, read, chunk: the fields of the name; None where absent
+# flowcell: the last "_"-separated part of the directory path (the seqrun
+#           directories end with the flowcell id)
+# pair_base: the name up to the read field, shared by the files of a read pair
+FastqName = collections.namedtuple('FastqName', ['path', 'stem', 'suffix', 'sample', 'index',
+                                                 'lane', 'read', 'chunk', 'flowcell',
+                                                 'pair_base'])
+
+_FASTQ_NAME_PATTERN = r"""
+    (?P<stem>
+        (?P<sthlm_lane>\d)_\d{6}_\w{10}_(?P<sthlm_sample>P\d{3}_\d{3}\w*?)(?:_(?P<sthlm_read>\d))?
+      | (?P<pair_base>(?P<sample>.+?)(?:_(?P<index>S\d+|[ACGTN+-]+|NoIndex))?
+                                     (?:_L(?P<lane>\d{3}))?)_R(?P<read>\d)(?:_(?P<chunk>\d+))?
+      | .*?
+    )(?:\.(?P<suffix>(?:fastq|fq)(?:\.gz|\.gzip|\.bz2)?))?"""
+# Matches every line of the file names joined by newlines, each exactly once
+_FASTQ_NAMES_RE = re.compile("^" + _FASTQ_NAME_PATTERN + "$", re.MULTILINE | re.VERBOSE)
+# Matches a single file name, which may contain newlines
+_FASTQ_NAME_RE = re.compile(_FASTQ_NAME_PATTERN + r"\Z", re.DOTALL | re.VERBOSE)
+
+# Single fields, also for the names in neither format: the name without its
+# fastq suffix, the name cut off at the read, the Sthlm or Illumina lane
+_FASTQ_STEM_RE = re.compile(r'(.*)\.(?:fastq|fq)(?:\.gz|\.gzip|\.bz2)?$')
+_PAIR_BASE_RE = re.compile(r'(.*)_(?:R\d|\d\.)')
+_LANE_RE = re.compile(r'(\d)_\d{6}_\w{10}_P\d{3}_\d{3}|.*_L(\d{3})')
+
+
+class _Numbers(dict):
+    """"001" -> 1, None -> None; converts each distinct string only once."""
+    def __missing__(self, digits):
+        number = self[digits] = int(digits) if digits else None
+        return number
+
+_NUMBERS = _Numbers()
+
+_new_row = tuple.__new__
+
+
+def parse_fastq_name(path):
+    """Parse a single fastq file name; see parse_fastq_names.
+
+    :param str path: The path to, or name of, the fastq file
+
+    :rtype: FastqName
+    """
+    return parse_fastq_names([path], fastq_only=False)[0]
+
+
+def parse_fastq_names(paths, fastq_only=True):
+    """Parse fastq file names into a table, one FastqName row per file.
+
+    :param list paths: The paths to, or names of, the fastq files
+    :param bool fastq_only: Leave out the files without a fastq suffix
+
+    :returns: The rows, in the order of paths
+    :rtype: list of FastqName
+    """
+    paths = list(paths)
+    dirnames, file_names = [], []
+    for path in paths:
+        dirname, _, file_name = path.rpartition("/")
+        dirnames.append(dirname.rstrip("/") or dirname)
+        file_names.append(file_name)
+    flowcells = {}
+    table = []
+    joined_names = "\n".join(file_names)
+    if joined_names.count("\n") == len(file_names) - 1:
+        matches = _FASTQ_NAMES_RE.finditer(joined_names)
+    else:
+        # A name contains a newline, so the lines are not the names
+        matches = [_FASTQ_NAME_RE.match(file_name) for file_name in file_names]
+    for row_num, match in enumerate(matches):
+        (stem, sthlm_lane, sthlm_sample, sthlm_read, pair_base, sample, index, lane, read,
+         chunk, suffix) = match.groups()
+        if suffix is None and fastq_only:
+            continue
+        if read is not None:
+            lane = _NUMBERS[lane]
+            read = _NUMBERS[read]
+        elif sthlm_lane is not None:
+            sample, lane, read = sthlm_sample, _NUMBERS[sthlm_lane], _NUMBERS[sthlm_read]
+        else:
+            lane = fastq_lane(stem)
+            sample = stem
+        if pair_base is None:
+            pair_base = fastq_pair_base(file_names[row_num])
+        dirname = dirnames[row_num]
+        flowcell = flowcells.get(dirname)
+        if flowcell is None:
+            flowcell = flowcells[dirname] = dirname.rsplit("_", 1)[-1]
+        # tuple.__new__ rather than FastqName(), which is written in Python
+        table.append(_new_row(FastqName, (paths[row_num], stem, suffix, sample, index, lane,
+                                          read, chunk, flowcell, pair_base)))
+    return table
+
+
+def fastq_stem(file_name):
+    """The file name without its fastq suffix, or None if it has none.
+
+    :param str file_name: The name of the file
+    :rtype: str
+    """
+    match = _FASTQ_STEM_RE.match(file_name)
+    return match.group(1) if match else None
+
+
+def fastq_pair_base(file_name):
+    """The file name up to the read, shared by the files of a read pair, or
+    None if there is no read in it.
+
+    :param str file_name: The name of the file
+    :rtype: str
+    """
+    match = _PAIR_BASE_RE.match(file_name)
+    return match.group(1) if match else None
+
+
+def fastq_lane(file_name):
+    """The lane number in the file name: the leading digit of the Sthlm
+    format, or the three digits after "_L" of the Illumina one (the last
+    such, for the names in neither format); None if there is none.
+
+    :param str file_name: The name of the file
+    :rtype: int
+    """
+    match = _LANE_RE.match(file_name)
+    return _NUMBERS[(match.group(1) or match.group(2)) if match else None]
+
+
+def group_fastq_names(fastq_names, key):
+    """Group the rows of a table by key.
+
+    :param list fastq_names: The rows, from parse_fastq_names
+    :param function key: Gives the group of a row
+
+    :returns: The rows of each group, in table order
+    :rtype: dict
+    """
+    groups = {}
+    for fastq_name in fastq_names:
+        group_key = key(fastq_name)
+        group = groups.get(group_key)
+        if group is None:
+            groups[group_key] = [fastq_name]
+        else:
+            group.append(fastq_name)
+    return groups
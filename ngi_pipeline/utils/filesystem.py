@@ -3,6 +3,7 @@ from __future__ import print_function
 import collections
 import contextlib
 import datetime
+import errno
 import fnmatch
 import functools
 import glob
@@ -13,13 +14,23 @@ import shutil
 import stat
 import subprocess
 import tempfile
+import threading
+import time
 
+from multiprocessing.pool import ThreadPool
 from ngi_pipeline.conductor.classes import NGIProject
 from ngi_pipeline.log.loggers import minimal_logger
 from ngi_pipeline.utils.classes import with_ngi_config
+from ngi_pipeline.utils.layout_cache import DIRECTORY_LAYOUTS
 
 from requests.exceptions import Timeout
 
+try:
+    from os import scandir
+except ImportError:
+    # Python < 3.5
+    from scandir import scandir
+
 
 LOG = minimal_logger(__name__)
 
@@ -190,6 +201,128 @@ def do_link(src_files, dst_dir, link_type='soft'):
             link_f(os.path.realpath(src_file), dst_file)
 
 
+class LinkPlan(object):
+    """Links to many files, collected first and then made in one go: each
+    destination directory is listed (or created) once and links already in it
+    are skipped, each source directory is resolved to its real path and listed
+    once, and the links are made by a small pool of threads.
+
+    Like do_link, a link points to the real path of its source file, and a
+    destination that already exists is left alone; an existing destination
+    that is a broken link, or a symlink to another file, is reported as an
+    error of its directory.
+    """
+    def __init__(self, link_type='soft', dir_mode=0o2770):
+        """
+        :param str link_type: 'soft' or 'hard'
+        :param int dir_mode: The mode of the destination directories created
+        """
+        self.link_type = link_type
+        self.dir_mode = dir_mode
+        # dst_dir -> file name -> src_file
+        self._links = collections.OrderedDict()
+        self.num_created = self.num_existing = 0
+
+    def __len__(self):
+        return sum(len(names) for names in self._links.values())
+
+    def add(self, src_files, dst_dir):
+        """Plan links to src_files in dst_dir.
+
+        :param list src_files: The files to link to
+        :param str dst_dir: The directory to put the links in (created if needed)
+        """
+        dst_names = self._links.setdefault(dst_dir, collections.OrderedDict())
+        for src_file in src_files:
+            dst_names[os.path.basename(src_file)] = src_file
+
+    def execute(self, max_workers=4):
+        """Make the planned links that do not exist yet.
+
+        :param int max_workers: The number of links made concurrently
+
+        :returns: The error of each destination directory where something failed
+        :rtype: dict
+        """
+        link_f = os.link if self.link_type == 'hard' else os.symlink
+        errors = {}
+        resolved_dirs = {}
+        links = []
+        for dst_dir, dst_names in self._links.items():
+            try:
+                existing_names = set(os.listdir(dst_dir))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    errors[dst_dir] = e
+                    continue
+                try:
+                    safe_makedir(dst_dir, self.dir_mode)
+                except OSError as e:
+                    errors[dst_dir] = e
+                    continue
+                existing_names = set()
+            for name, src_file in dst_names.items():
+                dst_file = os.path.join(dst_dir, name)
+                if name not in existing_names:
+                    links.append((self._realpath(src_file, resolved_dirs),
+                                  dst_file, dst_dir))
+                    continue
+                # The name is taken; it only counts as linked if it resolves to
+                # a file, and a symlink must point to the planned source
+                if not os.path.isfile(dst_file):
+                    errors.setdefault(dst_dir, OSError(
+                        errno.EEXIST, "Existing link is broken", dst_file))
+                elif self.link_type != 'hard' and os.path.islink(dst_file) and \
+                        os.readlink(dst_file) != self._realpath(src_file, resolved_dirs):
+                    errors.setdefault(dst_dir, OSError(
+                        errno.EEXIST, "Existing link points elsewhere", dst_file))
+                else:
+                    self.num_existing += 1
+
+        def make_link(link):
+            src_file, dst_file, dst_dir = link
+            try:
+                link_f(src_file, dst_file)
+            except OSError as e:
+                return dst_dir, e
+        max_workers = min(len(links), max_workers)
+        if max_workers > 1:
+            pool = ThreadPool(max_workers)
+            try:
+                results = pool.map(make_link, links)
+            finally:
+                pool.close()
+        else:
+            results = map(make_link, links)
+        for result in results:
+            if result is None:
+                self.num_created += 1
+            else:
+                errors.setdefault(*result)
+        self._links.clear()
+        return errors
+
+    @staticmethod
+    def _realpath(src_file, resolved_dirs):
+        """os.path.realpath(src_file), resolving each directory only once;
+        resolved_dirs maps a directory to its real path and the names of the
+        symlinks in it, which are still resolved one by one."""
+        src_dir, name = os.path.split(src_file)
+        try:
+            real_dir, symlink_names = resolved_dirs[src_dir]
+        except KeyError:
+            real_dir = os.path.realpath(src_dir)
+            try:
+                symlink_names = set(entry.name for entry in scandir(src_dir)
+                                    if entry.is_symlink())
+            except OSError:
+                symlink_names = set()
+            resolved_dirs[src_dir] = real_dir, symlink_names
+        if name in symlink_names:
+            return os.path.realpath(src_file)
+        return os.path.join(real_dir, name)
+
+
 def do_rsync(src_files, dst_dir):
     ## TODO I changed this -c because it takes for goddamn ever but I'll set it back once in Production
     #cl = ["rsync", "-car"]
@@ -219,6 +352,18 @@ def safe_makedir(dname, mode=0o2770):
                 raise
     return dname
 
+def safe_symlink(src, dst):
+    """Symlink src to dst if dst doesn't exist, handling concurrent race
+    conditions.
+    """
+    if not os.path.lexists(dst):
+        try:
+            os.symlink(src, dst)
+        except OSError:
+            if not os.path.lexists(dst):
+                raise
+    return dst
+
 def rotate_file(file_path, new_subdirectory="rotated_files"):
     if os.path.exists(file_path) and os.path.isfile(file_path):
         file_dirpath, extension = os.path.splitext(file_path)
@@ -281,9 +426,16 @@ def recreate_project_from_filesystem(project_dir,
                                      restrict_to_libpreps=None,
                                      restrict_to_seqruns=None,
                                      force_create_project=False,
+                                     use_symlink_index=True,
                                      config=None, config_file_path=None):
     """Recreates the full project/sample/libprep/seqrun set of
-    NGIObjects using the directory tree structure."""
+    NGIObjects using the directory tree structure, reading each directory
+    once.
+
+    :param bool use_symlink_index: Find the project name symlink in a cached
+                                   index of the symlinks in the DATA directory
+                                   (default True)
+    """
 
     from ngi_pipeline.database.classes import CharonError
     from ngi_pipeline.database.communicate import get_project_id_from_name
@@ -299,14 +451,12 @@ def recreate_project_from_filesystem(project_dir,
         syml_project_dir = os.path.abspath(project_dir)
     else:
         real_project_dir = os.path.abspath(project_dir)
-        search_dir = os.path.join(os.path.dirname(project_dir), "*")
-        sym_files = filter(os.path.islink, glob.glob(search_dir))
-        for sym_file in sym_files:
-            if os.path.realpath(sym_file) == os.path.realpath(real_project_dir):
-                syml_project_dir = os.path.abspath(sym_file)
-                break
+        data_dir = os.path.dirname(real_project_dir)
+        if use_symlink_index:
+            symlinks = get_symlink_index(data_dir)
         else:
-            syml_project_dir = None
+            symlinks = _index_symlinks(data_dir)
+        syml_project_dir = symlinks.get(os.path.realpath(real_project_dir))
     project_base_path, project_id = os.path.split(real_project_dir)
     if syml_project_dir:
         project_base_path, project_name = os.path.split(syml_project_dir)
@@ -319,12 +469,11 @@ def recreate_project_from_filesystem(project_dir,
                              dirname=project_id,
                              project_id=project_id,
                              base_path=project_base_path)
-    samples_pattern = os.path.join(real_project_dir, "*")
-    samples = filter(os.path.isdir, glob.glob(samples_pattern))
+    samples = [entry for entry in list_dir_entries(real_project_dir) if entry.is_dir()]
     if not samples:
         LOG.warn('No samples found for project "{}"'.format(project_obj))
-    for sample_dir in samples:
-        sample_name = os.path.basename(sample_dir)
+    for sample_entry in samples:
+        sample_name = sample_entry.name
         if restrict_to_samples and sample_name not in restrict_to_samples:
             LOG.debug('Skipping sample "{}": not in specified samples '
                       '"{}"'.format(sample_name, ', '.join(restrict_to_samples)))
@@ -332,12 +481,11 @@ def recreate_project_from_filesystem(project_dir,
         LOG.info('Setting up sample "{}"'.format(sample_name))
         sample_obj = project_obj.add_sample(name=sample_name, dirname=sample_name)
 
-        libpreps_pattern = os.path.join(sample_dir, "*")
-        libpreps = filter(os.path.isdir, glob.glob(libpreps_pattern))
+        libpreps = [entry for entry in list_dir_entries(sample_entry.path) if entry.is_dir()]
         if not libpreps:
             LOG.warn('No libpreps found for sample "{}"'.format(sample_obj))
-        for libprep_dir in libpreps:
-            libprep_name = os.path.basename(libprep_dir)
+        for libprep_entry in libpreps:
+            libprep_name = libprep_entry.name
             if restrict_to_libpreps and libprep_name not in restrict_to_libpreps:
                 LOG.debug('Skipping libprep "{}": not in specified libpreps '
                           '"{}"'.format(libprep_name, ', '.join(restrict_to_libpreps)))
@@ -346,12 +494,12 @@ def recreate_project_from_filesystem(project_dir,
             libprep_obj = sample_obj.add_libprep(name=libprep_name,
                                                  dirname=libprep_name)
 
-            seqruns_pattern = os.path.join(libprep_dir, "*_*_*_*")
-            seqruns = filter(os.path.isdir, glob.glob(seqruns_pattern))
+            seqruns = [entry for entry in list_dir_entries(libprep_entry.path, "*_*_*_*")
+                       if entry.is_dir()]
             if not seqruns:
                 LOG.warn('No seqruns found for libprep "{}"'.format(libprep_obj))
-            for seqrun_dir in seqruns:
-                seqrun_name = os.path.basename(seqrun_dir)
+            for seqrun_entry in seqruns:
+                seqrun_name = seqrun_entry.name
                 if restrict_to_seqruns and seqrun_name not in restrict_to_seqruns:
                     LOG.debug('Skipping seqrun "{}": not in specified seqruns '
                               '"{}"'.format(seqrun_name, ', '.join(restrict_to_seqruns)))
@@ -359,13 +507,104 @@ def recreate_project_from_filesystem(project_dir,
                 LOG.info('Setting up seqrun "{}"'.format(seqrun_name))
                 seqrun_obj = libprep_obj.add_seqrun(name=seqrun_name,
                                                     dirname=seqrun_name)
-                for fq_file in fastq_files_under_dir(seqrun_dir, realpath=False):
-                    fq_name = os.path.basename(fq_file)
-                    LOG.info('Adding fastq file "{}" to seqrun "{}"'.format(fq_name, seqrun_obj))
+                for fq_name in _fastq_file_names_under_dir(seqrun_entry.path):
+                    LOG.debug('Adding fastq file "{}" to seqrun "{}"'.format(fq_name, seqrun_obj))
                     seqrun_obj.add_fastq_files([fq_name])
     return project_obj
 
 
+_FASTQ_RE = re.compile(r".*\.(fastq|fq)(\.gz|\.gzip|\.bz2)?$")
+
+
+def _fastq_file_names_under_dir(dirname):
+    """The names of the fastq files under dirname, like fastq_files_under_dir
+    but with one scandir per directory; symlinked directories are not
+    followed (as with os.walk)."""
+    fastq_names = []
+    for entry in list_dir_entries(dirname):
+        if entry.is_dir(follow_symlinks=False):
+            fastq_names.extend(_fastq_file_names_under_dir(entry.path))
+        elif _FASTQ_RE.search(entry.name):
+            fastq_names.append(entry.name)
+    return fastq_names
+
+
+# directory -> (mtime, {real path of target: symlink path}), least recently used first
+_SYMLINK_INDEXES = collections.OrderedDict()
+_SYMLINK_INDEXES_LOCK = threading.Lock()
+_SYMLINK_INDEXES_MAX_ENTRIES = 1000
+
+
+def get_symlink_index(dirname):
+    """An index of the symlinks in a directory (e.g. the project name links in
+    DATA) by the real path of their targets, cached until the directory's
+    mtime changes. Where several symlinks point to the same place, the first
+    by name is used. As with the listings in DIRECTORY_LAYOUTS, an index read
+    within RACY_SECONDS of the directory's last change is not cached, and
+    only the most recently used directories are kept.
+
+    :param str dirname: The directory
+
+    :returns: The symlink path for each target
+    :rtype: dict
+    """
+    dirname = os.path.abspath(dirname)
+    try:
+        mtime = os.stat(dirname).st_mtime
+    except OSError:
+        with _SYMLINK_INDEXES_LOCK:
+            _SYMLINK_INDEXES.pop(dirname, None)
+        return {}
+    with _SYMLINK_INDEXES_LOCK:
+        cached = _SYMLINK_INDEXES.pop(dirname, None)
+        if cached and cached[0] == mtime:
+            _SYMLINK_INDEXES[dirname] = cached
+            return cached[1]
+    index = _index_symlinks(dirname)
+    if time.time() - mtime > DIRECTORY_LAYOUTS.RACY_SECONDS:
+        with _SYMLINK_INDEXES_LOCK:
+            _SYMLINK_INDEXES[dirname] = (mtime, index)
+            while len(_SYMLINK_INDEXES) > _SYMLINK_INDEXES_MAX_ENTRIES:
+                _SYMLINK_INDEXES.popitem(last=False)
+    return index
+
+
+def _index_symlinks(dirname):
+    index = {}
+    for entry in list_dir_entries(dirname):
+        if entry.is_symlink():
+            index.setdefault(os.path.realpath(entry.path), os.path.abspath(entry.path))
+    return index
+
+
+# Shell-style pattern -> compiled match function
+_SHELL_PATTERNS = {}
+
+
+def list_dir_entries(dirname, pattern=None):
+    """Read a directory once, returning its entries (skipping hidden ones, as
+    glob does) sorted by name. The entries cache their file type, so checking
+    is_dir()/is_file() on them costs no further filesystem calls. Listings are
+    reused while the directory is unchanged (see utils.layout_cache).
+
+    :param str dirname: The directory to list
+    :param str pattern: Only return the entries matching this shell-style pattern (optional)
+
+    :returns: The entries, with absolute paths; empty if the directory is missing or unreadable
+    :rtype: list of CachedDirEntry
+    """
+    match = None
+    if pattern:
+        match = _SHELL_PATTERNS.get(pattern)
+        if match is None:
+            match = _SHELL_PATTERNS[pattern] = re.compile(fnmatch.translate(pattern)).match
+    try:
+        return [entry for entry in DIRECTORY_LAYOUTS.list_dir(dirname)
+                if entry.name[0] != "." and (match is None or match(entry.name))]
+    except OSError:
+        return []
+
+
 def fastq_files_under_dir(dirname, realpath=True):
     return match_files_under_dir(dirname,
                                  pattern=".*\.(fastq|fq)(\.gz|\.gzip|\.bz2)?$",
@@ -374,7 +613,8 @@ def fastq_files_under_dir(dirname, realpath=True):
 
 
 def match_files_under_dir(dirname, pattern, pt_style="regex", realpath=True):
-    """Find all the files under a directory that match pattern.
+    """Find all the files under a directory that match pattern; the directory
+    listings are reused while unchanged (see utils.layout_cache).
 
     :parm str dirname: The directory under which to search
     :param str pattern: The pattern against which to match
@@ -390,7 +630,7 @@ def match_files_under_dir(dirname, pattern, pt_style="regex", realpath=True):
         pt_style = "regex"
     if pt_style == "regex": pt_comp = re.compile(pattern)
     matches = []
-    for root, dirnames, filenames in os.walk(dirname):
+    for root, dirnames, filenames in DIRECTORY_LAYOUTS.walk(dirname):
         if pt_style == "shell":
             for filename in fnmatch.filter(filenames, pattern):
                 match = os.path.abspath(os.path.join(root, filename))
@@ -0,0 +1,234 @@
+"""A process-wide cache of directory listings, validated by directory mtime.
+
+Launching a sample walks its DATA directory to collect the fastq files, the
+QC walks it again and recreate_project_from_filesystem walks the whole
+project once more, all within one invocation of ngi_pipeline_start.py. The
+listings are kept here, keyed by directory path, and reused for as long as
+the directory's mtime is unchanged: adding, removing or renaming an entry
+updates the mtime of its directory, so checking that costs one stat per
+directory instead of reading it again. Only names and file types are
+cached; stat() on an entry always goes to the filesystem.
+
+A listing read within RACY_SECONDS of its directory's last change is not
+cached, since a further change within the same (possibly coarse) mtime tick
+would go unnoticed.
+
+The number of directories kept is bounded, least recently used first out, so
+that the server does not grow without limit. Optionally the listings are
+also saved to a small JSON index when the process exits and loaded again by
+the next one (see use_layout_index); they are validated the same way.
+"""
+import atexit
+import collections
+import json
+import os
+import threading
+import time
+
+from ngi_pipeline.log.loggers import minimal_logger
+from ngi_pipeline.utils.classes import with_ngi_config
+
+try:
+    from os import scandir
+except ImportError:
+    # Python < 3.5
+    from scandir import scandir
+
+LOG = minimal_logger(__name__)
+
+
+class CachedDirEntry(object):
+    """A directory entry from a cached listing; can be used in place of the
+    DirEntry objects returned by scandir."""
+    __slots__ = ("name", "path", "_is_dir", "_is_symlink")
+
+    def __init__(self, dirname, name, is_dir, is_symlink):
+        self.name = name
+        self.path = os.path.join(dirname, name)
+        self._is_dir = is_dir
+        self._is_symlink = is_symlink
+
+    def __repr__(self):
+        return "<CachedDirEntry {}>".format(self.name)
+
+    def is_dir(self, follow_symlinks=True):
+        return self._is_dir and (follow_symlinks or not self._is_symlink)
+
+    def is_file(self, follow_symlinks=True):
+        return not self._is_dir and (follow_symlinks or not self._is_symlink)
+
+    def is_symlink(self):
+        return self._is_symlink
+
+    def stat(self, follow_symlinks=True):
+        return os.stat(self.path) if follow_symlinks else os.lstat(self.path)
+
+
+def _entry_is_dir(entry):
+    try:
+        return entry.is_dir()
+    except OSError:
+        # e.g. a symlink to somewhere we may not look
+        return False
+
+
+class DirectoryLayoutCache(object):
+    INDEX_VERSION = 1
+    RACY_SECONDS = 2
+
+    def __init__(self, max_entries=10000):
+        """
+        :param int max_entries: The most directories to keep listings of
+        """
+        self.max_entries = max_entries
+        # absolute path -> (mtime, [CachedDirEntry]), least recently used first
+        self._listings = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def __len__(self):
+        return len(self._listings)
+
+    def __repr__(self):
+        return "<DirectoryLayoutCache ({} of at most {} directories)>".format(
+                len(self._listings), self.max_entries)
+
+    def list_dir(self, dirname):
+        """The entries of a directory, hidden ones included, sorted by name.
+
+        :param str dirname: The directory to list
+
+        :returns: The entries; their paths are absolute
+        :rtype: list of CachedDirEntry
+        :raises OSError: If the directory is missing or unreadable
+        """
+        dirname = os.path.abspath(dirname)
+        try:
+            mtime = os.stat(dirname).st_mtime
+        except OSError:
+            self.invalidate(dirname)
+            raise
+        with self._lock:
+            cached = self._listings.pop(dirname, None)
+            if cached and cached[0] == mtime:
+                self._listings[dirname] = cached
+                self.counts["hits"] += 1
+                return list(cached[1])
+        entries = sorted((CachedDirEntry(dirname, entry.name, _entry_is_dir(entry),
+                                         entry.is_symlink()) for entry in scandir(dirname)),
+                         key=lambda entry: entry.name)
+        self.counts["misses"] += 1
+        if time.time() - mtime > self.RACY_SECONDS:
+            self._store(dirname, mtime, entries)
+        return list(entries)
+
+    def _store(self, dirname, mtime, entries):
+        with self._lock:
+            self._listings.pop(dirname, None)
+            self._listings[dirname] = (mtime, entries)
+            while len(self._listings) > self.max_entries:
+                self._listings.popitem(last=False)
+                self.counts["evictions"] += 1
+
+    def walk(self, top):
+        """Like os.walk(top) (top-down, not following symlinked directories,
+        unreadable directories skipped) with each level sorted by name.
+
+        :param str top: The directory to walk
+        """
+        try:
+            entries = self.list_dir(top)
+        except OSError:
+            return
+        dirnames = [entry.name for entry in entries if entry.is_dir()]
+        filenames = [entry.name for entry in entries if not entry.is_dir()]
+        yield top, dirnames, filenames
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                for level in self.walk(os.path.join(top, entry.name)):
+                    yield level
+
+    def invalidate(self, dirname=None):
+        """Forget the listing of dirname, or of all directories.
+
+        :param str dirname: The directory (optional)
+        """
+        with self._lock:
+            if dirname is None:
+                self._listings.clear()
+            else:
+                self._listings.pop(os.path.abspath(dirname), None)
+
+    def load(self, path):
+        """Add the listings in the index at path, if there is one. They are
+        only used where the directory's mtime has not changed since.
+
+        :param str path: The path to the index file
+        """
+        try:
+            with open(path) as f:
+                index = json.load(f)
+        except IOError:
+            return
+        except ValueError as e:
+            LOG.warn('Ignoring unreadable directory layout index "{}": {}'.format(path, e))
+            return
+        if index.get("version") != self.INDEX_VERSION:
+            return
+        for dirname, (mtime, entries) in index.get("directories", []):
+            self._store(dirname, mtime, [CachedDirEntry(dirname, name, is_dir, is_symlink)
+                                         for name, is_dir, is_symlink in entries])
+        LOG.debug('Loaded {} directory listings from "{}"'.format(len(self), path))
+
+    def save(self, path):
+        """Write the listings to an index at path, replacing it atomically.
+
+        :param str path: The path to the index file
+        """
+        with self._lock:
+            directories = [[dirname, [mtime, [[e.name, e._is_dir, e._is_symlink]
+                                              for e in entries]]]
+                           for dirname, (mtime, entries) in self._listings.items()]
+        tmp_path = "{}.tmp{}".format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({"version": self.INDEX_VERSION, "directories": directories}, f)
+        os.rename(tmp_path, path)
+
+    def stats(self):
+        """The number of hits, misses and evictions, and of directories cached.
+
+        :rtype: dict
+        """
+        stats = dict(hits=0, misses=0, evictions=0)
+        stats.update(self.counts)
+        stats["directories"] = len(self)
+        return stats
+
+
+DIRECTORY_LAYOUTS = DirectoryLayoutCache()
+
+
+@with_ngi_config
+def use_layout_index(config=None, config_file_path=None):
+    """Size DIRECTORY_LAYOUTS as configured and, if an index path is set,
+    load the listings from it now and save them back at exit. Configured
+    under "environment":
+
+        layout_cache:
+            max_entries: 10000
+            index_path: /proj/a2014205/ngi_resources/directory_layouts.json
+    """
+    settings = config.get("environment", {}).get("layout_cache") or {}
+    if settings.get("max_entries"):
+        DIRECTORY_LAYOUTS.max_entries = int(settings["max_entries"])
+    index_path = settings.get("index_path")
+    if index_path:
+        DIRECTORY_LAYOUTS.load(index_path)
+        atexit.register(_save_index_at_exit, index_path)
+
+
+def _save_index_at_exit(index_path):
+    try:
+        DIRECTORY_LAYOUTS.save(index_path)
+    except (IOError, OSError) as e:
+        LOG.warn('Could not write directory layout index "{}": {}'.format(index_path, e))
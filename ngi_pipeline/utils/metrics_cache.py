@@ -0,0 +1,230 @@
+"""A persistent cache of the values parsed from analysis result files.
+
+Result files such as Qualimap's genome_results.txt, Picard's .metrics and
+the genotype concordance tables are not changed once written, but every
+status sweep, coverage check and report parses them again. The values
+parsed from them are kept here, keyed by the kind of value and the file's
+absolute path, and reused for as long as the file's size and mtime are
+unchanged, so that checking them costs one stat per file instead of
+reading it. Values must be JSON-serializable (after saving, tuples come
+back as lists and strings as unicode).
+
+A file changed within RACY_SECONDS of being parsed is not cached, since it
+may still be being written.
+
+The number of values kept is bounded, least recently used first out.
+Optionally the values are saved to a JSON index when the process exits and
+loaded again by the next one (see use_metrics_cache), so that the sweep,
+the scripts and the reports all share them; saving merges in the values
+other processes have saved meanwhile.
+"""
+import atexit
+import collections
+import functools
+import json
+import os
+import threading
+import time
+
+from ngi_pipeline.log.loggers import minimal_logger
+from ngi_pipeline.utils.classes import with_ngi_config
+
+LOG = minimal_logger(__name__)
+
+_MISSING = object()
+
+
+class ParsedMetricsCache(object):
+    INDEX_VERSION = 1
+    RACY_SECONDS = 2
+
+    def __init__(self, max_entries=100000):
+        """
+        :param int max_entries: The most values to keep
+        """
+        self.max_entries = max_entries
+        # (kind, absolute path) -> (size, mtime, value), least recently used first
+        self._values = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return "<ParsedMetricsCache ({} of at most {} values)>".format(
+                len(self._values), self.max_entries)
+
+    @staticmethod
+    def _file_stat(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime
+
+    def get(self, kind, path, default=None):
+        """The value of this kind parsed from the file at path, if it is
+        cached and the file is unchanged.
+
+        :param str kind: The kind of value, e.g. the name of the parser
+        :param str path: The path to the file
+        :param default: Returned if there is no valid cached value
+
+        :returns: The value or default
+        """
+        key = (kind, os.path.abspath(path))
+        try:
+            file_stat = self._file_stat(key[1])
+        except OSError:
+            file_stat = None
+        with self._lock:
+            cached = self._values.pop(key, None)
+            if cached is not None and file_stat is not None and cached[:2] == file_stat:
+                self._values[key] = cached
+                self.counts["hits"] += 1
+                return cached[2]
+            self.counts["misses"] += 1
+        return default
+
+    def put(self, kind, path, value, file_stat=None):
+        """Keep a value parsed from the file at path.
+
+        :param str kind: The kind of value, e.g. the name of the parser
+        :param str path: The path to the file
+        :param value: The value parsed
+        :param tuple file_stat: The size and mtime of the file when it was
+                                parsed (optional; by default, its current ones)
+        """
+        path = os.path.abspath(path)
+        if file_stat is None:
+            try:
+                file_stat = self._file_stat(path)
+            except OSError:
+                return
+        if time.time() - file_stat[1] > self.RACY_SECONDS:
+            self._store((kind, path), file_stat[0], file_stat[1], value)
+
+    def _store(self, key, size, mtime, value):
+        with self._lock:
+            self._values.pop(key, None)
+            self._values[key] = (size, mtime, value)
+            while len(self._values) > self.max_entries:
+                self._values.popitem(last=False)
+                self.counts["evictions"] += 1
+
+    def cached(self, kind):
+        """Decorator for a parser taking the path to a file as its only
+        argument: its results are kept here under kind. Errors are not cached.
+
+        :param str kind: The kind of value
+        """
+        def decorator(parser):
+            @functools.wraps(parser)
+            def cached_parser(path):
+                value = self.get(kind, path, _MISSING)
+                if value is _MISSING:
+                    try:
+                        file_stat = self._file_stat(path)
+                    except OSError:
+                        file_stat = None
+                    value = parser(path)
+                    if file_stat is not None:
+                        self.put(kind, path, value, file_stat)
+                return value
+            return cached_parser
+        return decorator
+
+    def invalidate(self, kind=None):
+        """Forget the values of this kind, or all values.
+
+        :param str kind: The kind of value (optional)
+        """
+        with self._lock:
+            if kind is None:
+                self._values.clear()
+            else:
+                for key in [key for key in self._values if key[0] == kind]:
+                    del self._values[key]
+
+    def _read_index(self, path):
+        try:
+            with open(path) as f:
+                index = json.load(f)
+        except IOError:
+            return []
+        except ValueError as e:
+            LOG.warn('Ignoring unreadable metrics cache index "{}": {}'.format(path, e))
+            return []
+        if index.get("version") != self.INDEX_VERSION:
+            return []
+        return index.get("values", [])
+
+    def load(self, path):
+        """Add the values in the index at path, if there is one. They are
+        only used where the file's size and mtime have not changed since.
+
+        :param str path: The path to the index file
+        """
+        for kind, file_path, size, mtime, value in self._read_index(path):
+            self._store((kind, file_path), size, mtime, value)
+        LOG.debug('Loaded {} parsed metrics from "{}"'.format(len(self), path))
+
+    def save(self, path):
+        """Write the values to an index at path, together with those other
+        processes have saved there since it was loaded, replacing it atomically.
+
+        :param str path: The path to the index file
+        """
+        values = collections.OrderedDict(((kind, file_path), (size, mtime, value))
+                                         for kind, file_path, size, mtime, value
+                                         in self._read_index(path))
+        with self._lock:
+            for key, cached in self._values.items():
+                values.pop(key, None)
+                values[key] = cached
+        saved = [[kind, file_path, size, mtime, value] for (kind, file_path), (size, mtime, value)
+                 in values.items()[-self.max_entries:]]
+        tmp_path = "{}.tmp{}".format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({"version": self.INDEX_VERSION, "values": saved}, f)
+        os.rename(tmp_path, path)
+
+    def stats(self):
+        """The number of hits, misses and evictions, and of values cached.
+
+        :rtype: dict
+        """
+        stats = dict(hits=0, misses=0, evictions=0)
+        stats.update(self.counts)
+        stats["values"] = len(self)
+        return stats
+
+
+PARSED_METRICS = ParsedMetricsCache()
+
+_INDEX_PATHS = set()
+
+
+@with_ngi_config
+def use_metrics_cache(config=None, config_file_path=None):
+    """Size PARSED_METRICS as configured and, if an index path is set, load
+    the values from it now and save them back at exit (once per process and
+    index). Configured under "environment":
+
+        metrics_cache:
+            max_entries: 100000
+            index_path: /proj/a2014205/ngi_resources/parsed_metrics.json
+    """
+    settings = config.get("environment", {}).get("metrics_cache") or {}
+    if settings.get("max_entries"):
+        PARSED_METRICS.max_entries = int(settings["max_entries"])
+    index_path = settings.get("index_path")
+    if index_path and index_path not in _INDEX_PATHS:
+        _INDEX_PATHS.add(index_path)
+        PARSED_METRICS.load(index_path)
+        atexit.register(_save_index_at_exit, index_path)
+
+
+def _save_index_at_exit(index_path):
+    try:
+        PARSED_METRICS.save(index_path)
+    except (IOError, OSError) as e:
+        LOG.warn('Could not write metrics cache index "{}": {}'.format(index_path, e))
@@ -13,9 +13,13 @@ import xml.parsers.expat
 from ngi_pipeline.database.classes import CharonSession, CharonError
 from ngi_pipeline.log.loggers import minimal_logger
 from ngi_pipeline.utils.classes import memoized
+from ngi_pipeline.utils.fastq import fastq_lane, fastq_pair_base, fastq_stem
 
 LOG = minimal_logger(__name__)
 
+# The most SampleSheets kept parsed at a time (a few flowcells' worth)
+SAMPLESHEET_CACHE_SIZE = 32
+
 ## e.g. A.Wedell_13_03_P567_102_A_140528_D00415_0049_BC423WACXX                         <-- sthlm
 ##  or  ND-0522_NA10860_PCR-free_SX398_NA10860_PCR-free_140821_D00458_0029_AC45JGANXX   <-- uusnp
 STHLM_UUSNP_SEQRUN_RE = re.compile(r'(?P<project_name>\w\.\w+_\d+_\d+|\w{2}-\d+)_(?P<sample_id>[\w-]+)_(?P<libprep_id>\w|\w{2}\d{3}_\2)_(?P<seqrun_id>\d{6}_\w+_\d{4}_.{10})')
@@ -36,84 +40,155 @@ def parse_samples_from_vcf(path_to_vcf):
                          'samples from file "{}"'.format(path_to_vcf))
     return header_list[samples_index+1:]
 
-def determine_library_prep_from_fcid(project_id, sample_name, fcid):
+def get_sample_libprep_seqruns(project_id, sample_name):
+    """Get the library preps of a sample from the database together with
+    their sequencing runs, fetching the seqruns of all libpreps concurrently.
+
+    :param str project_id: The ID of the project
+    :param str sample_name: The name of the sample
+
+    :returns: The seqrun ids of each libprep id, in the order Charon lists them
+    :rtype: collections.OrderedDict
+    :raises CharonError: If the sample or its libpreps cannot be fetched
+    """
+    charon_session = CharonSession()
+    libprep_ids = [libprep['libprepid'] for libprep in
+                   charon_session.sample_get_libpreps(project_id, sample_name)['libpreps']]
+    get_seqruns = lambda libprep_id: charon_session.libprep_get_seqruns(project_id,
+                                                                        sample_name,
+                                                                        libprep_id)['seqruns']
+    libprep_seqruns = collections.OrderedDict()
+    for libprep_id, seqruns in zip(libprep_ids,
+                                   charon_session.map_concurrently(get_seqruns, libprep_ids)):
+        libprep_seqruns[libprep_id] = [seqrun["seqrunid"] for seqrun in seqruns or []]
+    return libprep_seqruns
+
+
+def determine_library_prep_from_fcid(project_id, sample_name, fcid, libprep_seqruns=None):
     """Use the information in the database to get the library prep id
     from the project name, sample name, and flowcell id.
 
     :param str project_id: The ID of the project
     :param str sample_name: The name of the sample
     :param str fcid: The flowcell ID
+    :param dict libprep_seqruns: The sample's libpreps and seqruns as returned by
+                                 get_sample_libprep_seqruns, if already fetched
 
     :returns: The library prep (e.g. "A")
     :rtype str
-    :raises ValueError: If no match was found.
+    :raises ValueError: If no match was found, or if more than one library
+                        prep of the sample was sequenced on the flowcell.
     """
-    charon_session = CharonSession()
-    try:
-        libpreps = charon_session.sample_get_libpreps(project_id, sample_name)['libpreps']
-        if libpreps:
-            for libprep in libpreps:
-                # Get the sequencing runs and see if they match the FCID we have
-                seqruns = charon_session.libprep_get_seqruns(project_id,
-                                                             sample_name,
-                                                             libprep['libprepid'])['seqruns']
-                if seqruns:
-                    for seqrun in seqruns:
-                        seqrun_runid = seqrun["seqrunid"]
-                        if seqrun_runid == fcid:
-                            ## BUG if we have one sample with two libpreps on the same flowcell,
-                            ##     this just picks the first one it encounters; instead,
-                            ##     it should raise an Exception. Requires restructuring.
-                            return libprep['libprepid']
+    if libprep_seqruns is None:
+        try:
+            libprep_seqruns = get_sample_libprep_seqruns(project_id, sample_name)
+        except CharonError as e:
+            if e.status_code == 404:
+                raise ValueError('No library prep found for project "{}" / sample "{}" '
+                                 '/ fcid "{}"'.format(project_id, sample_name, fcid))
             else:
-                raise CharonError("No match", 404)
-        else:
-            raise CharonError("No libpreps found!", 404)
-    except CharonError as e:
-        if e.status_code == 404:
-            raise ValueError('No library prep found for project "{}" / sample "{}" '
-                             '/ fcid "{}"'.format(project_id, sample_name, fcid))
-        else:
-            raise ValueError('Could not determine library prep for project "{}" '
-                             '/ sample "{}" / fcid "{}": {}'.format(project_id,
-                                                                    sample_name,
-                                                                    fcid,
-                                                                    e))
+                raise ValueError('Could not determine library prep for project "{}" '
+                                 '/ sample "{}" / fcid "{}": {}'.format(project_id,
+                                                                        sample_name,
+                                                                        fcid,
+                                                                        e))
+    matches = [libprep_id for libprep_id, seqrun_ids in libprep_seqruns.items()
+               if fcid in seqrun_ids]
+    if not matches:
+        raise ValueError('No library prep found for project "{}" / sample "{}" '
+                         '/ fcid "{}"'.format(project_id, sample_name, fcid))
+    elif len(matches) > 1:
+        raise ValueError('Cannot determine library prep for project "{}" / sample "{}" '
+                         '/ fcid "{}": library preps {} were all sequenced on this '
+                         'flowcell'.format(project_id, sample_name, fcid,
+                                           ", ".join(matches)))
+    return matches[0]
 
 
 def determine_library_prep_from_samplesheet(samplesheet_path, project_id, sample_id, lane_num):
-    lane_num = int(lane_num) # Raises ValueError if it can't convert. Handy
-    samplesheet = parse_samplesheet(samplesheet_path)
-    for row in samplesheet:
-        if not row.get("Description"):
-            continue
-        ss_project_id = row.get("SampleProject") or row.get("Sample_Project") or row.get("Project")
-        ss_project_id = ss_project_id.replace('Project_', '')
-        ss_sample_id = row.get("SampleID") or row.get("Sample_ID")
-        ss_sample_id = ss_sample_id.replace('Sample_', '')
-        ss_lane_num = int(row["Lane"])
-        if project_id == ss_project_id and \
-           sample_id == ss_sample_id and \
-           lane_num == ss_lane_num:
-               # Resembles 'LIBRARY_NAME:SX398_NA11993_Nano'
-               for keyval in row["Description"].split(";"):
-                       if keyval.split(":")[0] =="LIBRARY_NAME":
-                           return keyval.split(":")[1]
-               else:
-                   error_msg = ('Malformed description in "{}"; cannot get '
-                                'libprep information'.format(samplesheet_path))
-                   raise ValueError(error_msg)
-    else:
-        error_msg = ('No match found in "{}" for project "{}" / sample "{}" / '
-                     'lane number "{}"'.format(samplesheet_path,
-                                               project_id, sample_id,
-                                               lane_num))
-        raise ValueError(error_msg)
+    return index_samplesheet(samplesheet_path).get_library_prep(project_id, sample_id, lane_num)
+
+
+class SampleSheetIndex(object):
+    """The rows of a parsed SampleSheet that have a Description, indexed by
+    (project, sample, lane) with the LIBRARY_NAME of the description already
+    extracted. Where several rows share a key the first one counts.
+    """
+    def __init__(self, samplesheet_path, rows):
+        """
+        :param str samplesheet_path: The path to the SampleSheet (for messages)
+        :param list rows: The rows, as returned by parse_samplesheet
+        """
+        self.samplesheet_path = samplesheet_path
+        # (project_id, sample_id, lane_num) -> libprep name, or None if the
+        # description has no LIBRARY_NAME
+        self._library_preps = {}
+        for row in rows:
+            if not row.get("Description"):
+                continue
+            try:
+                ss_project_id = row.get("SampleProject") or row.get("Sample_Project") or row.get("Project")
+                ss_project_id = ss_project_id.replace('Project_', '')
+                ss_sample_id = row.get("SampleID") or row.get("Sample_ID")
+                ss_sample_id = ss_sample_id.replace('Sample_', '')
+                ss_lane_num = int(row["Lane"])
+            except (AttributeError, KeyError, ValueError):
+                LOG.debug('Skipping incomplete row in "{}": {}'.format(samplesheet_path, row))
+                continue
+            key = (ss_project_id, ss_sample_id, ss_lane_num)
+            if key in self._library_preps:
+                continue
+            # Resembles 'LIBRARY_NAME:SX398_NA11993_Nano'
+            for keyval in row["Description"].split(";"):
+                if keyval.split(":")[0] == "LIBRARY_NAME":
+                    self._library_preps[key] = keyval.split(":")[1]
+                    break
+            else:
+                self._library_preps[key] = None
 
+    def __len__(self):
+        return len(self._library_preps)
 
-@memoized
+    def get_library_prep(self, project_id, sample_id, lane_num):
+        """Return the library prep of a sample on a lane.
+
+        :param str project_id: The project as named in the SampleSheet
+        :param str sample_id: The sample id
+        :param lane_num: The lane number (int or str)
+
+        :returns: The library prep name
+        :rtype: str
+        :raises ValueError: If there is no row for the sample on that lane, or
+                            its description has no LIBRARY_NAME
+        """
+        lane_num = int(lane_num) # Raises ValueError if it can't convert. Handy
+        try:
+            libprep_name = self._library_preps[(project_id, sample_id, lane_num)]
+        except KeyError:
+            error_msg = ('No match found in "{}" for project "{}" / sample "{}" / '
+                         'lane number "{}"'.format(self.samplesheet_path,
+                                                   project_id, sample_id,
+                                                   lane_num))
+            raise ValueError(error_msg)
+        if libprep_name is None:
+            error_msg = ('Malformed description in "{}"; cannot get '
+                         'libprep information'.format(self.samplesheet_path))
+            raise ValueError(error_msg)
+        return libprep_name
+
+
+@memoized(maxsize=SAMPLESHEET_CACHE_SIZE, validate_paths=True)
+def index_samplesheet(samplesheet_path):
+    """Parses an Illumina SampleSheet.csv into a SampleSheetIndex; done once
+    per SampleSheet, and again if the file changes.
+    """
+    return SampleSheetIndex(samplesheet_path, parse_samplesheet(samplesheet_path))
+
+
+@memoized(maxsize=SAMPLESHEET_CACHE_SIZE, validate_paths=True)
 def parse_samplesheet(samplesheet_path):
-    """Parses an Illumina SampleSheet.csv and returns a list of dicts
+    """Parses an Illumina SampleSheet.csv and returns a list of dicts;
+    the result is reused until the file changes.
     """
     try:
         # try opening as a gzip file (Uppsala)
@@ -181,36 +256,31 @@ def find_fastq_read_pairs(file_list):
     :returns: A dict of file_basename -> [file1, file2]
     :rtype: dict
     """
-    # We only want fastq files
-    pt = re.compile(".*\.(fastq|fq)(\.gz|\.gzip|\.bz2)?$")
-    file_list = filter(pt.match, file_list)
-    if not file_list:
-        # No files found
-        LOG.warn("No fastq files found.")
-        return {}
     # --> This is the SciLifeLab-Sthlm-specific format (obsolete as of August 1st, hopefully)
     #     Format: <lane>_<date>_<flowcell>_<project-sample>_<read>.fastq.gz
     #     Example: 1_140220_AH8AMJADXX_P673_101_1.fastq.gz
     # --> This is the standard Illumina/Uppsala format (and Sthlm -> August 1st 2014)
     #     Format: <sample_name>_<index>_<lane>_<read>_<group>.fastq.gz
     #     Example: NA10860_NR_TAAGGC_L005_R1_001.fastq.gz
-    suffix_pattern = re.compile(r'(.*)fastq')
-    # Cut off at the read group
-    file_format_pattern = re.compile(r'(.*)_(?:R\d|\d\.).*')
     matches_dict = collections.defaultdict(list)
     for file_pathname in file_list:
         file_basename = os.path.basename(file_pathname)
-        fc_id = os.path.dirname(file_pathname).split("_")[-1]
-        try:
-            # Check for a pair
-            pair_base = file_format_pattern.match(file_basename).groups()[0]
-            matches_dict["{}_{}".format(pair_base,fc_id)].append(file_pathname)
-        except AttributeError:
+        # We only want fastq files
+        stem = fastq_stem(file_basename)
+        if stem is None:
+            continue
+        pair_base = fastq_pair_base(file_basename)
+        if pair_base is not None:
+            fc_id = os.path.dirname(file_pathname).split("_")[-1]
+            matches_dict["{}_{}".format(pair_base, fc_id)].append(file_pathname)
+        else:
             LOG.warn("Warning: file doesn't match expected file format, "
                       "cannot be paired: \"{}\"".format(file_pathname))
-            # File could not be paired, set by itself (?)
-            file_basename_stripsuffix = suffix_pattern.split(file_basename)[0]
-            matches_dict[file_basename_stripsuffix].append(os.abspath(file_pathname))
+            # File could not be paired, set by itself
+            matches_dict[stem].append(os.path.abspath(file_pathname))
+    if not matches_dict:
+        # No files found
+        LOG.warn("No fastq files found.")
     return dict(matches_dict)
 
 
@@ -229,21 +299,18 @@ def parse_lane_from_filename(sample_basename):
 
     returns a lane as an int or raises a ValueError if there is no match
     (which shouldn't generally happen and probably indicates a larger issue).
+    The Illumina lane is all three digits after "_L" (L010 is lane 10); it
+    used to be the last digit only.
 
     :param str sample_basename: The name of the file from which to pull the project id
     :returns: (project_id, sample_id)
     :rtype: tuple
     :raises ValueError: If the ids cannot be determined from the filename (no regex match)
     """
-    # Stockholm or \
-    # Illumina
-    match = re.match(r'(?P<lane>\d)_\d{6}_\w{10}_(?P<project>P\d{3})_(?P<sample>\d{3}).*', sample_basename) or \
-            re.match(r'.*_L\d{2}(?P<lane>\d{1}).*', sample_basename)
-            #re.match(r'(?P<project>P\d{3})_(?P<sample>\w+)_.*_L(?P<lane>\d{3})', sample_basename)
-
-    if match:
-        #return match.group('project'), match.group('sample'), match.group('lane')
-        return int(match.group('lane'))
+    # Stockholm or Illumina
+    lane = fastq_lane(os.path.basename(sample_basename))
+    if lane is not None:
+        return lane
     else:
         error_msg = ('Error: filename didn\'t match conventions, '
                      'couldn\'t find lane number for sample '
@@ -252,7 +319,7 @@ def parse_lane_from_filename(sample_basename):
         raise ValueError(error_msg)
 
 
-@memoized
+@memoized(maxsize=4096)
 def get_flowcell_id_from_dirtree(path):
     """Given the path to a file, tries to work out the flowcell ID.
 
@@ -21,6 +21,7 @@ from ngi_pipeline.conductor.flowcell import organize_projects_from_flowcell, \
                                             setup_analysis_directory_structure
 from ngi_pipeline.database.classes import CharonError
 from ngi_pipeline.database.filesystem import create_charon_entries_from_project
+from ngi_pipeline.database.journal import get_charon_journal
 from ngi_pipeline.engines import qc_ngi
 from ngi_pipeline.log.loggers import minimal_logger
 from ngi_pipeline.server import main as server_main
@@ -28,6 +29,7 @@ from ngi_pipeline.utils.charon import find_projects_from_samples, \
                                       reset_charon_records_by_object, \
                                       reset_charon_records_by_name
 from ngi_pipeline.utils.filesystem import locate_project, recreate_project_from_filesystem
+from ngi_pipeline.utils.layout_cache import use_layout_index
 from ngi_pipeline.utils.parsers import parse_samples_from_vcf
 
 LOG = minimal_logger(os.path.basename(__file__))
@@ -127,6 +129,8 @@ if __name__ == "__main__":
             help="Restrict processing to these samples. Use flag multiple times for multiple samples.")
     organize_flowcell.add_argument("-p", "--project", dest="restrict_to_projects", action="append",
             help="Restrict processing to these projects. Use flag multiple times for multiple projects.")
+    organize_flowcell.add_argument("--workers", type=int, default=1,
+            help="The number of flowcells to organize concurrently.")
 
     # Add subparser for deletion
     parser_delete = subparsers.add_parser('delete', help="Delete data systematically.")
@@ -167,6 +171,8 @@ if __name__ == "__main__":
     analyze_flowcell.add_argument("-p", "--project", dest="restrict_to_projects", action="append",
             help=("Restrict analysis to these projects. "
                   "Use flag multiple times for multiple projects."))
+    analyze_flowcell.add_argument("--workers", type=int, default=1,
+            help="The number of flowcells to organize concurrently (default 1).")
     # Add sub-subparser for project analysis
     analyze_project = subparsers_analyze.add_parser('project',
             help='Start the analysis of a pre-parsed project.')
@@ -236,8 +242,20 @@ if __name__ == "__main__":
     #genotype_sample = subparsers_genotype.add_parser('sample',
     #        help="Start genotype analysis for one specific sample in a project.")
 
+    # Add subparser for the journal of undelivered Charon updates
+    parser_journal = subparsers.add_parser('journal',
+            help="Manage Charon updates journaled while Charon was unavailable.")
+    subparsers_journal = parser_journal.add_subparsers(help="Choose the action.")
+    journal_replay = subparsers_journal.add_parser('replay',
+            help="Send the journaled updates to Charon.")
+    journal_replay.set_defaults(journal_action="replay")
+    journal_show = subparsers_journal.add_parser('show',
+            help="List the journaled updates, oldest first.")
+    journal_show.set_defaults(journal_action="show")
+
 
     args = parser.parse_args()
+    use_layout_index()
 
     # These options are available only if the script has been called with the 'analyze' option
     restart_all_jobs = args.__dict__.get('restart_all_jobs')
@@ -291,7 +309,8 @@ if __name__ == "__main__":
                                                  no_qc=args.no_qc,
                                                  quiet=args.quiet,
                                                  manual=True,
-                                                 generate_bqsr_bam=args.generate_bqsr_bam)
+                                                 generate_bqsr_bam=args.generate_bqsr_bam,
+                                                 workers=args.workers)
 
     ## Analyze Project
     elif 'analyze_project_dirs' in args:
@@ -470,7 +489,8 @@ if __name__ == "__main__":
                                                 restrict_to_projects=args.restrict_to_projects,
                                                 restrict_to_samples=args.restrict_to_samples,
                                                 fallback_libprep=args.fallback_libprep,
-                                                quiet=args.quiet)
+                                                quiet=args.quiet,
+                                                workers=args.workers)
         for project in projects_to_analyze:
             try:
                 create_charon_entries_from_project(project=project,
@@ -521,6 +541,21 @@ if __name__ == "__main__":
                                             keep_existing_data=args.keep_existing_data,
                                             level="genotype")
 
+    ## Charon journal
+    elif 'journal_action' in args:
+        journal = get_charon_journal()
+        if args.journal_action == "show":
+            for entry in journal.pending():
+                print("{}\t{}\t{}\t{}\t{}".format(entry.seq, entry.label or entry.url,
+                                                  entry.data, entry.attempts,
+                                                  entry.last_error or ""))
+        else:
+            result = journal.replay()
+            LOG.info("Journal replayed: {} document(s) updated, {} rejected, "
+                     "{} still pending".format(*result))
+            if result.remaining:
+                sys.exit(1)
+
     ## Server
     elif 'port' in args:
         LOG.info('Starting ngi_pipeline server at port {}'.format(args.port))
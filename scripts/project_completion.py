@@ -12,63 +12,46 @@ import tempfile
 import time
 
 from ngi_pipeline.conductor.flowcell import organize_projects_from_flowcell
-from ngi_pipeline.database.classes import CharonSession, CharonError
+from ngi_pipeline.database.async_classes import AsyncCharonSession
+from ngi_pipeline.database.classes import CharonError
+from ngi_pipeline.database.mirror import get_charon_read_session
 from ngi_pipeline.engines.piper_ngi.local_process_tracking import update_charon_with_local_jobs_status
 from ngi_pipeline.utils.classes import with_ngi_config
 from ngi_pipeline.utils.filesystem import locate_project
+from tornado import gen
+from tornado.ioloop import IOLoop
 
 print_stderr = functools.partial(print, file=sys.stderr)
 
-def project_summarize(projects, verbosity=0):
+def project_summarize(projects, verbosity=0, use_async=False):
+    """Print the status of the given projects.
+
+    :param list projects: The names, ids or paths of the projects
+    :param int verbosity: 0 to 2+
+    :param bool use_async: Fetch all the projects from Charon at once
+                           rather than one after the other
+    """
     if type(verbosity) is not int or verbosity < 0:
         print_stderr('Invalid verbosity level ("{}"); must be a positive '
                      'integer; falling back to 0')
         verbosity = 0
     update_charon_with_local_jobs_status(quiet=True) # Don't send mails
-    charon_session = CharonSession()
-    projects_list = []
+    project_names = []
     for project in projects:
         try:
-            project = os.path.basename(locate_project(project))
+            project_names.append(os.path.basename(locate_project(project)))
         except ValueError as e:
             print_stderr("Skipping project: {}".format(e))
+    if use_async:
+        charon_trees = IOLoop().run_sync(lambda: get_charon_trees_async(project_names))
+    else:
+        charon_trees = get_charon_trees(project_names)
+    projects_list = []
+    for project, charon_tree in zip(project_names, charon_trees):
+        if isinstance(charon_tree, CharonError):
+            print_stderr('Project "{}" not found in Charon; skipping ({})'.format(project, charon_tree))
             continue
-        print_stderr('Gathering information for project "{}"...'.format(project))
-        project_dict = {}
-        try:
-            project = charon_session.project_get(project)
-        except CharonError as e:
-            print_stderr('Project "{}" not found in Charon; skipping ({})'.format(project, e), file=sys.stderr)
-            continue
-        project_dict['name'] = project['name']
-        project_dict['id'] = project['projectid']
-        project_dict['status'] = project['status']
-        samples_list = project_dict['samples'] = []
-        for sample in charon_session.project_get_samples(project['projectid']).get('samples', []):
-            sample_dict = {}
-            sample_dict['id'] = sample['sampleid']
-            sample_dict['analysis_status'] = sample['analysis_status']
-            sample_dict['coverage'] = sample['total_autosomal_coverage']
-            libpreps_list = sample_dict['libpreps'] = []
-            samples_list.append(sample_dict)
-            for libprep in charon_session.sample_get_libpreps(project['projectid'],
-                                                              sample['sampleid']).get('libpreps', []):
-                libprep_dict = {}
-                libprep_dict['id'] = libprep['libprepid']
-                libprep_dict['qc'] = libprep['qc']
-                seqruns_list = libprep_dict['seqruns'] = []
-                libpreps_list.append(libprep_dict)
-                for seqrun in charon_session.libprep_get_seqruns(project['projectid'],
-                                                                 sample['sampleid'],
-                                                                 libprep['libprepid']).get('seqruns', []):
-                    seqrun_dict = {}
-                    seqrun_dict['id'] = seqrun['seqrunid']
-                    seqrun_dict['alignment_status'] = seqrun['alignment_status']
-                    seqrun_dict['coverage'] = seqrun['mean_autosomal_coverage']
-                    if seqrun.get('total_reads'):
-                        seqrun_dict['total_reads'] = seqrun['total_reads']
-                    seqruns_list.append(seqrun_dict)
-        projects_list.append(project_dict)
+        projects_list.append(project_dict_from_charon_tree(charon_tree))
 
 
     if verbosity in (0, 1):
@@ -163,6 +146,77 @@ def project_summarize(projects, verbosity=0):
             print_stderr("\n")
 
 
+def get_charon_trees(project_names):
+    """Fetch the Charon records for each project in turn.
+
+    :returns: A CharonProjectTree, or the CharonError raised, per project
+    :rtype: list
+    """
+    charon_session = get_charon_read_session()
+    charon_trees = []
+    for project in project_names:
+        print_stderr('Gathering information for project "{}"...'.format(project))
+        try:
+            charon_trees.append(charon_session.project_get_tree(project))
+        except CharonError as e:
+            charon_trees.append(e)
+    return charon_trees
+
+
+@gen.coroutine
+def get_charon_trees_async(project_names):
+    """As get_charon_trees, but with all the projects fetched concurrently."""
+    charon_session = AsyncCharonSession()
+
+    @gen.coroutine
+    def get_tree(project):
+        try:
+            charon_tree = yield charon_session.project_get_tree(project)
+        except CharonError as e:
+            raise gen.Return(e)
+        raise gen.Return(charon_tree)
+
+    print_stderr('Gathering information for {} projects...'.format(len(project_names)))
+    try:
+        charon_trees = yield [get_tree(project) for project in project_names]
+    finally:
+        charon_session.close()
+    raise gen.Return(charon_trees)
+
+
+def project_dict_from_charon_tree(charon_tree):
+    """Extract the fields shown in the summary from a CharonProjectTree."""
+    project_dict = {}
+    project = charon_tree.project
+    project_dict['name'] = project['name']
+    project_dict['id'] = project['projectid']
+    project_dict['status'] = project['status']
+    samples_list = project_dict['samples'] = []
+    for sample in charon_tree.samples.values():
+        sample_dict = {}
+        sample_dict['id'] = sample['sampleid']
+        sample_dict['analysis_status'] = sample['analysis_status']
+        sample_dict['coverage'] = sample['total_autosomal_coverage']
+        libpreps_list = sample_dict['libpreps'] = []
+        samples_list.append(sample_dict)
+        for libprep in charon_tree.get_libpreps(sample['sampleid']):
+            libprep_dict = {}
+            libprep_dict['id'] = libprep['libprepid']
+            libprep_dict['qc'] = libprep['qc']
+            seqruns_list = libprep_dict['seqruns'] = []
+            libpreps_list.append(libprep_dict)
+            for seqrun in charon_tree.get_seqruns(sample['sampleid'],
+                                                  libprep['libprepid']):
+                seqrun_dict = {}
+                seqrun_dict['id'] = seqrun['seqrunid']
+                seqrun_dict['alignment_status'] = seqrun['alignment_status']
+                seqrun_dict['coverage'] = seqrun['mean_autosomal_coverage']
+                if seqrun.get('total_reads'):
+                    seqrun_dict['total_reads'] = seqrun['total_reads']
+                seqruns_list.append(seqrun_dict)
+    return project_dict
+
+
 def flowcell_summarize(flowcells, brief=False, verbose=False):
     projects_to_analyze = \
             organize_projects_from_flowcell(demux_fcid_dirs=flowcells,
@@ -179,6 +233,8 @@ if __name__=="__main__":
     project_parser = subparsers.add_parser('project')
     project_parser.add_argument('project_dirs', nargs='+',
             help=('The name or ID (in Charon) of or path to one or more projects to be summarized.'))
+    project_parser.add_argument('-a', '--async', dest="use_async", action="store_true",
+            help=('Fetch all the projects from Charon concurrently.'))
 
     flowcell_parser = subparsers.add_parser('flowcell')
     flowcell_parser.add_argument('flowcell_dirs', nargs='+',
@@ -188,7 +244,7 @@ if __name__=="__main__":
     args = parser.parse_args()
 
     if "project_dirs" in args:
-        project_summarize(args.project_dirs, args.verbosity)
+        project_summarize(args.project_dirs, args.verbosity, args.use_async)
     elif "flowcell_dirs" in args:
         flowcell_summarize(args.flowcell_dirs, args.verbosity)
     else:
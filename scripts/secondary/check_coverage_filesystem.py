@@ -3,7 +3,8 @@ from __future__ import print_function
 import argparse
 import sys
 
-from ngi_pipeline.engines.piper_ngi.local_process_tracking import _parse_mean_coverage_from_qualimap
+from ngi_pipeline.engines.piper_ngi.parsers import parse_mean_coverage_from_qualimap
+from ngi_pipeline.utils.metrics_cache import use_metrics_cache
 
 if __name__=="__main__":
     parser = argparse.ArgumentParser(("Determine if a particular sample or sequencing run "
@@ -29,7 +30,8 @@ if __name__=="__main__":
     fcid = args.fcid if args.fcid else None
     required_coverage = args.required_coverage
 
-    reported_coverage = _parse_mean_coverage_from_qualimap(qc_path, sample, run, fcid)
+    use_metrics_cache()
+    reported_coverage = parse_mean_coverage_from_qualimap(qc_path, sample, run, fcid)
 
     print("Coverage is {}".format(reported_coverage))
     if required_coverage: